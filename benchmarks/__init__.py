@@ -0,0 +1,12 @@
+"""Benchmarks for transfat which run offline with stand-in executables.
+
+Run them from the root of the repository like so:
+
+    $ python3 -m benchmarks.run --sizes 1000 10000
+
+or do
+
+    $ python3 -m benchmarks.run -h
+
+to see how to be fancier.
+"""
@@ -0,0 +1,210 @@
+"""Contains functions to write stand-ins for transfat's external programs.
+
+The stand-ins are small Python scripts which behave just enough like
+the real programs for transfat to run against them, after sleeping for
+a configurable latency. Each reads its latency in seconds from the
+TRANSFAT_FAKE_<NAME>_LATENCY environment variable (for example,
+TRANSFAT_FAKE_FFMPEG_LATENCY), falling back to TRANSFAT_FAKE_LATENCY.
+
+The fake FAT device is "mounted" by a fake mount table, which transfat
+reads in place of /proc/self/mountinfo once mounts.MOUNTINFO_PATH points
+at it. Benchmarks running transfat in a fresh interpreter run it through
+a launcher which does that first.
+"""
+
+import os
+import sys
+
+# Name of the fake mount table in the stand-ins' directory
+MOUNTINFO_NAME = "mountinfo"
+
+# Name of the launcher in the stand-ins' directory
+LAUNCHER_NAME = "run_transfat.py"
+
+# Runs transfat from a repository with the fake mount table
+LAUNCHER = """#!%s
+import sys
+
+sys.path.insert(0, %r)
+
+from transfat import main
+from transfat import mounts
+
+mounts.MOUNTINFO_PATH = %r
+
+main.main()
+"""
+
+# Common preamble of every stand-in
+PREAMBLE = """#!%s
+import os
+import shutil
+import sys
+import time
+
+latency = os.environ.get(
+    "TRANSFAT_FAKE_%%s_LATENCY" %% os.path.basename(sys.argv[0]).upper(),
+    os.environ.get("TRANSFAT_FAKE_LATENCY", "0"),
+)
+time.sleep(float(latency))
+args = sys.argv[1:]
+"""
+
+# Bodies of the stand-ins, by program name
+PROGRAMS = {
+    # Copies its input to its output instead of converting
+    "ffmpeg": """
+if args[:1] == ["-version"]:
+    print("ffmpeg version 0.0-transfat-benchmark")
+    sys.exit(0)
+
+source = args[args.index("-i") + 1]
+destination = args[-1]
+
+if "-n" in args and os.path.exists(destination):
+    sys.exit(1)
+
+shutil.copyfile(source, destination)
+""",
+    # Says every file is three minutes long, with a little cover art
+    "ffprobe": """
+if "json" in args:
+    print(
+        '{"packets": [{"stream_index": 1, "size": "20000"}], '
+        '"streams": [{"index": 0, "codec_name": "flac", '
+        '"codec_type": "audio", "sample_rate": "44100", '
+        '"disposition": {"attached_pic": 0}}, '
+        '{"index": 1, "codec_name": "mjpeg", "codec_type": "video", '
+        '"disposition": {"attached_pic": 1}}], '
+        '"format": {"duration": "180.000000", "bit_rate": "900000"}}'
+    )
+else:
+    print("180.000000")
+""",
+    # Pretends to sort
+    "fatsort": """
+""",
+    # Pretends to unmount
+    "umount": """
+""",
+    # Runs its command without asking for anything
+    "sudo": """
+while args and args[0].startswith("-"):
+    args.pop(0)
+
+os.execvp(args[0], args)
+""",
+}
+
+
+def writeFakePrograms(directory, skip=()):
+    """Write the stand-in programs into a directory.
+
+    Put the directory at the front of PATH to use them.
+
+    Args:
+        directory: A string containing the path of the directory to
+            write to. It's created if it doesn't exist.
+        skip: An optional collection of strings containing the names of
+            programs not to write, so that the real ones are used.
+
+    Returns:
+        A list of strings containing the names of the programs written.
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    names = sorted(set(PROGRAMS) - set(skip))
+
+    for name in names:
+        body = PROGRAMS[name]
+        path = os.path.join(directory, name)
+
+        with open(path, "w") as program:
+            program.write(PREAMBLE % sys.executable + body)
+
+        os.chmod(path, 0o755)
+
+    return names
+
+
+def getMountInfoPath(directory):
+    """Return the path of the fake mount table in a directory."""
+    return os.path.join(directory, MOUNTINFO_NAME)
+
+
+def writeMountInfo(directory, mountLocation):
+    """Write a mount table with a fake FAT device mounted.
+
+    Args:
+        directory: A string containing the path of the directory the
+            stand-ins are in.
+        mountLocation: A string containing the path the fake FAT device
+            is "mounted" at.
+    """
+    # Escape paths the way the kernel does
+    escapedLocation = "".join(
+        "\\%03o" % ord(character) if character in " \t\n\\" else character
+        for character in os.path.abspath(mountLocation)
+    )
+
+    with open(getMountInfoPath(directory), "w") as mountInfo:
+        mountInfo.write(
+            "1 0 0:1 / / rw - rootfs rootfs rw\n"
+            "2 1 8:17 / %s rw,nosuid - vfat /dev/transfat-fake rw\n"
+            % escapedLocation
+        )
+
+
+def writeLauncher(directory, repositoryPath):
+    """Write a script which runs transfat with the fake mount table.
+
+    Args:
+        directory: A string containing the path of the directory the
+            stand-ins (and the fake mount table) are in.
+        repositoryPath: A string containing the path of the repository
+            to run transfat from.
+
+    Returns:
+        A string containing the path of the script.
+    """
+    path = os.path.join(directory, LAUNCHER_NAME)
+
+    with open(path, "w") as launcher:
+        launcher.write(
+            LAUNCHER
+            % (
+                sys.executable,
+                os.path.abspath(repositoryPath),
+                getMountInfoPath(directory),
+            )
+        )
+
+    os.chmod(path, 0o755)
+
+    return path
+
+
+def getEnvironment(directory, latency=0.0, latencies=None):
+    """Return an environment which uses the stand-in programs.
+
+    Args:
+        directory: A string containing the path of the directory the
+            stand-ins (and the fake mount table) are in.
+        latency: An optional float containing the default latency of
+            each program in seconds.
+        latencies: An optional dictionary mapping program names to
+            latencies in seconds, overriding the default.
+
+    Returns:
+        A dictionary containing environment variables.
+    """
+    environment = dict(os.environ)
+    environment["PATH"] = directory + os.pathsep + environment["PATH"]
+    environment["TRANSFAT_FAKE_LATENCY"] = str(latency)
+
+    for name, programLatency in (latencies or {}).items():
+        environment["TRANSFAT_FAKE_%s_LATENCY" % name.upper()] = str(
+            programLatency
+        )
+
+    return environment
@@ -0,0 +1,346 @@
+"""Contains functions to build FAT image files for sorting.
+
+Nothing here needs root, mkfs, or a loop device: images are written
+byte by byte. Files in an image are empty; only their directory entries
+matter for sorting.
+
+An image's directories are described as lists of items. Each item is
+either a bytes object holding raw directory slots, which is written as
+is (see getShortEntry and getLongEntries), or a 3-tuple of ("name",
+b"SHORTNAME  ", items) for a subdirectory, whose items describe its
+contents the same way. Subdirectories get "." and ".." entries of their
+own before their items.
+"""
+
+import random
+import struct
+from transfat import fatfs
+
+# Layout of the images built
+SECTOR_SIZE = 512
+SECTORS_PER_CLUSTER = 1
+FAT_COUNT = 2
+
+# Reserved sectors before the first FAT, by FAT type
+RESERVED_SECTORS = {12: 1, 16: 1, 32: 32}
+
+# Number of clusters in images of each FAT type, which decides the type
+CLUSTER_COUNTS = {12: 2000, 16: 8000, 32: 65525}
+
+# Number of entries in the fixed root directory of FAT12 and FAT16
+ROOT_ENTRY_COUNT = 512
+
+# Marks the end of a cluster chain, by FAT type
+END_OF_CHAIN = {12: 0xFFF, 16: 0xFFFF, 32: 0x0FFFFFFF}
+
+# Short names of the dot entries
+DOT_NAME = b".          "
+DOT_DOT_NAME = b"..         "
+
+
+def getShortEntry(shortName, attributes, cluster=0, caseFlags=0):
+    """Return a short directory entry.
+
+    Args:
+        shortName: A bytes object containing an 11 byte, space padded
+            8.3 name.
+        attributes: An integer containing the entry's attributes.
+        cluster: An optional integer containing the entry's first
+            cluster.
+        caseFlags: An optional integer containing the flags saying
+            which parts of the name are lowercase.
+    """
+    entry = bytearray(fatfs.ENTRY_SIZE)
+    entry[0:11] = shortName
+    entry[11] = attributes
+    entry[12] = caseFlags
+    struct.pack_into("<H", entry, 20, cluster >> 16)
+    struct.pack_into("<H", entry, 26, cluster & 0xFFFF)
+
+    return bytes(entry)
+
+
+def getLongEntries(name, shortEntry):
+    """Return a short entry preceded by long entries holding a name."""
+    checksum = fatfs.getShortNameChecksum(shortEntry)
+    units = name.encode("utf-16-le")
+    units = [units[index : index + 2] for index in range(0, len(units), 2)]
+
+    # Names are terminated and padded out to a whole number of entries
+    if len(units) % 13:
+        units.append(b"\0\0")
+        units += [b"\xff\xff"] * (-len(units) % 13)
+
+    slots = []
+    slotCount = len(units) // 13
+
+    for index in range(slotCount):
+        slot = bytearray(fatfs.ENTRY_SIZE)
+        slot[0] = (index + 1) | (0x40 if index == slotCount - 1 else 0)
+        slot[11] = fatfs.ATTRIBUTE_LONG_NAME
+        slot[13] = checksum
+
+        for unit, offset in zip(
+            units[index * 13 : index * 13 + 13], fatfs.LONG_NAME_OFFSETS
+        ):
+            slot[offset : offset + 2] = unit
+
+        slots.append(bytes(slot))
+
+    return b"".join(reversed(slots)) + shortEntry
+
+
+def getDeletedEntries(slots):
+    """Return directory slots marked as deleted."""
+    deleted = bytearray(slots)
+
+    for index in range(0, len(deleted), fatfs.ENTRY_SIZE):
+        deleted[index] = fatfs.DELETED_MARKER
+
+    return bytes(deleted)
+
+
+def buildVolume(path, fatType, root):
+    """Write a FAT image holding a tree of directories.
+
+    Each directory gets a contiguous run of clusters, so directories
+    with more entries than fit in a cluster span several. On FAT12 and
+    FAT16, the root directory lives in its fixed region instead, and
+    must fit in it.
+
+    Args:
+        path: A string containing the path of the image file to write.
+        fatType: An integer which is one of 12, 16, or 32.
+        root: A list of the root directory's items, as described in the
+            module docstring.
+    """
+    clusterSize = SECTOR_SIZE * SECTORS_PER_CLUSTER
+
+    def getClusterCount(data):
+        """Return the number of clusters some data takes up."""
+        return max(1, -(-len(data) // clusterSize))
+
+    def getData(items, cluster=None, parentCluster=0):
+        """Return a directory's contents, along with its subdirectories.
+
+        Args:
+            items: A list of the directory's items.
+            cluster: An optional integer containing the directory's first
+                cluster, or None for the root directory, which has no
+                dot entries.
+            parentCluster: An optional integer containing the parent's
+                first cluster, which is 0 for the root directory.
+
+        Returns:
+            A 2-tuple of the directory's contents as a bytes object,
+            and a list of 2-tuples of (first cluster, items) for its
+            subdirectories.
+        """
+        data = b""
+        subdirectories = []
+
+        if cluster is not None:
+            data += getShortEntry(
+                DOT_NAME, fatfs.ATTRIBUTE_DIRECTORY, cluster
+            )
+            data += getShortEntry(
+                DOT_DOT_NAME, fatfs.ATTRIBUTE_DIRECTORY, parentCluster
+            )
+
+        for item in items:
+            if isinstance(item, bytes):
+                data += item
+                continue
+
+            name, shortName, childItems = item
+            childCluster = allocations.get(id(childItems), 0)
+
+            data += getLongEntries(
+                name,
+                getShortEntry(
+                    shortName, fatfs.ATTRIBUTE_DIRECTORY, childCluster
+                ),
+            )
+            subdirectories.append((childCluster, childItems))
+
+        return (data, subdirectories)
+
+    # Allocate a run of clusters to each directory, parents first.
+    # Sizes don't depend on where things go, so a directory can be
+    # sized before its subdirectories are allocated.
+    allocations = {}
+    nextCluster = 2
+
+    if fatType == 32:
+        allocations[id(root)] = nextCluster
+        nextCluster += getClusterCount(getData(root)[0])
+
+    queue = [root]
+
+    for items in queue:
+        for item in items:
+            if isinstance(item, bytes):
+                continue
+
+            childItems = item[2]
+            allocations[id(childItems)] = nextCluster
+            nextCluster += getClusterCount(
+                getData(childItems, nextCluster)[0]
+            )
+            queue.append(childItems)
+
+    # Build every directory now that we know where they go. Pairs of
+    # (first cluster, contents) for every directory in the data region.
+    layout = []
+
+    rootData, subdirectories = getData(root)
+
+    if fatType == 32:
+        layout.append((2, rootData))
+    elif len(rootData) > ROOT_ENTRY_COUNT * fatfs.ENTRY_SIZE:
+        raise ValueError("root directory doesn't fit in its region")
+
+    # ".." holds 0 in directories in the root, whatever the FAT type
+    parents = [(0, subdirectories)]
+
+    for parentCluster, children in parents:
+        for cluster, items in children:
+            data, grandchildren = getData(items, cluster, parentCluster)
+            layout.append((cluster, data))
+            parents.append((cluster, grandchildren))
+
+    clusterCount = CLUSTER_COUNTS[fatType]
+
+    if nextCluster - 2 > clusterCount:
+        raise ValueError("directories don't fit in the image")
+
+    # Work out where everything goes
+    reservedSectors = RESERVED_SECTORS[fatType]
+    fatBytes = -(-(clusterCount + 2) * fatType // 8)
+    fatSectors = -(-fatBytes // SECTOR_SIZE)
+
+    if fatType == 32:
+        rootSectors = 0
+        rootEntryCount = 0
+    else:
+        rootSectors = ROOT_ENTRY_COUNT * fatfs.ENTRY_SIZE // SECTOR_SIZE
+        rootEntryCount = ROOT_ENTRY_COUNT
+
+    rootSector = reservedSectors + FAT_COUNT * fatSectors
+    dataSector = rootSector + rootSectors
+    totalSectors = dataSector + clusterCount * SECTORS_PER_CLUSTER
+
+    # Build the boot sector
+    bootSector = bytearray(SECTOR_SIZE)
+    bootSector[0:11] = b"\xeb\x58\x90TRANSFAT"
+    struct.pack_into(
+        "<HBHBHHBH",
+        bootSector,
+        11,
+        SECTOR_SIZE,
+        SECTORS_PER_CLUSTER,
+        reservedSectors,
+        FAT_COUNT,
+        rootEntryCount,
+        totalSectors if totalSectors < 0x10000 else 0,
+        0xF8,
+        fatSectors if fatType != 32 else 0,
+    )
+
+    if totalSectors >= 0x10000:
+        struct.pack_into("<I", bootSector, 32, totalSectors)
+
+    if fatType == 32:
+        struct.pack_into("<I", bootSector, 36, fatSectors)
+        struct.pack_into("<I", bootSector, 44, 2)
+
+    bootSector[510:512] = b"\x55\xaa"
+
+    # Build the FAT, chaining each directory's clusters together
+    # FAT12 entries are read two bytes at a time, so leave a spare
+    fat = bytearray(fatSectors * SECTOR_SIZE + 1)
+    setFatEntry(fat, fatType, 0, 0x0FFFFFF8 & END_OF_CHAIN[fatType])
+    setFatEntry(fat, fatType, 1, END_OF_CHAIN[fatType])
+
+    for firstCluster, data in layout:
+        lastCluster = firstCluster + getClusterCount(data) - 1
+
+        for cluster in range(firstCluster, lastCluster):
+            setFatEntry(fat, fatType, cluster, cluster + 1)
+
+        setFatEntry(fat, fatType, lastCluster, END_OF_CHAIN[fatType])
+
+    # Write everything, leaving the rest of the image sparse
+    with open(path, "wb") as image:
+        image.truncate(totalSectors * SECTOR_SIZE)
+        image.write(bootSector)
+
+        for index in range(FAT_COUNT):
+            image.seek((reservedSectors + index * fatSectors) * SECTOR_SIZE)
+            image.write(fat[: fatSectors * SECTOR_SIZE])
+
+        if fatType != 32:
+            image.seek(rootSector * SECTOR_SIZE)
+            image.write(rootData)
+
+        for firstCluster, data in layout:
+            image.seek(
+                dataSector * SECTOR_SIZE + (firstCluster - 2) * clusterSize
+            )
+            image.write(data)
+
+    return
+
+
+def setFatEntry(fat, fatType, cluster, value):
+    """Set the entry for a cluster in a FAT held in a bytearray."""
+    if fatType == 32:
+        struct.pack_into("<I", fat, 4 * cluster, value)
+    elif fatType == 16:
+        struct.pack_into("<H", fat, 2 * cluster, value)
+    else:
+        # Two entries share three bytes
+        offset = cluster + cluster // 2
+        pair = struct.unpack_from("<H", fat, offset)[0]
+
+        if cluster & 1:
+            pair = (pair & 0x000F) | (value << 4)
+        else:
+            pair = (pair & 0xF000) | value
+
+        struct.pack_into("<H", fat, offset, pair)
+
+
+def buildImage(path, directoryCount, filesPerDirectory, seed=0):
+    """Write a FAT32 image with directories of shuffled entries.
+
+    The root holds directoryCount directories, each holding
+    filesPerDirectory empty files with long names, all in random order.
+
+    Args:
+        path: A string containing the path of the image file to write.
+        directoryCount: An integer containing the number of directories.
+        filesPerDirectory: An integer containing the number of files in
+            each directory.
+        seed: An optional integer to seed the shuffling with.
+    """
+    randomizer = random.Random(seed)
+    root = []
+
+    for directoryIndex in range(directoryCount):
+        items = [
+            getLongEntries(
+                "%02d Track %d.mp3" % (index % 99 + 1, index),
+                getShortEntry(b"T%07dMP3" % index, 0),
+            )
+            for index in range(filesPerDirectory)
+        ]
+        randomizer.shuffle(items)
+
+        root.append(
+            ("Album %d" % directoryIndex, b"A%07d   " % directoryIndex, items)
+        )
+
+    randomizer.shuffle(root)
+
+    buildVolume(path, 32, root)
@@ -0,0 +1,149 @@
+"""Contains functions to generate synthetic music libraries."""
+
+import os
+import random
+import subprocess
+
+# Extensions of the audio files in a library, with their relative
+# frequencies
+AUDIO_EXTENSIONS = ((".flac", 6), (".mp3", 3), (".ogg", 1))
+
+# Clutter found next to the audio files in an album, with the chance of
+# an album having it
+CLUTTER = (
+    ("cover.jpg", 0.9),
+    ("folder.png", 0.2),
+    ("rip.log", 0.5),
+    ("album.cue", 0.5),
+    ("playlist.m3u", 0.3),
+    ("notes.txt", 0.1),
+)
+
+# Number of tracks on each album
+TRACKS_PER_ALBUM = 12
+
+# Number of albums by each artist
+ALBUMS_PER_ARTIST = 4
+
+# Length of each real audio sample in seconds
+SAMPLE_SECONDS = 30
+
+
+def generateLibrary(root, fileCount, fileSize=4096, seed=0):
+    """Write a library of fake audio files and clutter.
+
+    The library is laid out as root/Artist NNN/Album NNN/NN Track.ext,
+    with cover art, logs, cues, and so on scattered through the albums.
+    The same arguments always give the same library.
+
+    Args:
+        root: A string containing the path of the directory to write
+            the library to. It's created if it doesn't exist.
+        fileCount: An integer containing the number of audio files to
+            write. Clutter comes on top of this.
+        fileSize: An optional integer containing the size of each file
+            in bytes.
+        seed: An optional integer to seed the random choices with.
+
+    Returns:
+        A 2-tuple of (number of files, total bytes) written, including
+        clutter.
+    """
+    randomizer = random.Random(seed)
+    extensions = [
+        extension
+        for extension, frequency in AUDIO_EXTENSIONS
+        for _ in range(frequency)
+    ]
+
+    # Contents shared by every file; the fake executables don't care
+    # what's in them
+    contents = bytes(randomizer.getrandbits(8) for _ in range(fileSize))
+
+    tracksWritten = 0
+    filesWritten = 0
+    albumIndex = 0
+
+    while tracksWritten < fileCount:
+        albumDirectory = os.path.join(
+            root,
+            "Artist %03d" % (albumIndex // ALBUMS_PER_ARTIST),
+            "Album %03d" % albumIndex,
+        )
+        os.makedirs(albumDirectory, exist_ok=True)
+
+        # Albums are all one format, like real rips
+        extension = randomizer.choice(extensions)
+        trackCount = min(TRACKS_PER_ALBUM, fileCount - tracksWritten)
+
+        names = [
+            "%02d Track%s" % (track + 1, extension)
+            for track in range(trackCount)
+        ]
+        names += [
+            name for name, chance in CLUTTER if randomizer.random() < chance
+        ]
+
+        for name in names:
+            with open(os.path.join(albumDirectory, name), "wb") as file_:
+                file_.write(contents)
+
+        tracksWritten += trackCount
+        filesWritten += len(names)
+        albumIndex += 1
+
+    return (filesWritten, filesWritten * fileSize)
+
+
+def generateSamples(root, count, fileSize=4096, realAudio=False, seed=0):
+    """Write FLAC files for encoders to work on.
+
+    Args:
+        root: A string containing the path of the directory to write
+            the samples to. It's created if it doesn't exist.
+        count: An integer containing the number of samples to write.
+        fileSize: An optional integer containing the size of each fake
+            sample in bytes.
+        realAudio: An optional boolean toggling whether to write real
+            audio (stereo tones at 48 kHz, made with the FFmpeg on PATH)
+            instead of fake files, so that encoding them means
+            something.
+        seed: An optional integer to seed the random choices with.
+
+    Returns:
+        A list of strings containing the paths of the samples.
+    """
+    randomizer = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+    paths = []
+
+    for index in range(count):
+        path = os.path.join(root, "%02d Sample.flac" % (index + 1))
+
+        if realAudio:
+            subprocess.check_call(
+                [
+                    "ffmpeg",
+                    "-nostdin",
+                    "-loglevel",
+                    "error",
+                    "-y",
+                    "-f",
+                    "lavfi",
+                    "-i",
+                    "sine=frequency=%d:sample_rate=48000:duration=%d"
+                    % (randomizer.randint(110, 880), SAMPLE_SECONDS),
+                    "-ac",
+                    "2",
+                    path,
+                ]
+            )
+        else:
+            with open(path, "wb") as sample:
+                sample.write(
+                    bytes(randomizer.getrandbits(8) for _ in range(fileSize))
+                )
+
+        paths.append(path)
+
+    return paths
@@ -0,0 +1,617 @@
+"""Run transfat's benchmarks and print the results as JSON.
+
+Each scenario runs against a synthetic library (see library.py) with
+stand-ins for FFmpeg, fatsort, mount, and friends (see fakebin.py), so
+the benchmarks run offline on any Linux box. Transfers go to a plain
+directory pretending to be a mounted FAT device; sorting runs against
+FAT images built from scratch (see fatimage.py).
+"""
+
+import argparse
+import configparser
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from transfat import encoders
+from transfat import fatfs
+from transfat import main
+from transfat import mounts
+from transfat import plan
+from transfat import transfer
+from transfat.version import VERSION
+from . import fakebin
+from . import fatimage
+from . import library
+
+# Scenarios, in the order they run
+SCENARIOS = (
+    "startup",
+    "first-file",
+    "scan",
+    "filter",
+    "mkdir",
+    "convert",
+    "copy",
+    "cleanup",
+    "pipeline",
+    "encode",
+    "check",
+    "sort",
+    "cli",
+)
+
+# Path of the config file the benchmarks base their settings on
+CONFIG_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "transfat",
+    "config",
+    "config.ini",
+)
+
+# Path of the script which runs transfat
+RUN_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "run_transfat.py",
+)
+
+# Seconds scenarios should take at most, on top of any latency given to
+# the stand-in programs. Starting up is "transfat --version" in a fresh
+# interpreter; the first file is how long until a transfer's first file
+# shows up at its destination.
+BUDGETS = {"startup": 0.5, "first-file": 2.0}
+
+# Seconds between checks for the first file to show up
+POLL_INTERVAL = 0.005
+
+# Most files to encode with each encoder profile
+ENCODE_SAMPLES = 8
+
+# Programs which --real-ffmpeg uses the real versions of
+FFMPEG_PROGRAMS = ("ffmpeg", "ffprobe")
+
+# Settings overriding the config file's user section, so nothing
+# prompts and nothing outside the work directory is touched
+SETTING_OVERRIDES = {
+    "OverwriteDestinationFiles": "1",
+    "UseTranscodeCache": "0",
+    "CheckFreeSpace": "0",
+    "TrimToFit": "0",
+    "SortBackend": "fatsort",
+    "CheckIfSorted": "0",
+}
+
+
+def getRuntimeArguments():
+    """Return command line arguments as attributes of an object."""
+    parser = argparse.ArgumentParser(
+        prog="benchmarks.run",
+        description="run transfat's benchmarks and print JSON results",
+    )
+    parser.add_argument(
+        "--sizes",
+        help="numbers of audio files to benchmark with",
+        nargs="+",
+        type=int,
+        default=[1000, 10000, 100000],
+    )
+    parser.add_argument(
+        "--scenarios",
+        help="scenarios to run (default: all)",
+        nargs="+",
+        choices=SCENARIOS,
+        default=list(SCENARIOS),
+    )
+    parser.add_argument(
+        "--latency",
+        help="seconds each stand-in program takes to run",
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="number of conversions to run at once",
+        type=int,
+        default=os.cpu_count() or 1,
+    )
+    parser.add_argument(
+        "--scan-jobs",
+        help="number of directories to scan at once",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--file-size",
+        help="size of each generated file in bytes",
+        type=int,
+        default=4096,
+    )
+    parser.add_argument(
+        "--real-ffmpeg",
+        help=(
+            "use the FFmpeg on PATH instead of a stand-in; the encode"
+            " scenario only runs with this"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--work-directory",
+        help="directory to work in (default: a new temporary directory)",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--keep", help="keep the work directory", action="store_true"
+    )
+    parser.add_argument(
+        "--check-budgets",
+        help="exit with an error if a scenario goes over its time budget",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--verbose", help="report progress on stderr", action="store_true"
+    )
+
+    return parser.parse_args()
+
+
+def getConfigSettings(jobs, configPath):
+    """Write the benchmarks' config file and return its settings.
+
+    Args:
+        jobs: An integer containing the number of conversions to run at
+            once.
+        configPath: A string containing the path to write the config
+            file to.
+
+    Returns:
+        A dictionary-like 'configparser.SectionProxy' object containing
+        the settings in the config file's user section.
+    """
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(CONFIG_PATH)
+
+    for key, value in SETTING_OVERRIDES.items():
+        config["user"][key] = value
+    config["user"]["ConversionJobs"] = str(jobs)
+
+    with open(configPath, "w") as configFile:
+        config.write(configFile)
+
+    return config["user"]
+
+
+class Timer:
+    """Records how long scenarios take.
+
+    Attributes:
+        results: A list of dictionaries, one per scenario timed.
+    """
+
+    def __init__(self, scenarios, verbose=False, latency=0.0):
+        """Start with no results.
+
+        Args:
+            scenarios: A collection of strings containing the names of
+                the scenarios to time; others are skipped.
+            verbose: An optional boolean toggling whether to report
+                progress on stderr.
+            latency: An optional float containing the latency of the
+                stand-in programs, which budgets allow for.
+        """
+        self.scenarios = scenarios
+        self.verbose = verbose
+        self.latency = latency
+        self.results = []
+
+    def time(self, scenario, fileCount, function, *args):
+        """Time a function if its scenario is wanted.
+
+        Args:
+            scenario: A string containing the name of the scenario.
+            fileCount: An integer containing the number of files in the
+                library the scenario runs against.
+            function: The function to time.
+            *args: Arguments to call the function with.
+
+        Returns:
+            Whatever the function returns, or None if the scenario was
+            skipped.
+        """
+        if scenario not in self.scenarios:
+            return None
+
+        if self.verbose:
+            print("%s (%d files)" % (scenario, fileCount), file=sys.stderr)
+
+        cpuStart = time.process_time()
+        start = time.perf_counter()
+
+        value = function(*args)
+
+        seconds = time.perf_counter() - start
+        cpuSeconds = time.process_time() - cpuStart
+
+        result = {
+            "scenario": scenario,
+            "files": fileCount,
+            "seconds": round(seconds, 6),
+            "cpuSeconds": round(cpuSeconds, 6),
+            "filesPerSecond": round(fileCount / seconds, 1)
+            if seconds
+            else None,
+        }
+
+        # Say how the scenario did against its budget, if it has one
+        if scenario in BUDGETS:
+            result["budget"] = BUDGETS[scenario] + self.latency
+            result["withinBudget"] = seconds <= result["budget"]
+
+        self.results.append(result)
+
+        return value
+
+    def addDetails(self, details):
+        """Add details to the result of the scenario timed last.
+
+        Args:
+            details: A dictionary of details to add.
+        """
+        self.results[-1].update(details)
+
+    def getOverBudget(self):
+        """Return a list of the results which went over budget."""
+        return [
+            result
+            for result in self.results
+            if not result.get("withinBudget", True)
+        ]
+
+
+def runStartup(timer):
+    """Time starting transfat in a fresh interpreter."""
+
+    def startTransfat():
+        subprocess.check_call(
+            [sys.executable, RUN_PATH, "--version"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    timer.time("startup", 0, startTransfat)
+
+
+def hasFiles(path):
+    """Return whether there are any files under a directory."""
+    for _, _, fileNames in os.walk(path):
+        if fileNames:
+            return True
+
+    return False
+
+
+def runFirstFile(timer, size, sourcePath, mountPath, configPath, runPath):
+    """Time how long transfat takes to get its first file across."""
+    destinationPath = os.path.join(mountPath, "first")
+    command = [
+        sys.executable,
+        runPath,
+        "--config-file",
+        configPath,
+        "--non-interactive",
+        "--quiet",
+        sourcePath,
+        destinationPath,
+    ]
+
+    def waitForFirstFile():
+        transfatProcess = subprocess.Popen(
+            command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+
+        while not hasFiles(destinationPath):
+            if transfatProcess.poll() is not None:
+                break
+
+            time.sleep(POLL_INTERVAL)
+
+        return transfatProcess
+
+    transfatProcess = timer.time("first-file", size, waitForFirstFile)
+
+    # Let the rest of the transfer finish untimed
+    if transfatProcess is not None:
+        transfatProcess.wait()
+
+
+def runTransfer(timer, size, sourcePath, mountPath, configsettings, args):
+    """Time the stages of a sequential transfer, one after another."""
+    destinationPath = os.path.join(mountPath, "sequential")
+
+    transferPlan = timer.time(
+        "scan",
+        size,
+        plan.getTransferPlan,
+        [sourcePath],
+        destinationPath,
+        False,
+        True,
+        args.scan_jobs,
+    )
+
+    # Later stages need the plan even if scanning isn't being timed
+    if transferPlan is None:
+        transferPlan = plan.getTransferPlan(
+            [sourcePath], destinationPath, False, True, args.scan_jobs
+        )
+
+    timer.time(
+        "filter",
+        size,
+        transfer.filterOutExtensions,
+        transferPlan,
+        configsettings,
+        True,
+    )
+    timer.time(
+        "mkdir",
+        size,
+        transfer.createDirectories,
+        transferPlan.getDestinationDirectories(),
+        True,
+        False,
+        True,
+    )
+    tmpFiles = timer.time(
+        "convert",
+        size,
+        transfer.convertAudioFiles,
+        transferPlan,
+        configsettings,
+        True,
+        False,
+        True,
+        args.jobs,
+    )
+    timer.time(
+        "copy",
+        size,
+        transfer.copyFiles,
+        transferPlan,
+        configsettings,
+        True,
+        False,
+        True,
+    )
+    timer.time("cleanup", size, transfer.deleteFiles, tmpFiles or [], True)
+
+
+def runPipeline(timer, size, sourcePath, mountPath, configsettings, args):
+    """Time a transfer which scans, converts, and copies all at once."""
+    runtimeArguments = argparse.Namespace(
+        sources=[sourcePath],
+        destination=os.path.join(mountPath, "pipeline"),
+        non_interactive=True,
+        verbose=False,
+        quiet=True,
+    )
+
+    def pipeline():
+        transfer.transferFiles(
+            main.streamFiles(
+                runtimeArguments,
+                configsettings,
+                mountPath,
+                args.scan_jobs,
+                None,
+                [],
+                set(),
+            ),
+            configsettings,
+            True,
+            False,
+            True,
+            args.jobs,
+        )
+
+    timer.time("pipeline", size, pipeline)
+
+
+def runEncode(timer, size, workPath, configsettings, args):
+    """Time converting samples with each encoder profile in turn.
+
+    This needs the real FFmpeg (see --real-ffmpeg) to mean anything.
+    """
+    if "encode" not in timer.scenarios:
+        return
+
+    samplePath = os.path.join(workPath, "samples")
+    sampleCount = min(size, ENCODE_SAMPLES)
+
+    library.generateSamples(
+        samplePath, sampleCount, args.file_size, args.real_ffmpeg
+    )
+
+    # Convert to temporary files next to the samples, so that they can
+    # be measured
+    savedSettings = {
+        key: configsettings.get(key)
+        for key in ("EncoderProfile", "ConvertDirectlyToDestination")
+    }
+    configsettings["ConvertDirectlyToDestination"] = "0"
+
+    for name in encoders.getProfileNames(configsettings):
+        configsettings["EncoderProfile"] = name
+        samplePlan = plan.getTransferPlan(
+            [samplePath], os.path.join(workPath, "encoded"), False, True
+        )
+
+        tmpFiles = timer.time(
+            "encode",
+            sampleCount,
+            transfer.convertAudioFiles,
+            samplePlan,
+            configsettings,
+            True,
+            False,
+            True,
+            args.jobs,
+        )
+
+        timer.addDetails(
+            {
+                "profile": name,
+                "outputBytes": sum(
+                    os.path.getsize(path) for path in tmpFiles
+                ),
+            }
+        )
+
+        transfer.deleteFiles(tmpFiles, True)
+
+    for key, value in savedSettings.items():
+        if value is None:
+            configsettings.pop(key, None)
+        else:
+            configsettings[key] = value
+
+    shutil.rmtree(samplePath)
+
+
+def runSort(timer, size, workPath):
+    """Time checking and sorting a FAT image holding a library."""
+    imagePath = os.path.join(workPath, "device.img")
+    fatimage.buildImage(
+        imagePath,
+        max(1, size // library.TRACKS_PER_ALBUM),
+        min(size, library.TRACKS_PER_ALBUM),
+    )
+
+    timer.time("check", size, fatfs.countUnsortedDirectories, imagePath)
+    timer.time("sort", size, fatfs.sortDevice, imagePath)
+
+    os.remove(imagePath)
+
+
+def runCommandLine(timer, size, sourcePath, mountPath, configPath, runPath):
+    """Time running transfat from start to finish, fatsort included."""
+    command = [
+        sys.executable,
+        runPath,
+        "--config-file",
+        configPath,
+        "--non-interactive",
+        "--quiet",
+        sourcePath,
+        os.path.join(mountPath, "cli"),
+    ]
+
+    def runTransfat():
+        subprocess.check_call(
+            command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+
+    timer.time("cli", size, runTransfat)
+
+
+def main_():
+    """Run the benchmarks and print the results."""
+    args = getRuntimeArguments()
+
+    workPath = args.work_directory or tempfile.mkdtemp(
+        prefix="transfat-benchmark-"
+    )
+    binPath = os.path.join(workPath, "bin")
+    mountPath = os.path.join(workPath, "mount")
+    configPath = os.path.join(workPath, "transfatrc")
+
+    # Use the stand-ins for everything run from here on, and keep what
+    # transfat caches out of the user's cache
+    if args.real_ffmpeg:
+        fakebin.writeFakePrograms(binPath, FFMPEG_PROGRAMS)
+    else:
+        fakebin.writeFakePrograms(binPath)
+    fakebin.writeMountInfo(binPath, mountPath)
+    os.environ.update(fakebin.getEnvironment(binPath, args.latency))
+
+    # Have transfat read the fake mount table, both here and when it's
+    # run in a fresh interpreter
+    mounts.MOUNTINFO_PATH = fakebin.getMountInfoPath(binPath)
+    launcherPath = fakebin.writeLauncher(
+        binPath, os.path.dirname(RUN_PATH)
+    )
+    os.environ["XDG_CACHE_HOME"] = os.path.join(workPath, "cache")
+
+    configsettings = getConfigSettings(args.jobs, configPath)
+
+    # The stand-in FFmpeg writes the same output whatever the encoder
+    # profile, so encoding is only worth timing with the real one
+    scenarios = set(args.scenarios)
+
+    if not args.real_ffmpeg:
+        scenarios.discard("encode")
+
+    timer = Timer(scenarios, args.verbose, args.latency)
+
+    try:
+        runStartup(timer)
+
+        for size in args.sizes:
+            sourcePath = os.path.join(workPath, "library-%d" % size)
+
+            if args.verbose:
+                print("Generating %d files" % size, file=sys.stderr)
+
+            library.generateLibrary(sourcePath, size, args.file_size)
+
+            runFirstFile(
+                timer, size, sourcePath, mountPath, configPath, launcherPath
+            )
+            runTransfer(
+                timer, size, sourcePath, mountPath, configsettings, args
+            )
+            runPipeline(
+                timer, size, sourcePath, mountPath, configsettings, args
+            )
+            runEncode(timer, size, workPath, configsettings, args)
+            runSort(timer, size, workPath)
+            runCommandLine(
+                timer, size, sourcePath, mountPath, configPath, launcherPath
+            )
+
+            # Start afresh for the next size
+            shutil.rmtree(sourcePath)
+            shutil.rmtree(mountPath, ignore_errors=True)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workPath, ignore_errors=True)
+
+    json.dump(
+        {
+            "transfat": VERSION,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "jobs": args.jobs,
+            "latency": args.latency,
+            "realFfmpeg": args.real_ffmpeg,
+            "results": timer.results,
+        },
+        sys.stdout,
+        indent=2,
+    )
+    print()
+
+    # Fail if we're asked to keep to the budgets and didn't
+    if args.check_budgets and timer.getOverBudget():
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_()
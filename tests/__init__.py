@@ -0,0 +1,6 @@
+"""Tests for transfat.
+
+Run them from the root of the repository like so:
+
+    $ python3 -m unittest
+"""
@@ -0,0 +1,277 @@
+"""Tests for the in-process copy engine and its overwrite modes."""
+
+import configparser
+import errno
+import os
+import tempfile
+import unittest
+from unittest import mock
+from transfat import copyengine
+from transfat import transfer
+from transfat.config.constants import NO, YES, PROMPT
+
+# Number of bytes to move per system call, small enough that every
+# mechanism has to loop
+BUFFER_SIZE = 4096
+
+# Contents of the file to copy, spanning several buffers and ending
+# partway through one
+CONTENTS = bytes(range(256)) * 100
+
+# Contents of a destination file which is already there
+OLD_CONTENTS = b"already here"
+
+
+def raiseUnsupported(*args):
+    """Raise the error a kernel gives for an unsupported mechanism."""
+    raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+
+
+def getPartialCopyFileRange():
+    """Return a copy_file_range which gives up after its first call."""
+    calls = []
+
+    def copyFileRange(sourceFd, destinationFd, count):
+        """Copy one chunk, then claim not to be supported."""
+        calls.append(count)
+
+        if len(calls) > 1:
+            raiseUnsupported()
+
+        return os.copy_file_range(sourceFd, destinationFd, count)
+
+    return copyFileRange
+
+
+def getCopySettings(overwritesetting):
+    """Return config settings for copying natively."""
+    parser = configparser.ConfigParser()
+    parser["test"] = {
+        "CopyBackend": "native",
+        "CopyBufferSize": "4",
+        "OverwriteDestinationFiles": str(overwritesetting),
+    }
+
+    return parser["test"]
+
+
+def readFile(path):
+    """Return the contents of a file as a bytes object."""
+    with open(path, "rb") as file_:
+        return file_.read()
+
+
+def writeFile(path, contents):
+    """Write a bytes object to a file."""
+    with open(path, "wb") as file_:
+        file_.write(contents)
+
+
+class CopyFileTestCase(unittest.TestCase):
+    """Tests each mechanism of the copy engine's fallback chain."""
+
+    def setUp(self):
+        """Write a file to copy."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.directory.name, "source.mp3")
+        self.destination = os.path.join(
+            self.directory.name, "destination.mp3"
+        )
+
+        writeFile(self.source, CONTENTS)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def copy(self):
+        """Copy the source file and check the copy is whole."""
+        copied = copyengine.copyFile(
+            self.source, self.destination, BUFFER_SIZE
+        )
+
+        self.assertEqual(copied, len(CONTENTS))
+        self.assertEqual(readFile(self.destination), CONTENTS)
+
+    def testFallbacks(self):
+        """Each mechanism copies the whole file by itself."""
+        cases = (
+            ("copy_file_range", {"sendfile": raiseUnsupported}, False),
+            ("sendfile", {"copy_file_range": raiseUnsupported}, False),
+            (
+                "buffer",
+                {
+                    "copy_file_range": raiseUnsupported,
+                    "sendfile": raiseUnsupported,
+                },
+                True,
+            ),
+        )
+
+        for name, replacements, buffered in cases:
+            with self.subTest(name=name):
+                with mock.patch.multiple(
+                    copyengine.os, **replacements
+                ), mock.patch.object(
+                    copyengine,
+                    "copyWithBuffer",
+                    wraps=copyengine.copyWithBuffer,
+                ) as copyWithBuffer:
+                    self.copy()
+
+                self.assertEqual(copyWithBuffer.called, buffered)
+
+    def testMissingMechanisms(self):
+        """Kernels without the zero-copy system calls copy anyway."""
+        functions = {
+            name: getattr(os, name)
+            for name in ("copy_file_range", "sendfile")
+            if hasattr(os, name)
+        }
+
+        # Take away the system calls, putting them back afterwards
+        for name in functions:
+            delattr(os, name)
+
+        try:
+            self.copy()
+        finally:
+            for name, function in functions.items():
+                setattr(os, name, function)
+
+    def testFallbackPicksUpWhereItLeftOff(self):
+        """A mechanism giving up partway doesn't copy anything twice."""
+        copyFileRange = getPartialCopyFileRange()
+
+        with mock.patch.object(
+            copyengine.os, "copy_file_range", copyFileRange
+        ):
+            self.copy()
+
+        with mock.patch.multiple(
+            copyengine.os,
+            copy_file_range=getPartialCopyFileRange(),
+            sendfile=raiseUnsupported,
+        ):
+            self.copy()
+
+    def testFalseEndOfFile(self):
+        """Reaching the end before copying anything isn't trusted."""
+        with mock.patch.object(
+            copyengine.os, "copy_file_range", return_value=0
+        ):
+            self.copy()
+
+    def testFailureRemovesDestination(self):
+        """A failing copy raises and leaves no partial file."""
+
+        def failingSendfile(*args):
+            """Fail as if the device went away."""
+            raise OSError(errno.EIO, os.strerror(errno.EIO))
+
+        with mock.patch.multiple(
+            copyengine.os,
+            copy_file_range=raiseUnsupported,
+            sendfile=failingSendfile,
+        ):
+            with self.assertRaises(OSError):
+                copyengine.copyFile(
+                    self.source, self.destination, BUFFER_SIZE
+                )
+
+        self.assertFalse(os.path.lexists(self.destination))
+
+    def testTruncatesDestination(self):
+        """Copying over a longer file leaves nothing of it behind."""
+        writeFile(self.destination, CONTENTS * 2)
+
+        self.copy()
+
+
+class OverwriteTestCase(unittest.TestCase):
+    """Tests the overwrite modes of copying to a destination."""
+
+    def setUp(self):
+        """Write a file to copy and a destination file in the way."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.directory.name, "source.mp3")
+        self.destination = os.path.join(
+            self.directory.name, "destination.mp3"
+        )
+        self.newDestination = os.path.join(self.directory.name, "new.mp3")
+
+        writeFile(self.source, CONTENTS)
+        writeFile(self.destination, OLD_CONTENTS)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def testMayWriteDestination(self):
+        """Existing files are only written if the setting allows it."""
+        cases = (
+            (NO, None, False),
+            (YES, None, True),
+            (PROMPT, False, False),
+            (PROMPT, True, True),
+        )
+
+        for overwritesetting, answer, expected in cases:
+            with self.subTest(overwritesetting=overwritesetting):
+                with mock.patch.object(
+                    transfer.talk, "prompt", return_value=answer
+                ) as prompt:
+                    self.assertEqual(
+                        transfer.mayWriteDestination(
+                            self.destination, overwritesetting
+                        ),
+                        expected,
+                    )
+                    self.assertTrue(
+                        transfer.mayWriteDestination(
+                            self.newDestination, overwritesetting
+                        )
+                    )
+
+                # Only existing files are asked about
+                self.assertEqual(
+                    prompt.call_count, int(overwritesetting == PROMPT)
+                )
+
+    def testCopyFunction(self):
+        """Copying keeps or replaces existing files as configured."""
+        cases = (
+            (NO, False, None, OLD_CONTENTS),
+            (YES, False, None, CONTENTS),
+            (PROMPT, False, False, OLD_CONTENTS),
+            (PROMPT, False, True, CONTENTS),
+            (PROMPT, True, True, OLD_CONTENTS),
+        )
+
+        for overwritesetting, noninteractive, answer, expected in cases:
+            with self.subTest(
+                overwritesetting=overwritesetting,
+                noninteractive=noninteractive,
+                answer=answer,
+            ):
+                writeFile(self.destination, OLD_CONTENTS)
+
+                copyFunction = transfer.getCopyFunction(
+                    getCopySettings(overwritesetting), noninteractive
+                )
+
+                with mock.patch.object(
+                    transfer.talk, "prompt", return_value=answer
+                ) as prompt:
+                    # Not overwriting a file doesn't count as failing
+                    self.assertTrue(
+                        copyFunction(self.source, self.destination)
+                    )
+
+                self.assertEqual(readFile(self.destination), expected)
+                self.assertEqual(
+                    prompt.called,
+                    overwritesetting == PROMPT and not noninteractive,
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
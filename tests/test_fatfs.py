@@ -0,0 +1,290 @@
+"""Tests for the built-in FAT directory sorter."""
+
+import os
+import tempfile
+import unittest
+from benchmarks import fatimage
+from transfat import fatfs
+
+# FAT types to build images of
+FAT_TYPES = (12, 16, 32)
+
+# Number of files in each album, enough to span several clusters
+TRACK_COUNT = 40
+
+
+def getFile(name, shortName, caseFlags=0):
+    """Return the slots of a file, with a long name if it needs one."""
+    shortEntry = fatimage.getShortEntry(shortName, 0, caseFlags=caseFlags)
+
+    if name is None:
+        return shortEntry
+
+    return fatimage.getLongEntries(name, shortEntry)
+
+
+def getAlbum(albumIndex):
+    """Return the items of an album, with deleted files between tracks."""
+    items = []
+
+    for index in reversed(range(1, TRACK_COUNT + 1)):
+        items.append(
+            getFile(
+                "%d Track from album %d.mp3" % (index, albumIndex),
+                b"T%03d%04dMP3" % (albumIndex, index),
+            )
+        )
+
+        if index % 7 == 0:
+            items.append(
+                fatimage.getDeletedEntries(
+                    getFile("Deleted %d.mp3" % index, b"DEL%05dMP3" % index)
+                )
+            )
+
+    return items
+
+
+def getRoot():
+    """Return the items of a root directory in no particular order."""
+    return [
+        ("Album 10", b"ALBUM10    ", getAlbum(10)),
+        getFile("Zebra.mp3", b"ZEBRA   MP3"),
+        fatimage.getDeletedEntries(getFile("Gone.mp3", b"GONE    MP3")),
+        (
+            "Album 2",
+            b"ALBUM2     ",
+            [
+                ("Disc 2", b"DISC2      ", getAlbum(22)),
+                getFile(None, b"COVER   JPG", fatfs.LOWERCASE_BASE),
+                ("Disc 1", b"DISC1      ", getAlbum(21)),
+            ],
+        ),
+        fatimage.getShortEntry(
+            b"MY MUSIC   ", fatfs.ATTRIBUTE_VOLUME_LABEL
+        ),
+        getFile("Été en musique.mp3", b"ETEENM~1MP3"),
+        ("Album 1", b"ALBUM1     ", getAlbum(1)),
+        getFile(None, b"README  TXT"),
+    ]
+
+
+def readImage(path):
+    """Return the contents of an image file as a bytes object."""
+    with open(path, "rb") as image:
+        return image.read()
+
+
+def readDirectories(path):
+    """Return the entries of every directory in an image.
+
+    Returns:
+        A dictionary mapping each directory's first cluster to a list
+        of its 'fatfs.DirectoryEntry's.
+    """
+    with fatfs.FatVolume(path) as volume:
+        return {
+            cluster: volume.readDirectory(cluster)
+            for cluster in volume.getAllDirectories()
+        }
+
+
+def getDirectoryRegions(path):
+    """Return the regions of an image holding its directories."""
+    with fatfs.FatVolume(path) as volume:
+        return [
+            region
+            for cluster in volume.getAllDirectories()
+            for region in volume.getDirectoryRegions(cluster)
+        ]
+
+
+def maskRegions(data, regions):
+    """Return a copy of some data with some regions zeroed."""
+    masked = bytearray(data)
+
+    for offset, length in regions:
+        masked[offset : offset + length] = bytes(length)
+
+    return bytes(masked)
+
+
+class SortDeviceTestCase(unittest.TestCase):
+    """Tests sorting FAT12, FAT16, and FAT32 images."""
+
+    def setUp(self):
+        """Build an unsorted image of each FAT type."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.imagePaths = {}
+
+        for fatType in FAT_TYPES:
+            imagePath = os.path.join(
+                self.directory.name, "fat%d.img" % fatType
+            )
+            fatimage.buildVolume(imagePath, fatType, getRoot())
+            self.imagePaths[fatType] = imagePath
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def testImagesAreWhatTheySeem(self):
+        """The images are of the right type and need sorting."""
+        for fatType, imagePath in self.imagePaths.items():
+            with self.subTest(fatType=fatType):
+                with fatfs.FatVolume(imagePath) as volume:
+                    self.assertEqual(volume.fatType, fatType)
+                    self.assertEqual(
+                        volume.rootRegion is None, fatType == 32
+                    )
+
+                    # Albums span several clusters
+                    album = volume.findDirectory("Album 2/Disc 1")
+                    self.assertGreater(
+                        len(volume.getDirectoryRegions(album)), 1
+                    )
+
+                self.assertEqual(
+                    fatfs.countUnsortedDirectories(imagePath), 6
+                )
+
+    def testSortKeepsEntryBytes(self):
+        """Sorting only moves entries, long names and all."""
+        for fatType, imagePath in self.imagePaths.items():
+            with self.subTest(fatType=fatType):
+                before = readDirectories(imagePath)
+                fatfs.sortDevice(imagePath)
+                after = readDirectories(imagePath)
+
+                self.assertEqual(before.keys(), after.keys())
+
+                for cluster, entries in before.items():
+                    self.assertEqual(
+                        [entry.slots for entry in after[cluster]],
+                        [
+                            entry.slots
+                            for entry in fatfs.sortEntries(entries)
+                        ],
+                    )
+
+    def testSortOrder(self):
+        """Dot entries and the label come first, then directories."""
+        for fatType, imagePath in self.imagePaths.items():
+            with self.subTest(fatType=fatType):
+                fatfs.sortDevice(imagePath)
+
+                with fatfs.FatVolume(imagePath) as volume:
+                    rootNames = [
+                        entry.name for entry in volume.readDirectory(0)
+                    ]
+                    albumNames = [
+                        entry.name
+                        for entry in volume.readDirectory(
+                            volume.findDirectory("Album 2")
+                        )
+                    ]
+                    trackNames = [
+                        entry.name
+                        for entry in volume.readDirectory(
+                            volume.findDirectory("Album 1")
+                        )
+                    ]
+
+                self.assertEqual(
+                    rootNames,
+                    [
+                        "MY MUSIC",
+                        "Album 1",
+                        "Album 2",
+                        "Album 10",
+                        "README.TXT",
+                        "Zebra.mp3",
+                        "Été en musique.mp3",
+                    ],
+                )
+                self.assertEqual(
+                    albumNames, [".", "..", "Disc 1", "Disc 2", "cover.JPG"]
+                )
+                self.assertEqual(
+                    trackNames,
+                    [".", ".."]
+                    + [
+                        "%d Track from album 1.mp3" % index
+                        for index in range(1, TRACK_COUNT + 1)
+                    ],
+                )
+
+    def testSortDropsDeletedEntries(self):
+        """Deleted entries are dropped and the free space moves last."""
+        for fatType, imagePath in self.imagePaths.items():
+            with self.subTest(fatType=fatType):
+                fatfs.sortDevice(imagePath)
+
+                with fatfs.FatVolume(imagePath) as volume:
+                    for cluster in volume.getAllDirectories():
+                        data = volume.getDirectoryData(cluster)
+                        used = len(
+                            b"".join(
+                                entry.slots
+                                for entry in volume.readDirectory(cluster)
+                            )
+                        )
+
+                        self.assertNotIn(
+                            fatfs.DELETED_MARKER,
+                            data[:used:fatfs.ENTRY_SIZE],
+                        )
+                        self.assertEqual(
+                            data[used:], bytes(len(data) - used)
+                        )
+
+    def testSortOnlyWritesDirectories(self):
+        """Nothing outside directories changes, the FAT included."""
+        for fatType, imagePath in self.imagePaths.items():
+            with self.subTest(fatType=fatType):
+                regions = getDirectoryRegions(imagePath)
+                before = readImage(imagePath)
+                fatfs.sortDevice(imagePath)
+                after = readImage(imagePath)
+
+                self.assertNotEqual(before, after)
+                self.assertEqual(
+                    maskRegions(before, regions), maskRegions(after, regions)
+                )
+
+    def testSortTwiceChangesNothing(self):
+        """Sorting a sorted image leaves it alone."""
+        for fatType, imagePath in self.imagePaths.items():
+            with self.subTest(fatType=fatType):
+                self.assertEqual(fatfs.sortDevice(imagePath), 6)
+
+                sorted_ = readImage(imagePath)
+
+                self.assertEqual(fatfs.sortDevice(imagePath), 0)
+                self.assertEqual(readImage(imagePath), sorted_)
+                self.assertEqual(
+                    fatfs.countUnsortedDirectories(imagePath), 0
+                )
+
+    def testSortPaths(self):
+        """Only the directories asked for are sorted."""
+        for fatType, imagePath in self.imagePaths.items():
+            with self.subTest(fatType=fatType):
+                self.assertEqual(
+                    fatfs.sortDevice(
+                        imagePath, ["album 2/disc 1", "Album 1", "Nowhere"]
+                    ),
+                    2,
+                )
+                self.assertEqual(
+                    fatfs.countUnsortedDirectories(imagePath), 4
+                )
+                self.assertEqual(
+                    fatfs.countUnsortedDirectories(
+                        imagePath, ["Album 2/Disc 1", "Album 1"]
+                    ),
+                    0,
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,242 @@
+"""Tests for reading the mount table."""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+from transfat import mounts
+
+# A mount table, as /proc/self/mountinfo gives it
+MOUNTINFO = b"""\
+22 1 8:2 / / rw,relatime shared:1 - ext4 /dev/sda2 rw,errors=remount-ro
+25 22 0:23 / /proc rw,nosuid,nodev,noexec shared:12 - proc proc rw
+40 22 8:17 / /media/usb rw,nosuid,nodev - vfat /dev/sdb1 rw,fmask=0022,utf8
+41 22 8:33 / /media/My\\040Music rw,noatime - vfat /dev/sdc1 rw,uid=1000
+42 22 8:49 / /media/\\303\\211t\\303\\251 rw shared:30 - msdos /dev/sdd1 rw
+43 40 8:18 / /media/usb/nested rw - ext4 /dev/sdb2 rw
+44 22 0:40 / /media/usb2 rw - tmpfs tmpfs rw
+45 22 8:65 / /media/stacked rw - ext4 /dev/sde1 rw
+46 22 8:81 / /media/stacked rw - vfat /dev/sdf1 rw
+47 22 0:41 / /media/bare rw - fuseblk
+this line is garbage
+48 22 0:42 / /media/short rw shared:31
+49 22 0:43 / /media/nooptions rw - ramfs none
+50 22 8:97 / /media/tab\\011and\\134slash rw - vfat /dev/sdg1 rw
+"""
+
+
+def getMountPoints(mountList):
+    """Return the mount points of a list of 'Mount's."""
+    return [mount.mountPoint for mount in mountList]
+
+
+class ParseMountInfoTestCase(unittest.TestCase):
+    """Tests parsing the mount table."""
+
+    def setUp(self):
+        """Parse the mount table."""
+        self.mounts = {
+            mount.mountPoint: mount
+            for mount in mounts.parseMountInfo(MOUNTINFO)
+        }
+
+    def testUnescape(self):
+        """Octal escapes are decoded, whatever bytes they make up."""
+        cases = (
+            (b"/media/usb", "/media/usb"),
+            (b"/media/My\\040Music", "/media/My Music"),
+            (b"/media/\\303\\211t\\303\\251", "/media/Été"),
+            (b"tab\\011and\\134slash", "tab\tand\\slash"),
+            (b"newline\\012", "newline\n"),
+            (b"not\\08escaped", "not\\08escaped"),
+        )
+
+        for field, expected in cases:
+            with self.subTest(field=field):
+                self.assertEqual(mounts.unescape(field), expected)
+
+    def testMountPoints(self):
+        """Each mount is listed in order, skipping unusable lines."""
+        self.assertEqual(
+            getMountPoints(mounts.parseMountInfo(MOUNTINFO)),
+            [
+                "/",
+                "/proc",
+                "/media/usb",
+                "/media/My Music",
+                "/media/Été",
+                "/media/usb/nested",
+                "/media/usb2",
+                "/media/stacked",
+                "/media/stacked",
+                "/media/nooptions",
+                "/media/tab\tand\\slash",
+            ],
+        )
+
+    def testFields(self):
+        """Devices and filesystem types are read from after the "-"."""
+        cases = (
+            ("/", "/dev/sda2", "ext4", False),
+            ("/media/usb", "/dev/sdb1", "vfat", True),
+            ("/media/My Music", "/dev/sdc1", "vfat", True),
+            ("/media/Été", "/dev/sdd1", "msdos", True),
+            ("/media/usb2", "tmpfs", "tmpfs", False),
+            ("/media/nooptions", "none", "ramfs", False),
+        )
+
+        for mountPoint, device, filesystemType, isFat in cases:
+            with self.subTest(mountPoint=mountPoint):
+                mount = self.mounts[mountPoint]
+
+                self.assertEqual(mount.device, device)
+                self.assertEqual(mount.filesystemType, filesystemType)
+                self.assertEqual(mount.isFat(), isFat)
+
+    def testOptions(self):
+        """Mount point and filesystem options are both kept."""
+        cases = (
+            (
+                "/media/usb",
+                ["rw", "nosuid", "nodev", "rw", "fmask=0022"],
+                {"nosuid": True, "fmask": "0022", "utf8": True},
+            ),
+            (
+                "/media/My Music",
+                ["rw", "noatime", "rw", "uid=1000"],
+                {"noatime": True, "uid": "1000", "gid": None},
+            ),
+            ("/media/nooptions", ["rw"], {"rw": True, "uid": None}),
+        )
+
+        for mountPoint, options, values in cases:
+            with self.subTest(mountPoint=mountPoint):
+                mount = self.mounts[mountPoint]
+
+                self.assertEqual(mount.options[: len(options)], options)
+
+                for name, value in values.items():
+                    self.assertEqual(mount.getOption(name), value)
+
+    def testBlockSize(self):
+        """Block sizes are only looked up once, when first asked for."""
+        root = self.mounts["/"]
+        blockSize = os.statvfs("/").f_bsize
+
+        with tempfile.TemporaryDirectory() as directory:
+            missingPath = os.path.join(directory, "gone")
+
+        missing = mounts.Mount("/dev/sdz1", missingPath, "vfat")
+
+        with mock.patch.object(
+            mounts.os, "statvfs", wraps=os.statvfs
+        ) as statvfs:
+            self.assertIs(root.statBlockSize, mounts.NOT_LOOKED_UP)
+            self.assertEqual(root.blockSize, blockSize)
+            self.assertEqual(root.blockSize, blockSize)
+
+            # Mount points which can't be statted have no block size
+            self.assertIsNone(missing.blockSize)
+
+        self.assertEqual(
+            [call[0] for call in statvfs.call_args_list],
+            [("/",), (missingPath,)],
+        )
+
+
+class FindMountTestCase(unittest.TestCase):
+    """Tests finding which mount paths are on."""
+
+    def setUp(self):
+        """Point the mount table at a file of our own."""
+        self.directory = tempfile.TemporaryDirectory()
+        mountInfoPath = os.path.join(self.directory.name, "mountinfo")
+
+        with open(mountInfoPath, "wb") as mountInfoFile:
+            mountInfoFile.write(MOUNTINFO)
+
+        self.patcher = mock.patch.object(
+            mounts, "MOUNTINFO_PATH", mountInfoPath
+        )
+        self.patcher.start()
+        mounts.getMounts.cache_clear()
+
+    def tearDown(self):
+        self.patcher.stop()
+        mounts.getMounts.cache_clear()
+        self.directory.cleanup()
+
+    def testFindMount(self):
+        """The longest mount point wins, then the last mounted."""
+        cases = (
+            ("/", "/dev/sda2"),
+            ("/home/user/music", "/dev/sda2"),
+            ("/media/usb", "/dev/sdb1"),
+            ("/media/usb/Album/01.mp3", "/dev/sdb1"),
+            ("/media/usb/nested/01.mp3", "/dev/sdb2"),
+            ("/media/usb2/01.mp3", "tmpfs"),
+            ("/media/usb/../usb2/01.mp3", "tmpfs"),
+            ("/media/My Music/Album", "/dev/sdc1"),
+            ("/media/Été/01.mp3", "/dev/sdd1"),
+            ("/media/stacked/01.mp3", "/dev/sdf1"),
+        )
+
+        for path, device in cases:
+            with self.subTest(path=path):
+                self.assertEqual(mounts.findMount(path).device, device)
+
+    def testFindNoMount(self):
+        """Paths outside every mount aren't on anything."""
+        mountList = mounts.parseMountInfo(MOUNTINFO)[2:]
+
+        self.assertIsNone(mounts.findMount("/home/user", mountList))
+        self.assertIsNone(mounts.findMount("/media/usb3", mountList))
+        self.assertIsNone(mounts.findMount("/anything", []))
+
+    def testResolveDestinations(self):
+        """Only destinations on FAT filesystems resolve to a mount."""
+        resolved = mounts.resolveDestinations(
+            [
+                "/media/usb/Music",
+                "/media/usb/nested/Music",
+                "/media/stacked",
+                "/home/user/Music",
+            ]
+        )
+
+        self.assertEqual(
+            {
+                path: mount and mount.device
+                for path, mount in resolved.items()
+            },
+            {
+                "/media/usb/Music": "/dev/sdb1",
+                "/media/usb/nested/Music": None,
+                "/media/stacked": "/dev/sdf1",
+                "/home/user/Music": None,
+            },
+        )
+        self.assertEqual(
+            getMountPoints(mounts.getFatMounts()),
+            [
+                "/media/usb",
+                "/media/My Music",
+                "/media/Été",
+                "/media/stacked",
+                "/media/tab\tand\\slash",
+            ],
+        )
+
+    def testUnreadableMountTable(self):
+        """A missing mount table means nothing's mounted."""
+        with mock.patch.object(
+            mounts, "MOUNTINFO_PATH", os.path.join(self.directory.name, "no")
+        ):
+            mounts.getMounts.cache_clear()
+
+            self.assertEqual(mounts.getMounts(), ())
+            self.assertIsNone(mounts.findMount("/media/usb"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,311 @@
+"""Tests for the pipeline which copies files while converting others."""
+
+import configparser
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from benchmarks import fakebin
+from transfat import mounts
+from transfat import plan
+from transfat import transfer
+
+# Path of the config file the tests base their settings on
+CONFIG_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "transfat",
+    "config",
+    "config.ini",
+)
+
+# Names of the audio files in the library, all of which get converted
+TRACK_NAMES = ["0%d Track.flac" % index for index in range(1, 7)]
+
+# Name of a file in the library which isn't converted
+COVER_NAME = "cover.jpg"
+
+# Seconds to wait for a transfer which should finish straight away
+TIMEOUT = 30
+
+
+def getConfigSettings(**overrides):
+    """Return config settings for converting while copying."""
+    parser = configparser.ConfigParser()
+    parser.optionxform = str
+    parser.read(CONFIG_PATH)
+    parser["test"] = {
+        "ConvertFLACtoMP3": "1",
+        "OverwriteDestinationFiles": "1",
+        "CopyWhileConverting": "1",
+        "ConvertDirectlyToDestination": "0",
+        "UseTranscodeCache": "0",
+    }
+
+    for key, value in overrides.items():
+        parser["test"][key] = value
+
+    return parser["test"]
+
+
+def readFile(path):
+    """Return the contents of a file as a bytes object."""
+    with open(path, "rb") as file_:
+        return file_.read()
+
+
+def writeFile(path, contents):
+    """Write a bytes object to a file."""
+    with open(path, "wb") as file_:
+        file_.write(contents)
+
+
+def listFiles(directory):
+    """Return a sorted list of the files in a directory."""
+    return sorted(
+        name
+        for name in os.listdir(directory)
+        if os.path.isfile(os.path.join(directory, name))
+    )
+
+
+class TransferFilesTestCase(unittest.TestCase):
+    """Tests converting and copying files as a pipeline."""
+
+    def setUp(self):
+        """Write a library, a device, and stand-ins for FFmpeg."""
+        self.directory = tempfile.TemporaryDirectory()
+        binPath = os.path.join(self.directory.name, "bin")
+        self.albumPath = os.path.join(self.directory.name, "Album")
+        self.mountPath = os.path.join(self.directory.name, "mount")
+
+        os.makedirs(self.albumPath)
+        os.makedirs(self.mountPath)
+
+        # Give every file different contents, so a mix-up shows
+        for name in TRACK_NAMES + [COVER_NAME]:
+            writeFile(os.path.join(self.albumPath, name), name.encode())
+
+        # Run the stand-ins, and have the device look like a FAT one
+        fakebin.writeFakePrograms(binPath)
+        fakebin.writeMountInfo(binPath, self.mountPath)
+
+        patchers = [
+            mock.patch.dict(os.environ, fakebin.getEnvironment(binPath)),
+            mock.patch.object(
+                mounts, "MOUNTINFO_PATH", fakebin.getMountInfoPath(binPath)
+            ),
+        ]
+
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        mounts.getMounts.cache_clear()
+        self.addCleanup(mounts.getMounts.cache_clear)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def getRecords(self):
+        """Return records for the library, creating its directories."""
+        transferPlan = plan.getTransferPlan([self.albumPath], self.mountPath)
+
+        transfer.createDirectories(
+            [record.destination for record in transferPlan.directories],
+            True,
+            False,
+            True,
+        )
+
+        return transferPlan.files
+
+    def transfer(self, records, configsettings, jobs=2):
+        """Transfer files, failing if the pipeline doesn't finish."""
+        result = []
+
+        def run():
+            """Run the pipeline, keeping what it returns or raises."""
+            try:
+                result.append(
+                    transfer.transferFiles(
+                        records, configsettings, True, False, True, jobs
+                    )
+                )
+            except Exception as error:
+                result.append(error)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(TIMEOUT)
+
+        self.assertFalse(thread.is_alive(), "the transfer never finished")
+
+        return result[0]
+
+    def getDestination(self, name):
+        """Return the path a file in the library is transferred to."""
+        return os.path.join(self.mountPath, "Album", name)
+
+    def testTransfer(self):
+        """Files are converted, copied, and cleaned up after."""
+        for direct in ("0", "1"):
+            with self.subTest(direct=direct):
+                records = self.getRecords()
+                transferred = self.transfer(
+                    records,
+                    getConfigSettings(ConvertDirectlyToDestination=direct),
+                )
+
+                self.assertEqual(
+                    sorted(record.finalDestination for record in transferred),
+                    sorted(
+                        self.getDestination(name)
+                        for name in [COVER_NAME]
+                        + [name[:-5] + ".mp3" for name in TRACK_NAMES]
+                    ),
+                )
+
+                for name in TRACK_NAMES:
+                    self.assertEqual(
+                        readFile(self.getDestination(name[:-5] + ".mp3")),
+                        name.encode(),
+                    )
+
+                # Nothing's left beside the sources
+                self.assertEqual(
+                    listFiles(self.albumPath),
+                    sorted(TRACK_NAMES + [COVER_NAME]),
+                )
+
+    def testFailedConversionCopiesOriginal(self):
+        """A file which fails to convert is copied as it is instead."""
+        records = self.getRecords()
+
+        # The stand-in FFmpeg won't overwrite a file in its way
+        blockingPath = os.path.join(self.albumPath, "03 Track.mp3")
+        writeFile(blockingPath, b"in the way")
+
+        transferred = self.transfer(records, getConfigSettings())
+
+        self.assertIn(
+            self.getDestination("03 Track.flac"),
+            [record.finalDestination for record in transferred],
+        )
+        self.assertEqual(
+            listFiles(os.path.join(self.mountPath, "Album")),
+            sorted(
+                [COVER_NAME, "03 Track.flac"]
+                + [
+                    name[:-5] + ".mp3"
+                    for name in TRACK_NAMES
+                    if name != "03 Track.flac"
+                ]
+            ),
+        )
+        self.assertEqual(
+            readFile(self.getDestination("03 Track.flac")),
+            b"03 Track.flac",
+        )
+
+        # The file in the way isn't ours to remove
+        self.assertEqual(readFile(blockingPath), b"in the way")
+
+    def testFailedCopierStopsConversions(self):
+        """Conversions waiting for room fail when copying stops."""
+        records = self.getRecords()
+
+        with mock.patch.object(
+            transfer.copyengine,
+            "copyFile",
+            side_effect=RuntimeError("device gone"),
+        ):
+            error = self.transfer(records, getConfigSettings(), 1)
+
+        self.assertIsInstance(error, RuntimeError)
+        self.assertEqual(str(error), "device gone")
+
+    def testInterruptedTransferCopiesNothing(self):
+        """Once interrupted, queued files are dropped, not copied."""
+        records = self.getRecords()
+
+        with mock.patch.object(
+            transfer.commands, "isCancelled", return_value=True
+        ):
+            self.transfer(records, getConfigSettings())
+
+        self.assertEqual(
+            listFiles(os.path.join(self.mountPath, "Album")), []
+        )
+
+        # Temporary conversions are still removed
+        self.assertEqual(
+            listFiles(self.albumPath), sorted(TRACK_NAMES + [COVER_NAME])
+        )
+
+
+class CopyQueueTestCase(unittest.TestCase):
+    """Tests the queue of files waiting to be copied."""
+
+    def testConvertedFilesFirst(self):
+        """Converted files are handed out before the others."""
+        queue = transfer.CopyQueue(2)
+
+        queue.put("plain")
+        queue.put("converted", True)
+        queue.close()
+
+        self.assertEqual(
+            [queue.get(), queue.get(), queue.get()],
+            ["converted", "plain", None],
+        )
+
+    def testClose(self):
+        """Closing lets waiting getters finish and refuses new items."""
+        queue = transfer.CopyQueue(1)
+        items = []
+
+        getter = threading.Thread(target=lambda: items.append(queue.get()))
+        getter.start()
+        queue.close()
+        getter.join(TIMEOUT)
+
+        self.assertEqual(items, [None])
+
+        with self.assertRaises(RuntimeError):
+            queue.put("too late")
+
+    def testAbort(self):
+        """Aborting wakes waiting putters and getters with the error."""
+        queue = transfer.CopyQueue(1)
+        error = ValueError("copier failed")
+        errors = []
+
+        queue.put("converted", True)
+
+        def put():
+            """Wait for room in the full queue."""
+            try:
+                queue.put("waiting", True)
+            except ValueError as putError:
+                errors.append(putError)
+
+        putter = threading.Thread(target=put)
+        putter.start()
+        queue.abort(error)
+        putter.join(TIMEOUT)
+
+        self.assertEqual(errors, [error])
+
+        with self.assertRaises(ValueError):
+            queue.get()
+
+        # The first error sticks
+        queue.abort(OSError())
+
+        with self.assertRaises(ValueError):
+            queue.put("plain")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,239 @@
+"""Contains functions for caching converted audio files between runs.
+
+Converted files are stored in a cache directory under a name derived
+from a hash of the source file's contents, the encoder arguments used,
+and the version of FFmpeg doing the encoding. Entries are evicted least
+recently used first; using an entry bumps its modification time.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+from . import system
+from . import talk
+
+# Size of the chunks read when hashing source files
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Number of bytes in a mebibyte; cache sizes in the config are in MiB
+MIB = 1024 * 1024
+
+
+def getFfmpegVersion():
+    """Return a string containing FFmpeg's version line.
+
+    Returns an empty string if FFmpeg can't be run.
+    """
+    return system.getFfmpegCapabilities()[0]
+
+
+def getCacheKey(sourcePath, encoderArguments):
+    """Return a key identifying a conversion, and the source's hash.
+
+    The source file's hash is worked out from the same read as the key,
+    so whoever needs it (like the manifest) doesn't have to read the
+    file again.
+
+    Args:
+        sourcePath: A string containing the path of the file to be
+            converted.
+        encoderArguments: A list of strings containing the FFmpeg
+            arguments which determine the output (codec, quality, and so
+            on).
+
+    Returns:
+        A 2-tuple of ("key", "sourceHash") containing hexadecimal
+        digests of the conversion and of the source file alone, as
+        hashFile returns.
+
+    Raises:
+        OSError: The source file couldn't be read.
+    """
+    digest = hashlib.sha256()
+    sourceDigest = hashlib.sha256()
+
+    # Hash the encoder settings first, then the file contents
+    digest.update(getFfmpegVersion().encode("utf-8"))
+    digest.update(b"\0")
+    digest.update("\0".join(encoderArguments).encode("utf-8"))
+    digest.update(b"\0")
+
+    key = hashFile(sourcePath, digest, [sourceDigest])
+
+    return (key, sourceDigest.hexdigest())
+
+
+def hashFile(path, digest=None, otherDigests=()):
+    """Return a string containing a hexadecimal digest of a file.
+
+    Args:
+        path: A string containing the path of the file to hash.
+        digest: An optional hashlib hash object to add the file's
+            contents to. Defaults to a new SHA-256 hash.
+        otherDigests: An optional list of more hashlib hash objects to
+            add the file's contents to while it's being read.
+
+    Returns:
+        A string containing a hexadecimal digest.
+
+    Raises:
+        OSError: The file couldn't be read.
+    """
+    if digest is None:
+        digest = hashlib.sha256()
+
+    with open(path, "rb") as file_:
+        for chunk in iter(lambda: file_.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+
+            for otherDigest in otherDigests:
+                otherDigest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def getEntryPath(cacheDirectory, key, extension=".mp3"):
+    """Return the path of the cache entry for a key."""
+    return os.path.join(cacheDirectory, key[:2], key + extension)
+
+
+def lookup(entryPath):
+    """Return whether a cache entry exists, marking it as used if so."""
+    try:
+        os.utime(entryPath)
+    except OSError:
+        return False
+
+    return True
+
+
+def getStagingPath(entryPath):
+    """Return a path to write a cache entry to before it's complete.
+
+    Creates the entry's parent directory if necessary, and an empty
+    staging file with a name no other conversion (in this process or
+    any other) is using. Once the staging file is complete, it should
+    be moved into place with os.replace.
+
+    Raises:
+        OSError: The staging file couldn't be created.
+    """
+    directory, name = os.path.split(entryPath)
+
+    os.makedirs(directory, exist_ok=True)
+
+    fileDescriptor, stagingPath = tempfile.mkstemp(
+        suffix=".part", prefix=name + ".", dir=directory
+    )
+    os.close(fileDescriptor)
+
+    return stagingPath
+
+
+def store(path, entryPath):
+    """Store a copy of a converted file as a cache entry.
+
+    The cache is only an optimization, so failing to store the entry
+    isn't an error.
+
+    Args:
+        path: A string containing the path of the converted file.
+        entryPath: A string containing the path of the cache entry.
+
+    Returns:
+        A boolean signalling whether the entry was stored.
+    """
+    try:
+        stagingPath = getStagingPath(entryPath)
+    except OSError:
+        return False
+
+    try:
+        shutil.copyfile(path, stagingPath)
+        os.replace(stagingPath, entryPath)
+    except OSError:
+        try:
+            os.remove(stagingPath)
+        except OSError:
+            pass
+
+        return False
+
+    return True
+
+
+def getEntries(cacheDirectory):
+    """Return a list of cache entries, least recently used first.
+
+    Args:
+        cacheDirectory: A string containing the path to the cache
+            directory.
+
+    Returns:
+        A list of 3-tuples of (mtime, size, "path") for each complete
+        entry in the cache.
+    """
+    entries = []
+
+    for root, _, files in os.walk(cacheDirectory):
+        for file_ in files:
+            # Skip entries which are still being written
+            if file_.endswith(".part"):
+                continue
+
+            path = os.path.join(root, file_)
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            entries += [(stat.st_mtime, stat.st_size, path)]
+
+    entries.sort()
+
+    return entries
+
+
+def getStats(cacheDirectory):
+    """Return a 2-tuple of (number of entries, total bytes) in a cache."""
+    entries = getEntries(cacheDirectory)
+
+    return (len(entries), sum(size for _, size, _ in entries))
+
+
+def prune(cacheDirectory, maxBytes, quiet=False):
+    """Evict least recently used cache entries until under a size cap.
+
+    Args:
+        cacheDirectory: A string containing the path to the cache
+            directory.
+        maxBytes: An integer containing the maximum number of bytes the
+            cache may take up.
+        quiet: An optional boolean toggling whether to omit error
+            output.
+
+    Returns:
+        A 2-tuple of (number of entries removed, bytes removed).
+    """
+    entries = getEntries(cacheDirectory)
+    totalBytes = sum(size for _, size, _ in entries)
+
+    removedCount = 0
+    removedBytes = 0
+
+    for _, size, path in entries:
+        if totalBytes - removedBytes <= maxBytes:
+            break
+
+        try:
+            os.remove(path)
+        except OSError:
+            talk.error("Failed to remove %s!" % path, quiet)
+            continue
+
+        removedCount += 1
+        removedBytes += size
+
+    return (removedCount, removedBytes)
@@ -0,0 +1,311 @@
+"""Contains functions for estimating whether a transfer fits on a device.
+
+Estimates are made before anything expensive happens. Files which are
+converted are estimated from their duration and cover art (as reported
+by ffprobe) and the bitrate of the encoder profile; everything else
+takes up its real size.
+Every file and every new directory takes up a whole number of clusters
+on a FAT filesystem, so sizes are rounded up to the cluster size.
+"""
+
+import os
+from . import probe
+from . import talk
+from .config.constants import NO, PROMPT
+
+# Bitrate to estimate converted files with if we're not told otherwise:
+# the upper end of the average bitrate of LAME's highest VBR quality, in
+# bits per second
+ESTIMATED_BITRATE = 260000
+
+# Bytes allowed for tags copied into each converted file, on top of its
+# cover art
+TAG_ALLOWANCE = 64 * 1024
+
+# Number of bytes in a mebibyte, for reporting
+MIB = 1024 * 1024
+
+
+def getFreeSpace(mountLocation):
+    """Return the free space on a device.
+
+    Args:
+        mountLocation: A string containing the mount location of the
+            device.
+
+    Returns:
+        A 2-tuple containing integers for (free bytes, cluster size).
+        On FAT filesystems the fundamental block size statvfs reports is
+        the cluster size.
+    """
+    stat = os.statvfs(mountLocation)
+
+    return (stat.f_bavail * stat.f_frsize, stat.f_frsize)
+
+
+def roundUpToCluster(size, clusterSize):
+    """Return the number of bytes a file of some size takes up."""
+    return -(-size // clusterSize) * clusterSize
+
+
+def getOccupiedSize(path, clusterSize):
+    """Return the bytes an existing file takes up, or 0 if it's absent."""
+    try:
+        return roundUpToCluster(os.stat(path).st_size, clusterSize)
+    except OSError:
+        return 0
+
+
+def estimateFileSizes(
+    plan,
+    conversionOptions,
+    clusterSize,
+    jobs=1,
+    probeDatabase=None,
+    bitrate=ESTIMATED_BITRATE,
+    overwritesetting=PROMPT,
+):
+    """Estimate the bytes each file in a transfer plan takes up.
+
+    Converted files go to their .mp3 destination, and copied files go
+    to their destination. If a file's already there, the space it takes
+    up is only credited back if it's going to be overwritten; if it's
+    going to be kept, nothing is written. Files we'd prompt to overwrite
+    might be kept, so nothing is credited back for them.
+
+    Args:
+        plan: A 'plan.TransferPlan' object containing the files to
+            transfer.
+        conversionOptions: A dictionary as returned by
+            'transfer.getConversionOptions'. Files which we'd prompt to
+            convert are estimated at the larger of their converted and
+            real sizes.
+        clusterSize: An integer containing the cluster size of the
+            device.
+        jobs: An optional integer specifying how many files to probe at
+            the same time.
+        probeDatabase: An optional string containing the path of the
+            probe cache's database, to look up and remember what files
+            are like in.
+        bitrate: An optional integer containing about the most bits per
+            second converted files take up, as returned by
+            'encoders.EncoderProfile.getEstimatedBitrate'.
+        overwritesetting: An optional integer (as returned by
+            'transfer.getOverwriteSetting') which is one of YES, NO, or
+            PROMPT, specifying whether existing destination files are
+            overwritten.
+
+    Returns:
+        A list of integers containing the estimated change in bytes used
+        on the device for each file, in the same order as the plan's
+        files.
+    """
+    # Find out how long the files to convert are, and whether they're
+    # MP3s already
+    audioInfo = probe.getAudioInfo(
+        [
+            record.source
+            for record in plan.files
+            if record.suffix in conversionOptions
+        ],
+        jobs,
+        probeDatabase,
+    )
+
+    def getSizeChange(size, destination):
+        """Return the change in bytes used writing a file somewhere."""
+        if not os.path.lexists(destination):
+            # Nothing to overwrite
+            return roundUpToCluster(size, clusterSize)
+
+        if overwritesetting == NO:
+            # The existing file is kept, and ours is never written
+            return 0
+
+        if overwritesetting == PROMPT:
+            # The existing file may be kept as well as ours
+            return roundUpToCluster(size, clusterSize)
+
+        return roundUpToCluster(size, clusterSize) - getOccupiedSize(
+            destination, clusterSize
+        )
+
+    def estimateFileSize(record):
+        """Return the estimated change in bytes used for a file."""
+        try:
+            size = os.stat(record.source).st_size
+        except OSError:
+            # The transfer will fail for this file anyway
+            return 0
+
+        prompt = conversionOptions.get(record.suffix)
+
+        if prompt is None:
+            # Copied as is
+            return getSizeChange(size, record.destination)
+
+        # Converted. Fall back to the real size if we can't tell how
+        # long the file is.
+        info = audioInfo[record.source]
+
+        if (
+            info is None
+            or info.duration is None
+            or probe.canStreamCopy(record.source, info)
+        ):
+            # MP3 audio is copied as is, so takes up about as much
+            # space as it does now
+            estimate = size
+        else:
+            estimate = (
+                int(info.duration * bitrate / 8)
+                + info.artSize
+                + TAG_ALLOWANCE
+            )
+
+            if prompt:
+                # Might not be converted
+                estimate = max(estimate, size)
+
+        destination = (
+            record.destination[: len(record.destination) - len(record.suffix)]
+            + ".mp3"
+        )
+
+        return getSizeChange(estimate, destination)
+
+    return [estimateFileSize(record) for record in plan.files]
+
+
+def getTrimSetting(configsettings, noninteractive=False):
+    """Return whether to trim a transfer which doesn't fit the device.
+
+    Args:
+        configsettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+        noninteractive: An optional boolean signalling to never prompt,
+            and to give up instead.
+
+    Returns:
+        An integer which is one of NO, YES, or PROMPT.
+    """
+    trimSetting = configsettings.getint("TrimToFit", fallback=0)
+
+    if noninteractive and trimSetting == PROMPT:
+        return NO
+
+    return trimSetting
+
+
+def checkFreeSpace(
+    plan,
+    conversionOptions,
+    mountLocation,
+    trimsetting,
+    verbose=False,
+    quiet=False,
+    jobs=1,
+    probeDatabase=None,
+    bitrate=ESTIMATED_BITRATE,
+    overwritesetting=PROMPT,
+):
+    """Make sure a transfer fits on a device before it starts.
+
+    If the transfer doesn't fit, either give up or, if the trim setting
+    allows it, sort the plan and leave out the files at the end which
+    don't fit, along with directories left empty.
+
+    Args:
+        plan: A 'plan.TransferPlan' object containing the files and
+            directories to transfer.
+        conversionOptions: A dictionary as returned by
+            'transfer.getConversionOptions'.
+        mountLocation: A string containing the mount location of the
+            device.
+        trimsetting: An integer (as returned by getTrimSetting)
+            specifying whether to trim the plan to fit (YES), give up
+            (NO), or prompt (PROMPT).
+        verbose: An optional boolean toggling whether to give extra
+            output.
+        quiet: An optional boolean toggling whether to omit error
+            output.
+        jobs: An optional integer specifying how many files to probe at
+            the same time.
+        probeDatabase: An optional string containing the path of the
+            probe cache's database.
+        bitrate: An optional integer containing about the most bits per
+            second converted files take up.
+        overwritesetting: An optional integer which is one of YES, NO,
+            or PROMPT, specifying whether existing destination files
+            are overwritten.
+
+    Returns:
+        A 2-tuple containing a boolean signalling whether the transfer
+        can go ahead, and a list of the 'plan.FileRecord's trimmed from
+        the plan. The work performed on the plan is done in place.
+    """
+    freeBytes, clusterSize = getFreeSpace(mountLocation)
+
+    # Each new directory takes up at least one cluster
+    neededBytes = clusterSize * sum(
+        not os.path.isdir(directory.destination)
+        for directory in plan.directories
+    )
+
+    fileSizes = estimateFileSizes(
+        plan,
+        conversionOptions,
+        clusterSize,
+        jobs,
+        probeDatabase,
+        bitrate,
+        overwritesetting,
+    )
+    neededBytes += sum(fileSizes)
+
+    talk.status(
+        "About %.1f MiB needed, %.1f MiB free"
+        % (neededBytes / MIB, freeBytes / MIB),
+        verbose,
+    )
+
+    if neededBytes <= freeBytes:
+        # Fits
+        return (True, [])
+
+    talk.error(
+        "Transfer needs about %.1f MiB but only %.1f MiB is free!"
+        % (neededBytes / MIB, freeBytes / MIB),
+        quiet,
+    )
+
+    # Determine whether to trim the plan. Note that trimsetting - 1 is
+    # equivalent to a prompt flag, given the config setting constant
+    # definitions.
+    if not trimsetting or (
+        trimsetting - 1 and not talk.prompt("Transfer only what fits?")
+    ):
+        return (False, [])
+
+    # Keep files in natural order until we run out of room, so that the
+    # same files are kept every time
+    keptBytes = neededBytes - sum(fileSizes)
+    fileSizes = dict(zip(plan.files, fileSizes))
+
+    plan.sort()
+
+    for index, record in enumerate(plan.files):
+        if keptBytes + fileSizes[record] > freeBytes:
+            break
+
+        keptBytes += fileSizes[record]
+    else:
+        index = len(plan.files)
+
+    trimmedFiles = plan.trim(index)
+
+    talk.status(
+        "Leaving out %d files which don't fit" % len(trimmedFiles), verbose
+    )
+
+    return (True, trimmedFiles)
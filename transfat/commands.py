@@ -0,0 +1,486 @@
+"""Contains a runner for the external programs transfat uses.
+
+FFmpeg, ffprobe, cp, sudo, umount, and fatsort are all run through one
+asyncio event loop, which runs in a background thread. Any thread can
+run a command through it and wait for the result, so stages running in
+different threads share one set of limits and one place to stop
+everything from. The runner
+
+    - limits how many commands of each group (like "convert") run at
+      once;
+    - captures commands' output into 'CommandResult's, along with how
+      long each command took;
+    - when cancelled, as when the user presses Ctrl-C, stops commands
+      which are still running, removes the partial files they were
+      writing, and refuses to start any more.
+
+asyncio is only imported once a command is run, keeping startup quick.
+"""
+
+import os
+import subprocess
+import sys
+import threading
+import time
+
+# What to do with a command's standard streams: leave them with the
+# user, capture them into the result, or throw them away
+INHERIT = None
+CAPTURE = subprocess.PIPE
+DISCARD = subprocess.DEVNULL
+
+# Number of commands of a group to run at once if there's no limit set
+DEFAULT_LIMIT = os.cpu_count() or 1
+
+# Seconds to give commands to exit once asked to before killing them
+TERMINATE_TIMEOUT = 2
+
+
+class CommandResult:
+    """What happened when a command ran.
+
+    Attributes:
+        command: A list of strings containing the command.
+        group: A string containing the group the command ran in, or
+            None.
+        returnCode: An integer containing the command's exit code
+            (negative if a signal ended it), or None if it never
+            started.
+        stdout: A bytes object containing what the command wrote to
+            stdout, or None if that wasn't captured.
+        stderr: A bytes object containing what the command wrote to
+            stderr, or None if that wasn't captured.
+        seconds: A float containing how long the command ran for.
+        cancelled: A boolean signalling whether the command was stopped
+            (or never started) because the runner was cancelled.
+    """
+
+    __slots__ = (
+        "command",
+        "group",
+        "returnCode",
+        "stdout",
+        "stderr",
+        "seconds",
+        "cancelled",
+    )
+
+    def __init__(
+        self,
+        command,
+        group=None,
+        returnCode=None,
+        stdout=None,
+        stderr=None,
+        seconds=0.0,
+        cancelled=False,
+    ):
+        """Initialize a result."""
+        self.command = command
+        self.group = group
+        self.returnCode = returnCode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.seconds = seconds
+        self.cancelled = cancelled
+
+    def __repr__(self):
+        return "CommandResult(%r, %r, %r)" % (
+            self.command,
+            self.returnCode,
+            self.cancelled,
+        )
+
+    def succeeded(self):
+        """Return whether the command ran and exited successfully."""
+        return self.returnCode == 0 and not self.cancelled
+
+    def getName(self):
+        """Return a string naming the command, for reports.
+
+        This is the command's group if it has one, or else the name of
+        the program run.
+        """
+        return self.group or os.path.basename(self.command[0])
+
+    def getOutput(self):
+        """Return a string containing the captured stdout, if any."""
+        if self.stdout is None:
+            return ""
+
+        return self.stdout.decode("utf-8", "replace")
+
+
+def removeFiles(paths):
+    """Remove files which may or may not exist."""
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class CommandRunner:
+    """Runs commands on an event loop in a background thread.
+
+    Attributes:
+        profiler: A 'profiling.Profiler' object to record each command
+            with, or None.
+        cancelled: A boolean signalling whether we've been cancelled.
+    """
+
+    def __init__(self):
+        """Initialize a runner, leaving its event loop until needed."""
+        self.profiler = None
+        self.cancelled = False
+        self.loop = None
+        self.lock = threading.Lock()
+
+        # Maximum number of commands of each group to run at once, and
+        # the semaphores enforcing them, which belong to the loop
+        self.limits = {}
+        self.semaphores = {}
+
+        # Running processes, mapped to lists of the paths of the files
+        # they're writing
+        self.processes = {}
+
+    def start(self):
+        """Start the event loop if it isn't running already.
+
+        Before Python 3.8, asyncio can only tell when child processes
+        exit if the main thread sets this up, so this should be called
+        from the main thread before any other thread runs commands.
+
+        Returns:
+            The 'asyncio.AbstractEventLoop' commands run on.
+        """
+        with self.lock:
+            if self.loop is not None:
+                return self.loop
+
+            import asyncio
+
+            loop = asyncio.new_event_loop()
+
+            if (
+                sys.version_info < (3, 8)
+                and threading.current_thread() is threading.main_thread()
+            ):
+                asyncio.get_child_watcher().attach_loop(loop)
+
+            def runLoop():
+                """Run the event loop until we exit."""
+                asyncio.set_event_loop(loop)
+                loop.run_forever()
+
+            threading.Thread(
+                target=runLoop, name="commands", daemon=True
+            ).start()
+
+            self.loop = loop
+
+            return loop
+
+    def setLimit(self, group, count):
+        """Set how many commands of a group may run at once.
+
+        The limit applies to commands started from now on.
+
+        Args:
+            group: A string containing the name of the group, like
+                "convert".
+            count: An integer containing the maximum number of commands.
+        """
+        with self.lock:
+            self.limits[group] = max(count, 1)
+            self.semaphores.pop(group, None)
+
+    def getSemaphore(self, group):
+        """Return the semaphore limiting a group, or None for no group.
+
+        This must be called from the event loop.
+        """
+        if group is None:
+            return None
+
+        import asyncio
+
+        with self.lock:
+            if group not in self.semaphores:
+                self.semaphores[group] = asyncio.Semaphore(
+                    self.limits.get(group, DEFAULT_LIMIT)
+                )
+
+            return self.semaphores[group]
+
+    def submit(
+        self,
+        command,
+        group=None,
+        stdin=INHERIT,
+        stdout=INHERIT,
+        stderr=INHERIT,
+        onLine=None,
+        outputs=(),
+    ):
+        """Start running a command without waiting for it.
+
+        Args:
+            command: A list of strings containing the command.
+            group: An optional string containing the name of a group to
+                limit the command with (see setLimit). Commands with no
+                group aren't limited.
+            stdin: An optional INHERIT or DISCARD saying what to do with
+                the command's stdin.
+            stdout: An optional INHERIT, CAPTURE, or DISCARD saying what
+                to do with the command's stdout.
+            stderr: An optional INHERIT, CAPTURE, or DISCARD saying what
+                to do with the command's stderr.
+            onLine: An optional function to call with each line the
+                command writes to stdout, as a string, as it's written.
+                It's called on the event loop's thread, so it mustn't
+                block. stdout is captured to do this, but not kept, and
+                stderr mustn't be captured too.
+            outputs: An optional iterable of strings containing the
+                paths of files the command writes, which are removed if
+                it's cancelled part way through.
+
+        Returns:
+            A 'concurrent.futures.Future' which gives the command's
+            'CommandResult', or raises OSError if the command couldn't
+            be started.
+        """
+        import asyncio
+
+        return asyncio.run_coroutine_threadsafe(
+            self.runCommand(
+                command, group, stdin, stdout, stderr, onLine, outputs
+            ),
+            self.start(),
+        )
+
+    def run(self, command, **options):
+        """Run a command and wait for it to finish.
+
+        Args:
+            command: A list of strings containing the command.
+            **options: Any of the options of submit.
+
+        Returns:
+            The command's 'CommandResult'.
+
+        Raises:
+            OSError: The command couldn't be started.
+        """
+        return self.submit(command, **options).result()
+
+    def runMany(self, commandList, limit=1, **options):
+        """Run several commands and wait for them all to finish.
+
+        Args:
+            commandList: A list of commands, each a list of strings.
+            limit: An optional integer specifying how many of these
+                commands to run at once.
+            **options: Any of the options of submit, which apply to
+                every command.
+
+        Returns:
+            A list of 'CommandResult's, in the order of the commands.
+
+        Raises:
+            OSError: A command couldn't be started.
+        """
+        import asyncio
+
+        return asyncio.run_coroutine_threadsafe(
+            self.runCommands(commandList, limit, options), self.start()
+        ).result()
+
+    async def runCommands(self, commandList, limit, options):
+        """Run several commands, at most limit at once (see runMany)."""
+        import asyncio
+
+        semaphore = asyncio.Semaphore(max(limit, 1))
+
+        async def runLimitedCommand(command):
+            """Run a command once there's room."""
+            async with semaphore:
+                return await self.runCommand(command, **options)
+
+        return await asyncio.gather(
+            *[runLimitedCommand(command) for command in commandList]
+        )
+
+    async def runCommand(
+        self,
+        command,
+        group=None,
+        stdin=INHERIT,
+        stdout=INHERIT,
+        stderr=INHERIT,
+        onLine=None,
+        outputs=(),
+    ):
+        """Run a command once its group has room (see submit)."""
+        semaphore = self.getSemaphore(group)
+
+        if semaphore is None:
+            result = await self.runProcess(
+                command, group, stdin, stdout, stderr, onLine, outputs
+            )
+        else:
+            async with semaphore:
+                result = await self.runProcess(
+                    command, group, stdin, stdout, stderr, onLine, outputs
+                )
+
+        # Commands refused because we were cancelled never ran
+        if self.profiler and result.returnCode is not None:
+            self.profiler.addCommand(result)
+
+        return result
+
+    async def runProcess(
+        self, command, group, stdin, stdout, stderr, onLine, outputs
+    ):
+        """Run a command straight away (see submit)."""
+        import asyncio
+
+        # Don't start anything new once we've been cancelled
+        if self.cancelled:
+            return CommandResult(command, group, cancelled=True)
+
+        start = time.perf_counter()
+
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=stdin,
+            stdout=CAPTURE if onLine else stdout,
+            stderr=stderr
+        )
+
+        self.processes[process] = list(outputs)
+
+        # We may have been cancelled while the process was starting
+        if self.cancelled:
+            stopProcess(process)
+
+        try:
+            if onLine:
+                # Pass on each line as it comes
+                while True:
+                    line = await process.stdout.readline()
+
+                    if not line:
+                        break
+
+                    onLine(line.decode("utf-8", "replace"))
+
+                output = (None, None)
+                await process.wait()
+            else:
+                output = await process.communicate()
+        finally:
+            del self.processes[process]
+
+        result = CommandResult(
+            command,
+            group,
+            process.returncode,
+            output[0],
+            output[1],
+            time.perf_counter() - start,
+            self.cancelled and process.returncode != 0,
+        )
+
+        # Don't leave partial files behind
+        if result.cancelled:
+            removeFiles(outputs)
+
+        return result
+
+    async def stopProcesses(self):
+        """Stop every running process and remove the files they wrote.
+
+        Processes are asked to exit, and killed if they haven't after
+        TERMINATE_TIMEOUT seconds.
+        """
+        import asyncio
+
+        processes = list(self.processes.items())
+
+        for process, _ in processes:
+            stopProcess(process)
+
+        for process, outputs in processes:
+            try:
+                await asyncio.wait_for(process.wait(), TERMINATE_TIMEOUT)
+            except asyncio.TimeoutError:
+                stopProcess(process, True)
+                await process.wait()
+
+            removeFiles(outputs)
+
+    def cancel(self, wait=True):
+        """Stop running commands and refuse to start any more.
+
+        Commands which are refused or stopped give results with
+        cancelled set.
+
+        Args:
+            wait: An optional boolean toggling whether to wait for
+                running commands to stop and their files to be removed.
+                Without waiting, this is safe to call from a signal
+                handler.
+        """
+        self.cancelled = True
+
+        loop = self.loop
+
+        if loop is None:
+            # Nothing's ever run
+            return
+
+        import asyncio
+
+        if wait:
+            asyncio.run_coroutine_threadsafe(
+                self.stopProcesses(), loop
+            ).result()
+        else:
+            loop.call_soon_threadsafe(
+                lambda: asyncio.ensure_future(self.stopProcesses())
+            )
+
+
+def stopProcess(process, kill=False):
+    """Ask a process to exit, or kill it, if it's still running."""
+    try:
+        if kill:
+            process.kill()
+        else:
+            process.terminate()
+    except ProcessLookupError:
+        pass
+
+
+# The runner everything shares, and shortcuts to its methods
+runner = CommandRunner()
+
+start = runner.start
+setLimit = runner.setLimit
+submit = runner.submit
+run = runner.run
+runMany = runner.runMany
+cancel = runner.cancel
+
+
+def isCancelled():
+    """Return whether the shared runner has been cancelled."""
+    return runner.cancelled
+
+
+def setProfiler(profiler):
+    """Record the commands the shared runner runs with a profiler."""
+    runner.profiler = profiler
@@ -0,0 +1,194 @@
+"""Contains functions to copy files without spawning a process per file.
+
+Copying tries the fastest mechanism the kernel offers first and falls
+back to slower ones when a mechanism isn't supported for a pair of
+files: copy_file_range (which can avoid copying data through user space
+entirely), then sendfile, and finally a plain buffered read/write loop.
+"""
+
+import errno
+import os
+
+# Default number of bytes to move per system call
+DEFAULT_BUFFER_SIZE = 8 * 1024 * 1024
+
+# Errors which mean a zero-copy mechanism can't be used for a given pair
+# of files, as opposed to the copy actually failing
+UNSUPPORTED_ERRNOS = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.EBADF,
+}
+
+
+def copyFile(
+    source, destination, bufferSize=DEFAULT_BUFFER_SIZE, force=False
+):
+    """Copy the contents of a file to a destination file.
+
+    The destination file is created if it doesn't exist and truncated if
+    it does. A partially written destination file is removed if the copy
+    fails.
+
+    Args:
+        source: A string containing the path of the file to copy.
+        destination: A string containing the path to copy to.
+        bufferSize: An optional integer containing the number of bytes
+            to move per system call.
+        force: An optional boolean toggling whether to remove and
+            recreate a destination file which can't be opened for
+            writing, like 'cp --force'.
+
+    Returns:
+        An integer containing the number of bytes copied.
+
+    Raises:
+        OSError: The copy failed.
+    """
+    with open(source, "rb") as sourceFile:
+        try:
+            destinationFd = os.open(
+                destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666
+            )
+        except PermissionError:
+            if not force:
+                raise
+
+            # Remove the file in the way and try again
+            os.remove(destination)
+            destinationFd = os.open(
+                destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666
+            )
+
+        try:
+            copied = copyFileDescriptor(
+                sourceFile.fileno(), destinationFd, bufferSize
+            )
+        except OSError:
+            # Don't leave a partial file behind
+            os.close(destinationFd)
+            os.remove(destination)
+            raise
+
+        os.close(destinationFd)
+
+    return copied
+
+
+def copyFileDescriptor(
+    sourceFd, destinationFd, bufferSize=DEFAULT_BUFFER_SIZE
+):
+    """Copy everything from one file descriptor to another.
+
+    Both descriptors are read and written from their current offsets.
+
+    Args:
+        sourceFd: An integer containing a file descriptor open for
+            reading.
+        destinationFd: An integer containing a file descriptor open for
+            writing.
+        bufferSize: An optional integer containing the number of bytes
+            to move per system call.
+
+    Returns:
+        An integer containing the number of bytes copied.
+    """
+    copied = 0
+
+    # Try each zero-copy mechanism in turn. Each returns the number of
+    # bytes it copied before finishing or finding that it isn't
+    # supported, so the next mechanism picks up where it left off.
+    for copyFunction in (copyWithCopyFileRange, copyWithSendfile):
+        done, count = copyFunction(sourceFd, destinationFd, bufferSize)
+        copied += count
+
+        if done:
+            return copied
+
+    # Fall back to copying through a buffer
+    return copied + copyWithBuffer(sourceFd, destinationFd, bufferSize)
+
+
+def copyWithCopyFileRange(sourceFd, destinationFd, bufferSize):
+    """Copy between file descriptors with os.copy_file_range.
+
+    Returns:
+        A 2-tuple containing a boolean signalling whether the whole
+        file was copied, and an integer containing the number of bytes
+        copied.
+    """
+    if not hasattr(os, "copy_file_range"):
+        return (False, 0)
+
+    copied = 0
+
+    while True:
+        try:
+            count = os.copy_file_range(sourceFd, destinationFd, bufferSize)
+        except OSError as e:
+            if e.errno in UNSUPPORTED_ERRNOS:
+                return (False, copied)
+            raise
+
+        if not count:
+            # End of file. Some filesystems report this falsely before
+            # copying anything, so let another mechanism make sure.
+            return (bool(copied), copied)
+
+        copied += count
+
+
+def copyWithSendfile(sourceFd, destinationFd, bufferSize):
+    """Copy between file descriptors with os.sendfile.
+
+    Returns:
+        A 2-tuple containing a boolean signalling whether the whole
+        file was copied, and an integer containing the number of bytes
+        copied.
+    """
+    if not hasattr(os, "sendfile"):
+        return (False, 0)
+
+    copied = 0
+
+    while True:
+        try:
+            count = os.sendfile(destinationFd, sourceFd, None, bufferSize)
+        except OSError as e:
+            if e.errno in UNSUPPORTED_ERRNOS:
+                return (False, copied)
+            raise
+
+        if not count:
+            # End of file
+            return (True, copied)
+
+        copied += count
+
+
+def copyWithBuffer(sourceFd, destinationFd, bufferSize):
+    """Copy between file descriptors through a buffer.
+
+    Returns:
+        An integer containing the number of bytes copied.
+    """
+    buffer_ = bytearray(bufferSize)
+    view = memoryview(buffer_)
+    copied = 0
+
+    while True:
+        count = os.readv(sourceFd, [buffer_])
+
+        if not count:
+            # End of file
+            return copied
+
+        # Writes can be partial, so keep going until it's all out
+        written = 0
+        while written < count:
+            written += os.write(destinationFd, view[written:count])
+
+        copied += count
@@ -0,0 +1,216 @@
+"""Contains encoder profiles, which say how to encode MP3s.
+
+Profiles trade size and encoding time against quality. Each is a named
+section of the config file, like
+
+    [encoder car]
+    Mode = vbr
+    Quality = 4
+    CompressionLevel = 7
+    SampleRate = 44100
+    Channels = 2
+
+and one is chosen with the EncoderProfile config setting or the
+--encoder-profile runtime argument. The keys are
+
+    Mode: vbr (variable bitrate) or cbr (constant bitrate)
+    Quality: the VBR level, from 0 (biggest, best) to 9 (smallest)
+    Bitrate: the CBR bitrate in kbit/s
+    CompressionLevel: LAME's algorithm quality, from 0 (slowest, best)
+        to 9 (fastest); leave it out for LAME's default
+    SampleRate: the sample rate to resample to in Hz (0 = keep)
+    Channels: 1 for mono or 2 for stereo (0 = keep)
+
+The v0 profile is built in, so config files without any profiles keep
+working as they always have.
+"""
+
+# Prefix of the names of config file sections holding profiles
+SECTION_PREFIX = "encoder "
+
+# Profile to use if none is chosen
+DEFAULT_PROFILE = "v0"
+
+# Profiles which exist even if the config file doesn't define them
+BUILTIN_PROFILES = {"v0": {"Mode": "vbr", "Quality": "0"}}
+
+# Upper end of the average bitrate of each of LAME's VBR levels, in bits
+# per second
+VBR_BITRATES = (
+    260000,
+    225000,
+    190000,
+    175000,
+    165000,
+    130000,
+    115000,
+    100000,
+    85000,
+    65000,
+)
+
+
+class EncoderProfile:
+    """A way of encoding MP3s.
+
+    Attributes:
+        name: A string containing the name of the profile.
+        mode: A string containing "vbr" or "cbr".
+        quality: An integer containing the VBR level, from 0 to 9.
+        bitrate: An integer containing the CBR bitrate in kbit/s.
+        compressionLevel: An integer containing LAME's algorithm
+            quality, from 0 to 9, or None to use LAME's default.
+        sampleRate: An integer containing the sample rate to resample to
+            in Hz, or 0 to keep the original.
+        channels: An integer containing the number of channels to mix
+            down to, or 0 to keep the original.
+    """
+
+    __slots__ = (
+        "name",
+        "mode",
+        "quality",
+        "bitrate",
+        "compressionLevel",
+        "sampleRate",
+        "channels",
+    )
+
+    def __init__(self, name, settings):
+        """Read a profile's settings.
+
+        Args:
+            name: A string containing the name of the profile.
+            settings: A dictionary-like object mapping the profile's
+                keys (see above) to strings.
+
+        Raises:
+            ValueError: A setting isn't valid.
+        """
+        self.name = name
+        self.mode = settings.get("Mode", "vbr").lower()
+        self.quality = getInteger(settings, "Quality", 0, 0, 9)
+        self.bitrate = getInteger(settings, "Bitrate", 192, 8, 320)
+        self.compressionLevel = getInteger(
+            settings, "CompressionLevel", None, 0, 9
+        )
+        self.sampleRate = getInteger(settings, "SampleRate", 0, 0, 48000)
+        self.channels = getInteger(settings, "Channels", 0, 0, 2)
+
+        if self.mode not in ("vbr", "cbr"):
+            raise ValueError("Mode must be vbr or cbr")
+
+    def __repr__(self):
+        return "EncoderProfile(%r)" % self.name
+
+    def getArguments(self):
+        """Return a list of FFmpeg arguments encoding with this profile.
+
+        Any cached conversion must have been made with these same
+        arguments, so they're part of the transcode cache's keys.
+        """
+        arguments = ["-codec:a", "libmp3lame"]
+
+        # See https://trac.ffmpeg.org/wiki/Encode/MP3
+        if self.mode == "vbr":
+            arguments += ["-qscale:a", str(self.quality)]
+        else:
+            arguments += ["-b:a", "%dk" % self.bitrate]
+
+        if self.compressionLevel is not None:
+            arguments += ["-compression_level", str(self.compressionLevel)]
+
+        if self.sampleRate:
+            arguments += ["-ar", str(self.sampleRate)]
+
+        if self.channels:
+            arguments += ["-ac", str(self.channels)]
+
+        return arguments
+
+    def getEstimatedBitrate(self):
+        """Return about the most bits per second this profile produces."""
+        if self.mode == "vbr":
+            return VBR_BITRATES[self.quality]
+
+        return self.bitrate * 1000
+
+
+def getInteger(settings, key, default, minimum, maximum):
+    """Return an integer setting of a profile.
+
+    Args:
+        settings: A dictionary-like object mapping keys to strings.
+        key: A string containing the key of the setting.
+        default: The value to return if the setting isn't there.
+        minimum: An integer containing the smallest valid value.
+        maximum: An integer containing the largest valid value.
+
+    Returns:
+        An integer, or the default.
+
+    Raises:
+        ValueError: The setting isn't an integer in range.
+    """
+    value = settings.get(key, "").strip()
+
+    if not value:
+        return default
+
+    number = int(value)
+
+    if not minimum <= number <= maximum:
+        raise ValueError(
+            "%s must be between %d and %d" % (key, minimum, maximum)
+        )
+
+    return number
+
+
+def getProfileNames(configsettings):
+    """Return a sorted list of the names of the profiles available.
+
+    Args:
+        configsettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+    """
+    names = set(BUILTIN_PROFILES)
+
+    for section in configsettings.parser.sections():
+        if section.startswith(SECTION_PREFIX):
+            names.add(section[len(SECTION_PREFIX) :].strip())
+
+    return sorted(names)
+
+
+def getEncoderProfile(configsettings):
+    """Return the encoder profile chosen by the EncoderProfile setting.
+
+    Args:
+        configsettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+
+    Returns:
+        An 'EncoderProfile'.
+
+    Raises:
+        ValueError: The profile doesn't exist or isn't valid.
+    """
+    name = configsettings.get("EncoderProfile", fallback=DEFAULT_PROFILE)
+    parser = configsettings.parser
+    section = SECTION_PREFIX + name
+
+    if parser.has_section(section):
+        settings = parser[section]
+    elif name in BUILTIN_PROFILES:
+        settings = BUILTIN_PROFILES[name]
+    else:
+        raise ValueError(
+            "no encoder profile '%s' (try %s)"
+            % (name, ", ".join(getProfileNames(configsettings)))
+        )
+
+    try:
+        return EncoderProfile(name, settings)
+    except ValueError as error:
+        raise ValueError("bad encoder profile '%s' (%s)" % (name, error))
@@ -0,0 +1,574 @@
+"""Contains a minimal FAT12/16/32 reader and directory sorter.
+
+This works directly on a device node (or an image file) through a
+memory map, so the device must not be mounted while sorting. Only
+directory clusters are ever written, and only those whose contents
+actually change; the file allocation table itself is never touched.
+
+Sorted directories hold the dot entries and any volume label first,
+then subdirectories, then files, with each long file name kept together
+with the short entry it belongs to. Deleted entries are dropped, and
+the free space is moved to the end.
+"""
+
+import mmap
+import os
+import struct
+from . import plan
+
+# Size of a directory entry in bytes
+ENTRY_SIZE = 32
+
+# First byte of a deleted entry, and of the end of a directory
+DELETED_MARKER = 0xE5
+END_MARKER = 0x00
+
+# Directory entry attributes
+ATTRIBUTE_VOLUME_LABEL = 0x08
+ATTRIBUTE_DIRECTORY = 0x10
+ATTRIBUTE_LONG_NAME = 0x0F
+
+# Offsets of the characters in a long file name entry
+LONG_NAME_OFFSETS = (1, 3, 5, 7, 9, 14, 16, 18, 20, 22, 24, 28, 30)
+
+# Case flags for short names
+LOWERCASE_BASE = 0x08
+LOWERCASE_EXTENSION = 0x10
+
+
+class DirectoryEntry:
+    """An entry in a FAT directory.
+
+    Attributes:
+        name: A string containing the entry's long name, or its short
+            name if it doesn't have a long name.
+        slots: A bytes object containing the raw entry, including any
+            long file name entries before the short entry.
+        attributes: An integer containing the short entry's attributes.
+        cluster: An integer containing the first cluster of the entry's
+            contents.
+    """
+
+    __slots__ = ("name", "slots", "attributes", "cluster")
+
+    def __init__(self, name, slots, attributes, cluster):
+        self.name = name
+        self.slots = slots
+        self.attributes = attributes
+        self.cluster = cluster
+
+    def __repr__(self):
+        return "DirectoryEntry(%r)" % self.name
+
+    def isDirectory(self):
+        """Return whether this entry is a directory."""
+        return bool(self.attributes & ATTRIBUTE_DIRECTORY)
+
+    def isVolumeLabel(self):
+        """Return whether this entry is the volume label."""
+        return bool(self.attributes & ATTRIBUTE_VOLUME_LABEL)
+
+    def isDotEntry(self):
+        """Return whether this entry is '.' or '..'."""
+        return self.name in (".", "..")
+
+
+class FatVolume:
+    """A FAT filesystem on a device node or image file.
+
+    Use it as a context manager, or call close when done with it.
+    Directories are identified by their first cluster, where 0 is the
+    root directory.
+
+    Attributes:
+        fatType: An integer which is one of 12, 16, or 32.
+        clusterSize: An integer containing the number of bytes in a
+            cluster.
+    """
+
+    def __init__(self, devicePath, writable=False):
+        """Open a FAT filesystem.
+
+        Args:
+            devicePath: A string containing the path of the device node
+                or image file.
+            writable: An optional boolean toggling whether to allow
+                changing the filesystem.
+
+        Raises:
+            OSError: The device couldn't be opened.
+            ValueError: The device doesn't hold a FAT filesystem.
+        """
+        self.writable = writable
+        self.fd = os.open(devicePath, os.O_RDWR if writable else os.O_RDONLY)
+
+        try:
+            # Block devices report a size of zero, so find their size by
+            # seeking to the end
+            size = os.lseek(self.fd, 0, os.SEEK_END)
+            self.map = mmap.mmap(
+                self.fd,
+                size,
+                access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ,
+            )
+        except (OSError, ValueError):
+            os.close(self.fd)
+            raise
+
+        try:
+            self.readBootSector()
+        except ValueError:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exceptionInfo):
+        self.close()
+
+    def close(self):
+        """Write out any changes and close the filesystem."""
+        if self.map.closed:
+            return
+
+        if self.writable:
+            self.map.flush()
+            os.fsync(self.fd)
+
+        self.map.close()
+        os.close(self.fd)
+
+    def readBootSector(self):
+        """Read the filesystem's layout from its boot sector."""
+        if len(self.map) < 512 or self.map[510:512] != b"\x55\xaa":
+            raise ValueError("no FAT boot sector signature")
+
+        (
+            self.sectorSize,
+            sectorsPerCluster,
+            reservedSectors,
+            fatCount,
+            rootEntryCount,
+            totalSectors16,
+            _,
+            fatSize16,
+        ) = struct.unpack_from("<HBHBHHBH", self.map, 11)
+        totalSectors32, fatSize32 = struct.unpack_from("<II", self.map, 32)
+
+        if (
+            self.sectorSize not in (512, 1024, 2048, 4096)
+            or not sectorsPerCluster
+            or sectorsPerCluster & (sectorsPerCluster - 1)
+            or not fatCount
+        ):
+            raise ValueError("invalid FAT boot sector")
+
+        fatSize = fatSize16 or fatSize32
+        totalSectors = totalSectors16 or totalSectors32
+        rootSectors = -(-rootEntryCount * ENTRY_SIZE // self.sectorSize)
+        dataSector = reservedSectors + fatCount * fatSize + rootSectors
+
+        self.clusterSize = sectorsPerCluster * self.sectorSize
+        self.clusterCount = (totalSectors - dataSector) // sectorsPerCluster
+        self.fatOffset = reservedSectors * self.sectorSize
+        self.dataOffset = dataSector * self.sectorSize
+
+        # The number of clusters alone determines the FAT type
+        if self.clusterCount < 4085:
+            self.fatType = 12
+        elif self.clusterCount < 65525:
+            self.fatType = 16
+        else:
+            self.fatType = 32
+
+        if self.fatType == 32:
+            self.rootCluster = struct.unpack_from("<I", self.map, 44)[0]
+            self.rootRegion = None
+        else:
+            # The root directory has a fixed region of its own
+            self.rootCluster = 0
+            self.rootRegion = (
+                (reservedSectors + fatCount * fatSize) * self.sectorSize,
+                rootEntryCount * ENTRY_SIZE,
+            )
+
+        if dataSector * self.sectorSize > len(self.map):
+            raise ValueError("FAT filesystem larger than its device")
+
+    def getNextCluster(self, cluster):
+        """Return the cluster after a cluster, or None at the end."""
+        if self.fatType == 32:
+            nextCluster = struct.unpack_from(
+                "<I", self.map, self.fatOffset + 4 * cluster
+            )[0]
+            nextCluster &= 0x0FFFFFFF
+            endCluster = 0x0FFFFFF7
+        elif self.fatType == 16:
+            nextCluster = struct.unpack_from(
+                "<H", self.map, self.fatOffset + 2 * cluster
+            )[0]
+            endCluster = 0xFFF7
+        else:
+            pair = struct.unpack_from(
+                "<H", self.map, self.fatOffset + cluster + cluster // 2
+            )[0]
+            nextCluster = pair >> 4 if cluster & 1 else pair & 0x0FFF
+            endCluster = 0xFF7
+
+        if nextCluster < 2 or nextCluster >= endCluster:
+            return None
+
+        return nextCluster
+
+    def getDirectoryRegions(self, cluster):
+        """Return the regions of the device holding a directory.
+
+        Args:
+            cluster: An integer containing the first cluster of the
+                directory, or 0 for the root directory.
+
+        Returns:
+            A list of 2-tuples of (offset, length) in bytes.
+        """
+        if not cluster:
+            if self.rootRegion:
+                return [self.rootRegion]
+
+            cluster = self.rootCluster
+
+        regions = []
+
+        # Follow the chain, making sure a damaged FAT can't send us
+        # round in circles
+        while cluster is not None and len(regions) <= self.clusterCount:
+            if cluster - 2 >= self.clusterCount:
+                raise ValueError("cluster %d out of range" % cluster)
+
+            regions.append(
+                (
+                    self.dataOffset + (cluster - 2) * self.clusterSize,
+                    self.clusterSize,
+                )
+            )
+            cluster = self.getNextCluster(cluster)
+
+        return regions
+
+    def readDirectory(self, cluster):
+        """Return a list of the DirectoryEntrys in a directory.
+
+        Long file name entries which don't belong to the short entry
+        after them are left out, as are deleted entries.
+
+        Args:
+            cluster: An integer containing the first cluster of the
+                directory, or 0 for the root directory.
+        """
+        data = self.getDirectoryData(cluster)
+
+        entries = []
+        longSlots = []
+
+        for index in range(0, len(data) - ENTRY_SIZE + 1, ENTRY_SIZE):
+            slot = data[index : index + ENTRY_SIZE]
+
+            if slot[0] == END_MARKER:
+                break
+
+            if slot[0] == DELETED_MARKER:
+                longSlots = []
+                continue
+
+            if slot[11] == ATTRIBUTE_LONG_NAME:
+                if slot[0] & 0x40:
+                    # The first slot of a long name
+                    longSlots = []
+
+                longSlots.append(slot)
+                continue
+
+            # A short entry. Keep any long name before it if it
+            # belongs to it.
+            if longSlots and all(
+                longSlot[13] == getShortNameChecksum(slot)
+                for longSlot in longSlots
+            ):
+                name = getLongName(longSlots)
+                slots = b"".join(longSlots) + slot
+            else:
+                name = getShortName(slot)
+                slots = slot
+
+            longSlots = []
+
+            # FAT12 and FAT16 don't use the high half of the cluster
+            firstCluster = struct.unpack_from("<H", slot, 26)[0]
+            if self.fatType == 32:
+                firstCluster |= struct.unpack_from("<H", slot, 20)[0] << 16
+
+            entries.append(
+                DirectoryEntry(name, slots, slot[11], firstCluster)
+            )
+
+        return entries
+
+    def findDirectory(self, path):
+        """Return the first cluster of a directory, or None.
+
+        Args:
+            path: A string containing the path of the directory relative
+                to the root of the filesystem. Names are matched
+                regardless of case, like the vfat driver does.
+        """
+        cluster = 0
+
+        for name in path.split("/"):
+            if name in ("", "."):
+                continue
+
+            for entry in self.readDirectory(cluster):
+                if (
+                    entry.isDirectory()
+                    and not entry.isVolumeLabel()
+                    and entry.name.lower() == name.lower()
+                ):
+                    cluster = entry.cluster
+                    break
+            else:
+                return None
+
+        return cluster
+
+    def getAllDirectories(self):
+        """Return a list of the first clusters of every directory."""
+        directories = [0]
+        seen = {0, self.rootCluster}
+
+        for cluster in directories:
+            for entry in self.readDirectory(cluster):
+                if (
+                    entry.isDirectory()
+                    and not entry.isDotEntry()
+                    and not entry.isVolumeLabel()
+                    and entry.cluster not in seen
+                ):
+                    seen.add(entry.cluster)
+                    directories.append(entry.cluster)
+
+        return directories
+
+    def isSorted(self, cluster, natural=True):
+        """Return whether a directory's entries are in sorted order.
+
+        Deleted entries between entries count as being out of order,
+        since new entries can be created in their place.
+        """
+        entries = sortEntries(self.readDirectory(cluster), natural)
+        data = self.getDirectoryData(cluster)
+
+        # Sorting must leave everything up to the end marker as it is
+        for index in range(0, len(data), ENTRY_SIZE):
+            if data[index] == END_MARKER:
+                data = data[:index]
+                break
+
+        return data == b"".join(entry.slots for entry in entries)
+
+    def getDirectoryData(self, cluster):
+        """Return the raw contents of a directory as a bytes object."""
+        return b"".join(
+            self.map[offset : offset + length]
+            for offset, length in self.getDirectoryRegions(cluster)
+        )
+
+    def sortDirectory(self, cluster, natural=True):
+        """Sort a directory's entries in place.
+
+        Args:
+            cluster: An integer containing the first cluster of the
+                directory, or 0 for the root directory.
+            natural: An optional boolean toggling whether to sort names
+                in natural, case-insensitive order, rather than by code
+                point.
+
+        Returns:
+            An integer containing the number of regions of the device
+            (clusters, or the root directory region) rewritten.
+        """
+        entries = sortEntries(self.readDirectory(cluster), natural)
+        data = b"".join(entry.slots for entry in entries)
+
+        rewritten = 0
+        position = 0
+
+        for offset, length in self.getDirectoryRegions(cluster):
+            # Everything after the last entry is free
+            newData = data[position : position + length]
+            newData += bytes(length - len(newData))
+            position += length
+
+            if self.map[offset : offset + length] != newData:
+                self.map[offset : offset + length] = newData
+                rewritten += 1
+
+        return rewritten
+
+
+def getShortNameChecksum(slot):
+    """Return the checksum long name entries hold of a short name."""
+    checksum = 0
+
+    for byte in slot[:11]:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + byte) & 0xFF
+
+    return checksum
+
+
+def getShortName(slot):
+    """Return the name held in a short entry."""
+    base = bytearray(slot[:8])
+    if base[0] == 0x05:
+        # Stands in for a name starting with 0xE5
+        base[0] = DELETED_MARKER
+
+    base = bytes(base).decode("cp437").rstrip(" ")
+    extension = slot[8:11].decode("cp437").rstrip(" ")
+
+    if slot[12] & LOWERCASE_BASE:
+        base = base.lower()
+    if slot[12] & LOWERCASE_EXTENSION:
+        extension = extension.lower()
+
+    if extension:
+        return base + "." + extension
+
+    return base
+
+
+def getLongName(longSlots):
+    """Return the name held in a list of long name entries.
+
+    The entries are in the order they appear in the directory, which is
+    the reverse of the order of the name's characters.
+    """
+    characters = bytearray()
+
+    for slot in reversed(longSlots):
+        for offset in LONG_NAME_OFFSETS:
+            characters += slot[offset : offset + 2]
+
+    name = characters.decode("utf-16-le", "replace")
+
+    return name.split("\0", 1)[0]
+
+
+def sortEntries(entries, natural=True):
+    """Return a list of directory entries in sorted order.
+
+    The dot entries and the volume label come first, then directories,
+    then files.
+    """
+    if natural:
+        getKey = plan.getNaturalKey
+    else:
+        getKey = str
+
+    return sorted(
+        entries,
+        key=lambda entry: (
+            entry.name != ".",
+            entry.name != "..",
+            not entry.isVolumeLabel(),
+            not entry.isDirectory(),
+            getKey(entry.name),
+        ),
+    )
+
+
+def sortDevice(devicePath, paths=None, natural=True):
+    """Sort the directories on a FAT device.
+
+    Args:
+        devicePath: A string containing the path of the device node or
+            image file. The device must not be mounted.
+        paths: An optional list of strings containing the paths of the
+            directories to sort, relative to the root of the filesystem.
+            Directories which don't exist are ignored. Defaults to
+            sorting every directory.
+        natural: An optional boolean toggling whether to sort names in
+            natural, case-insensitive order, rather than by code point.
+
+    Returns:
+        An integer containing the number of directories which changed.
+
+    Raises:
+        OSError: The device couldn't be read or written.
+        ValueError: The device doesn't hold a valid FAT filesystem.
+    """
+    changed = 0
+
+    with FatVolume(devicePath, writable=True) as volume:
+        for cluster in getDirectoryClusters(volume, paths):
+            if volume.sortDirectory(cluster, natural):
+                changed += 1
+
+    return changed
+
+
+def countUnsortedDirectories(devicePath, paths=None, natural=True):
+    """Count the directories on a FAT device which aren't sorted.
+
+    This only reads from the device, so it's safe to run while the
+    device is mounted, as long as everything written to it has been
+    flushed.
+
+    Args:
+        devicePath: A string containing the path of the device node or
+            image file.
+        paths: An optional list of strings containing the paths of the
+            directories to check, relative to the root of the
+            filesystem. Directories which don't exist are ignored.
+            Defaults to checking every directory.
+        natural: An optional boolean toggling whether to sort names in
+            natural, case-insensitive order, rather than by code point.
+
+    Returns:
+        An integer containing the number of directories out of order.
+
+    Raises:
+        OSError: The device couldn't be read.
+        ValueError: The device doesn't hold a valid FAT filesystem.
+    """
+    with FatVolume(devicePath) as volume:
+        return sum(
+            not volume.isSorted(cluster, natural)
+            for cluster in getDirectoryClusters(volume, paths)
+        )
+
+
+def getDirectoryClusters(volume, paths=None):
+    """Return the first clusters of directories on a FAT volume.
+
+    Args:
+        volume: A FatVolume.
+        paths: An optional list of strings containing the paths of the
+            directories, relative to the root of the filesystem.
+            Directories which don't exist are left out. Defaults to
+            every directory.
+
+    Returns:
+        A list of integers, without duplicates.
+    """
+    if paths is None:
+        return volume.getAllDirectories()
+
+    clusters = []
+
+    for path in paths:
+        cluster = volume.findDirectory(path)
+
+        if cluster is not None and cluster not in clusters:
+            clusters.append(cluster)
+
+    return clusters
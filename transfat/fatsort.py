@@ -1,7 +1,9 @@
 """Contains functions useful for fatsorting drives."""
 
 import os
-import subprocess
+from . import commands
+from . import fatfs
+from . import mounts
 from . import talk
 
 
@@ -34,38 +36,21 @@ def findDeviceLocations(
     # Make sure destination is an absolute path
     destination = os.path.abspath(destinationPath)
 
-    # Get list of FAT devices
-    bashListCmd = "mount -t vfat | cut -f 1,3 -d ' '"
-    deviceListProcess = subprocess.Popen(
-        ["bash", "-c", bashListCmd], stdout=subprocess.PIPE
-    )
+    # Look up which device the destination is on
+    mount = mounts.resolveDestinations([destination])[destination]
 
-    # Read the devices list from Popen
-    deviceString = deviceListProcess.communicate()[0].decode("ascii")
-    deviceString = deviceString.rstrip()
+    if mount is not None:
+        # Found a match! Return device and mount location
+        return (mount.device, mount.mountPoint)
+
+    # Get list of FAT devices
+    fatMounts = mounts.getFatMounts()
 
     # Check if any FAT devices were found
-    if deviceString == "":
+    if not fatMounts:
         # No FAT devices found, return empty string
         return ("", "")
 
-    # Split deviceString so we get a separate string for each device
-    deviceList = deviceString.split("\n")
-
-    # For each device, split into device location and mount location.
-    # So in deviceListSep, deviceListSep[i][0] gives the device location
-    # and deviceListSep[i][1] gives the mount location of the ith device
-    deviceListSep = [deviceList[i].split() for i in range(len(deviceList))]
-
-    # Test if destination path matches any mount locations
-    for i in range(len(deviceList)):
-        deviceLoc = deviceListSep[i][0]
-        mountLoc = deviceListSep[i][1]
-
-        if os.path.commonpath((destination, mountLoc)) == mountLoc:
-            # Found a match! Return device and mount location
-            return (deviceLoc, mountLoc)
-
     # Something went wrong with the automation: if not set to
     # non-interactive mode, ask user if any of the FAT devices found
     # earlier match the intended destination; otherwise, just return
@@ -73,8 +58,8 @@ def findDeviceLocations(
     if not noninteractive:
         # Enumerate each device
         deviceListEnum = [
-            "[%d] %s" % (i, deviceList[i - 1])
-            for i in range(1, len(deviceList) + 1)
+            "[%d] %s %s" % (i, mount.device, mount.mountPoint)
+            for i, mount in enumerate(fatMounts, 1)
         ]
 
         # Add option to abort
@@ -101,31 +86,202 @@ def findDeviceLocations(
             return ("", "")
 
         # Return requested device and mount location strings
-        return (deviceListSep[ans - 1][0], deviceListSep[ans - 1][1])
+        return (fatMounts[ans - 1].device, fatMounts[ans - 1].mountPoint)
 
     # Non-interactive mode is on, just return empty strings
     return ("", "")
 
 
+def isMounted(deviceLocation):
+    """Return whether a device is mounted anywhere."""
+    return any(mount.device == deviceLocation for mount in mounts.getMounts())
+
+
 def unmount(deviceLocation, verbose=False):
     """Unmount a device and return whether it was successful."""
     noiseLevel = []
     if verbose:
         noiseLevel += ["-v"]
 
-    exitCode = subprocess.Popen(
-        ["sudo", "umount", deviceLocation] + noiseLevel
-    ).wait()
-    return bool(not exitCode)
+    result = commands.run(["sudo", "umount", deviceLocation] + noiseLevel)
+
+    # What's mounted has changed
+    mounts.getMounts.cache_clear()
+
+    return result.succeeded()
+
+
+def getUnsortedDirectories(plan):
+    """Return the directories a transfer would leave out of order.
+
+    FAT devices list directory entries in the order they were created.
+    When a transfer creates its entries in sorted order, the only
+    directories which can end up out of order are those which already
+    had entries in them before the transfer added more. Call this before
+    creating any directories.
+
+    Note that an empty directory can still contain the slots of deleted
+    entries, which new entries may reuse out of order; empty directories
+    are assumed not to.
+
+    Args:
+        plan: A 'plan.TransferPlan' object containing the files and
+            directories to transfer.
+
+    Returns:
+        A sorted list of strings containing the paths of the existing,
+        non-empty directories the transfer would add entries to.
+    """
+    # Directories which get new entries
+    targets = set()
+
+    for record in plan.directories + plan.files:
+        if not os.path.lexists(record.destination):
+            targets.add(os.path.dirname(record.destination))
+
+    unsorted = []
+
+    for target in targets:
+        try:
+            if next(os.scandir(target), None) is not None:
+                unsorted.append(target)
+        except FileNotFoundError:
+            # We'll create this directory ourselves
+            pass
+        except OSError:
+            unsorted.append(target)
+
+    return sorted(unsorted)
+
+
+def getRelativePaths(directories, mountLocation):
+    """Return the paths of directories relative to a device's root.
+
+    Args:
+        directories: An iterable of strings containing absolute paths of
+            directories on the device. Directories which don't exist or
+            aren't on the device are left out.
+        mountLocation: A string containing the mount location of the
+            device.
+
+    Returns:
+        A sorted list of strings containing paths relative to the root
+        of the device, where the root itself is an empty string.
+    """
+    relativePaths = set()
 
+    for directory in directories:
+        if not os.path.isdir(directory):
+            continue
+
+        relativePath = os.path.relpath(directory, mountLocation)
+
+        if relativePath == ".":
+            relativePaths.add("")
+        elif not relativePath.startswith(".."):
+            relativePaths.add(relativePath)
+
+    return sorted(relativePaths)
+
+
+def countUnsortedDirectories(
+    deviceLocation, directories=None, natural=False, quiet=False
+):
+    """Count the directories on a mounted device which need sorting.
+
+    Flushes everything written to the device first, then reads the
+    directories straight from the device, without unmounting it.
+
+    Args:
+        deviceLocation: A string containing the device location of the
+            device.
+        directories: An optional list of strings containing the paths
+            of the only directories to check, relative to the root of
+            the device (as returned by getRelativePaths). Defaults to
+            checking every directory.
+        natural: An optional boolean toggling whether to check for
+            natural, case-insensitive order, as 'plan.getNaturalKey'
+            gives.
+        quiet: An optional boolean toggling whether to omit error
+            output.
+
+    Returns:
+        An integer containing the number of directories out of order,
+        or None if the device couldn't be checked.
+    """
+    os.sync()
+
+    try:
+        return fatfs.countUnsortedDirectories(
+            deviceLocation, directories, natural
+        )
+    except (OSError, ValueError) as e:
+        talk.error("Failed to check whether sorted (%s)" % e, quiet)
+        return None
+
+
+def fatsort(
+    deviceLocation,
+    quiet=False,
+    natural=False,
+    backend="fatsort",
+    directories=None,
+):
+    """Sort a device and return whether it was successful.
+
+    Args:
+        deviceLocation: A string containing the device location of the
+            unmounted device.
+        quiet: An optional boolean toggling whether to omit error
+            output.
+        natural: An optional boolean toggling whether to sort names in
+            natural, case-insensitive order, as 'plan.getNaturalKey'
+            does.
+        backend: An optional string (given by the SortBackend config
+            setting) specifying whether to sort with the external
+            fatsort program ("fatsort") or in-process ("builtin"). If
+            the built-in sorter fails, fatsort is tried instead.
+        directories: An optional list of strings containing the paths
+            of the only directories to sort, relative to the root of the
+            device (as returned by getRelativePaths). Defaults to
+            sorting every directory.
+
+    Returns:
+        A boolean signalling whether sorting succeeded.
+    """
+    # The built-in sorter writes to the device directly, so never let it
+    # near a device which is still mounted
+    if backend == "builtin" and isMounted(deviceLocation):
+        talk.error(
+            "%s is still mounted; trying fatsort" % deviceLocation, quiet
+        )
+    elif backend == "builtin":
+        try:
+            fatfs.sortDevice(deviceLocation, directories, natural)
+            return True
+        except (OSError, ValueError) as e:
+            talk.error(
+                "Built-in sorter failed (%s); trying fatsort" % e, quiet
+            )
 
-def fatsort(deviceLocation, quiet=False):
-    """fatsort a device and return whether it was successful."""
     noiseLevel = []
     if quiet:
         noiseLevel += ["-q"]
 
-    exitCode = subprocess.Popen(
-        ["sudo", "fatsort", deviceLocation] + noiseLevel
-    ).wait()
-    return bool(not exitCode)
+    sortOrder = []
+    if natural:
+        sortOrder += ["-n", "-c"]
+
+    # Restrict sorting to particular directories if asked to
+    selection = []
+    for directory in directories or []:
+        selection += ["-d", "/" + directory]
+
+    result = commands.run(
+        ["sudo", "fatsort"]
+        + sortOrder
+        + selection
+        + noiseLevel
+        + [deviceLocation]
+    )
+    return result.succeeded()
@@ -0,0 +1,247 @@
+"""Contains a class for flushing files to devices as they're written.
+
+Left to itself, the kernel holds on to data written to a device and
+writes it out whenever it sees fit. A USB stick takes much longer to
+write to than copying takes, so gigabytes can still be waiting when we
+unmount the device, and unmounting then sits there for minutes saying
+nothing.
+
+Instead, each file is flushed (with fsync) as soon as it's been written,
+on a thread of its own for each device, so that flushing one file
+overlaps with copying the next. Copying waits whenever too much is
+waiting to be flushed to a device, keeping the backlog short, and
+whatever's left at the end is flushed while showing how much the kernel
+still has to write. Unmounting is then quick.
+"""
+
+import collections
+import os
+import threading
+from . import talk
+
+# File containing the kernel's memory counters
+MEMINFO_PATH = "/proc/meminfo"
+
+# Counters in MEMINFO_PATH of data waiting to be written to devices
+DIRTY_COUNTERS = ("Dirty", "Writeback")
+
+# Seconds between progress updates while waiting for flushes to finish
+WAIT_INTERVAL = 0.25
+
+
+def getDirtyBytes():
+    """Return how many bytes the kernel has waiting to be written.
+
+    This counts data for every device, not just ours.
+
+    Returns:
+        An integer, or None if we can't tell.
+    """
+    dirtyBytes = None
+
+    try:
+        with open(MEMINFO_PATH) as meminfoFile:
+            for line in meminfoFile:
+                key, _, value = line.partition(":")
+
+                # Values are in KiB
+                if key in DIRTY_COUNTERS:
+                    kibibytes = int(value.split()[0])
+                    dirtyBytes = (dirtyBytes or 0) + kibibytes * 1024
+    except (OSError, ValueError, IndexError):
+        return None
+
+    return dirtyBytes
+
+
+def flushFile(path):
+    """Flush a file or directory to its device.
+
+    Returns:
+        A boolean signalling whether flushing succeeded.
+    """
+    try:
+        fileDescriptor = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+
+    try:
+        os.fsync(fileDescriptor)
+    except OSError:
+        return False
+    finally:
+        os.close(fileDescriptor)
+
+    return True
+
+
+class Flusher:
+    """Flushes files to their devices in the background.
+
+    A flusher which isn't enabled does nothing, so it's safe to call its
+    methods unconditionally.
+
+    Attributes:
+        enabled: A boolean signalling whether we flush anything.
+        aheadBytes: An integer containing how many bytes may wait to be
+            flushed to each device before adding more waits.
+        flushedFiles: An integer containing the number of files flushed.
+        flushedBytes: An integer containing the number of bytes flushed.
+    """
+
+    def __init__(self, aheadBytes=0, quiet=False):
+        """Start with nothing to flush.
+
+        Args:
+            aheadBytes: An optional integer containing how many bytes
+                may wait to be flushed to each device. If this is 0,
+                nothing is flushed.
+            quiet: An optional boolean toggling whether to omit error
+                output.
+        """
+        self.enabled = aheadBytes > 0
+        self.aheadBytes = aheadBytes
+        self.quiet = quiet
+        self.flushedFiles = 0
+        self.flushedBytes = 0
+
+        self.condition = threading.Condition()
+        self.closed = False
+
+        # Files waiting to be flushed to each device, as 2-tuples of
+        # ("path", size), along with the bytes queued or being flushed
+        # and the thread flushing them, by device number
+        self.queues = {}
+        self.pendingBytes = {}
+        self.threads = {}
+
+        # Directories holding the files flushed
+        self.directories = set()
+
+    def add(self, path):
+        """Flush a file which has been written, in the background.
+
+        If too much is waiting to be flushed to the file's device
+        already, this waits for room first.
+
+        Args:
+            path: A string containing the path of the file.
+        """
+        if not self.enabled:
+            return
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Gone already
+            return
+
+        device = stat.st_dev
+        size = stat.st_size
+
+        with self.condition:
+            # Wait for room, but let a file in whenever nothing's
+            # waiting, however big it is
+            while (
+                self.pendingBytes.get(device, 0)
+                and self.pendingBytes[device] + size > self.aheadBytes
+            ):
+                self.condition.wait()
+
+            self.queues.setdefault(device, collections.deque()).append(
+                (path, size)
+            )
+            self.pendingBytes[device] = (
+                self.pendingBytes.get(device, 0) + size
+            )
+
+            if device not in self.threads:
+                self.threads[device] = threading.Thread(
+                    target=self.flushDevice,
+                    args=(device,),
+                    name="flush-%d" % device,
+                    daemon=True,
+                )
+                self.threads[device].start()
+
+            self.condition.notify_all()
+
+    def flushDevice(self, device):
+        """Flush files queued for a device until we're finished."""
+        queue = self.queues[device]
+
+        while True:
+            with self.condition:
+                while not (queue or self.closed):
+                    self.condition.wait()
+
+                if not queue:
+                    # All done
+                    return
+
+                path, size = queue.popleft()
+
+            flushed = flushFile(path)
+
+            with self.condition:
+                self.pendingBytes[device] -= size
+
+                if flushed:
+                    self.flushedFiles += 1
+                    self.flushedBytes += size
+                    self.directories.add(os.path.dirname(path))
+
+                self.condition.notify_all()
+
+            if not flushed:
+                talk.error("Failed to flush %s" % path, self.quiet)
+
+    def getPendingBytes(self):
+        """Return how many bytes are waiting to be flushed by us."""
+        with self.condition:
+            return sum(self.pendingBytes.values())
+
+    def finish(self, progress=None):
+        """Wait for every file to be flushed, then flush their directories.
+
+        No more files can be added afterwards.
+
+        Args:
+            progress: An optional 'talk.FlushProgress' object to show how
+                much is left to write on while waiting.
+        """
+        if not self.enabled:
+            return
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+            threads = list(self.threads.values())
+
+        # Whether we had to wait for anything
+        waited = False
+
+        for thread in threads:
+            while thread.is_alive():
+                waited = True
+
+                if progress:
+                    # Go by the kernel's counters if we can, since they
+                    # show progress within files too
+                    dirtyBytes = getDirtyBytes()
+
+                    if dirtyBytes is None:
+                        dirtyBytes = self.getPendingBytes()
+
+                    progress.setRemaining(dirtyBytes)
+
+                thread.join(WAIT_INTERVAL)
+
+        # New directory entries belong to the directories
+        for directory in self.directories:
+            flushFile(directory)
+
+        if progress and waited:
+            progress.setRemaining(0)
+            progress.finish()
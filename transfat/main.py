@@ -13,7 +13,20 @@ or do
 to see how to be fancier. Or read the README.md.
 """
 
+import atexit
+import collections
+import concurrent.futures
+import signal
+from transfat import cache
+from transfat import capacity
+from transfat import commands
+from transfat import encoders
 from transfat import fatsort
+from transfat import flush
+from transfat import manifest
+from transfat import plan
+from transfat import probe
+from transfat import profiling
 from transfat import rename
 from transfat import system
 from transfat import talk
@@ -25,6 +38,49 @@ def main():
     # Get runtime arguments
     args = system.getRuntimeArguments()
 
+    # Stop the commands we've started as soon as we're interrupted,
+    # rather than once whatever's waiting on them notices
+    signal.signal(signal.SIGINT, interrupt)
+
+    try:
+        # Run the cache subcommand if that's what we're asked to do
+        if args.command == "cache":
+            cacheCommand(args)
+        else:
+            transferCommand(args)
+    except KeyboardInterrupt:
+        # Wait for the commands to stop and for their partial files to
+        # be removed, without being interrupted again
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        commands.cancel()
+
+        talk.error("interrupted!", args.quiet)
+        system.abort(130)
+
+
+def interrupt(signalNumber, frame):
+    """Handle SIGINT by cancelling commands and raising KeyboardInterrupt.
+
+    Args:
+        signalNumber: An integer containing the signal's number.
+        frame: The stack frame we were interrupted in.
+    """
+    commands.cancel(False)
+
+    raise KeyboardInterrupt
+
+
+def transferCommand(args):
+    """Transfer files to devices.
+
+    Args:
+        args: An 'argparse.Namespace' object containing the runtime
+            arguments.
+    """
+    # Run commands from the main thread first; see commands.start
+    commands.start()
+
     # Confirm that dependencies are installed
     talk.status("Checking if dependencies are installed", args.verbose)
 
@@ -50,6 +106,17 @@ def main():
         # Success
         talk.success("'%s' read" % args.config_file, args.verbose)
 
+    # Choose how to encode conversions, making sure we can before
+    # anything starts
+    if args.encoder_profile:
+        cfgSettings["EncoderProfile"] = args.encoder_profile
+
+    try:
+        encoderProfile = encoders.getEncoderProfile(cfgSettings)
+    except ValueError as error:
+        talk.error("%s!" % error, args.quiet)
+        system.abort(1)
+
     # Get root access if we don't have it already, and restart with it
     # if we don't. No need to do this if we're not fatsorting.
     if not args.no_sort:
@@ -66,103 +133,545 @@ def main():
             # Success
             talk.success("Running as root", args.verbose)
 
+    # Record where time is spent if we're asked to. Do this after
+    # getting root access, which restarts us, so that only one report is
+    # written. The report is written on exit, even if we abort.
+    profiler = profiling.Profiler(
+        args.profile is not None, args.profile_python, args.profile_memory
+    )
+
+    if args.profile:
+        atexit.register(
+            writeProfile, profiler, args.profile, args.verbose, args.quiet
+        )
+
+        commands.setProfiler(profiler)
+
+    # Paths on FAT devices before the destination are guessed to be
+    # destinations too. Make sure the user meant that, or else only
+    # transfer to the last path. Do this after getting root access,
+    # which restarts us, so that the user is only asked once.
+    if (
+        len(args.destinations) > 1
+        and not args.to
+        and not system.confirmDestinations(
+            args.sources, args.destinations, args.non_interactive, args.quiet
+        )
+    ):
+        args.sources += args.destinations[:-1]
+        args.destinations = args.destinations[-1:]
+        args.destination = args.destinations[0]
+
     # Warn that this will take a bit of time if we're not fatsorting
     if not args.quiet:
         print("This may take a few minutes . . .")
 
-    # Find device and mount location corresponding to provided
-    # destination
-    talk.status(
-        "Finding device and mount locations containing '%s'"
-        % args.destination,
-        args.verbose,
-    )
+    # Find device and mount locations corresponding to each provided
+    # destination. Each entry is a 3-tuple of ("destination",
+    # "devLoc", "mntLoc").
+    devices = []
 
-    # This function returns empty strings if it failed
-    devLoc, mntLoc = fatsort.findDeviceLocations(
-        args.destination, args.non_interactive, args.verbose, args.quiet
-    )
-    if devLoc == "":
-        # Failure
-        talk.error("no FAT device found!", args.quiet)
+    for destination in args.destinations:
+        talk.status(
+            "Finding device and mount locations containing '%s'"
+            % destination,
+            args.verbose,
+        )
+
+        # This function returns empty strings if it failed
+        devLoc, mntLoc = fatsort.findDeviceLocations(
+            destination, args.non_interactive, args.verbose, args.quiet
+        )
+        if devLoc == "":
+            # Failure
+            talk.error("no FAT device found!", args.quiet)
+            system.abort(1)
+        else:
+            # Success, print the devices
+            if args.verbose:
+                print(
+                    "Success\n\nFound device and mount locations:"
+                    "\ndevice: %s\nmount: %s" % (devLoc, mntLoc),
+                    end="\n\n",
+                )
+
+        devices.append((destination, devLoc, mntLoc))
+
+    # Each device has its own manifest, and what's changed can differ
+    # between them
+    if args.incremental and len(devices) > 1:
+        talk.error(
+            "incremental transfers go to one destination at a time!",
+            args.quiet,
+        )
         system.abort(1)
-    else:
-        # Success, print the devices
-        if args.verbose:
-            print(
-                "Success\n\nFound device and mount locations:"
-                "\ndevice: %s\nmount: %s" % (devLoc, mntLoc),
-                end="\n\n",
-            )
+
+    # The first (usually only) device
+    devLoc, mntLoc = devices[0][1:]
+
+    # Whether to create entries on the device in sorted order, and
+    # whether doing so leaves the device sorted
+    sortedCreation = cfgSettings.getint("SortedCreation", fallback=0)
+    alreadySorted = False
+
+    # Directories on the device this run adds entries to. This stays
+    # None if we don't know, in which case the whole device is sorted.
+    touchedDirectories = None
+
+    # Whether each device is already sorted, and the directories on it
+    # this run adds entries to, in the same order as devices. Transfers
+    # which make a plan up front fill this in themselves.
+    deviceStates = None
 
     # Transfer files
     if args.sources:
-        # Get source and destination paths
-        talk.status(
-            "Getting lists of source and destination paths", args.verbose
-        )
+        touchedDirectories = set()
 
-        _, fromFiles, toDirs, toFiles = transfer.getCorrespondingPathsLists(
-            args.sources, args.destination, args.verbose, args.quiet
-        )
+        # Number of directories to scan at once
+        scanJobs = max(cfgSettings.getint("ScanJobs", fallback=1), 1)
 
-        talk.success("Source and destination locations found", args.verbose)
+        # Load what's already on the device if we're asked to leave out
+        # files which are already there
+        if args.incremental:
+            manifestEntries = manifest.load(mntLoc, args.quiet)
+        else:
+            manifestEntries = None
 
-        # Filter out certain file types based on settings in config file
-        talk.status("Filtering out unwanted file types", args.verbose)
+        # Converted files already on the device must have been encoded
+        # just like we'd encode them now
+        encoderKey = manifest.getEncoderKey(encoderProfile.getArguments())
 
-        transfer.filterOutExtensions(
-            fromFiles, toFiles, cfgSettings, args.non_interactive
-        )
+        # Use the transcode cache if we're asked to
+        if cfgSettings.getint("UseTranscodeCache", fallback=0):
+            cacheDirectory = system.getCacheDirectoryPath()
+        else:
+            cacheDirectory = None
 
-        talk.success("Filtering complete", args.verbose)
+        # Remember what audio files are like between runs if we're asked
+        # to
+        if cfgSettings.getint("UseProbeCache", fallback=0):
+            probeDatabase = system.getProbeDatabasePath()
+        else:
+            probeDatabase = None
 
-        # Perform necessary audio file conversions
-        talk.status(
-            "Starting to convert any audio files that need it", args.verbose
+        # Number of conversions to run at once
+        jobs = system.getConversionJobs(args.jobs, cfgSettings)
+
+        # However stages overlap, don't run more FFmpegs than that
+        commands.setLimit("convert", jobs)
+
+        # Whether to copy while converting, and whether to make sure
+        # everything fits on the device first. Checking and sorting need
+        # the whole plan up front, so files can't be streamed from the
+        # scan.
+        copyWhileConverting = cfgSettings.getint(
+            "CopyWhileConverting", fallback=0
         )
+        checkSpace = cfgSettings.getint("CheckFreeSpace", fallback=0)
 
-        # Returns a list of temporary files to remove later
-        tmpFiles = transfer.convertAudioFiles(
-            fromFiles,
-            toFiles,
-            cfgSettings,
-            args.non_interactive,
-            args.verbose,
+        # Show how far we've got if we're asked to, unless every file is
+        # being printed anyway
+        progress = talk.Progress(
+            cfgSettings.getint("ShowProgress", fallback=0)
+            and not (args.verbose or args.quiet)
+        )
+
+        # Flush files to the devices as they're written, so that
+        # unmounting doesn't sit there writing them out
+        flusher = flush.Flusher(
+            cfgSettings.getint("FlushAheadSize", fallback=0) * cache.MIB,
             args.quiet,
         )
 
-        talk.success("Conversions finished", args.verbose)
+        if (
+            copyWhileConverting
+            and not (checkSpace or sortedCreation)
+            and len(devices) == 1
+        ):
+            # Convert and copy files as the sources are scanned
+            talk.status(
+                "Scanning, converting, and copying files", args.verbose
+            )
+
+            pendingEntries = []
 
-        # Create necessary directories to transfer to
-        talk.status("Creating destination directories", args.verbose)
+            # Scanning, converting, and copying all overlap, so they're
+            # timed as one stage
+            profiler.startStage("transfer")
 
-        transfer.createDirectories(
-            toDirs, args.non_interactive, args.verbose, args.quiet
-        )
+            transferredFiles = transfer.transferFiles(
+                streamFiles(
+                    args,
+                    cfgSettings,
+                    mntLoc,
+                    scanJobs,
+                    manifestEntries,
+                    pendingEntries,
+                    touchedDirectories,
+                    encoderKey,
+                ),
+                cfgSettings,
+                args.non_interactive,
+                args.verbose,
+                args.quiet,
+                jobs,
+                cacheDirectory,
+                profiler,
+                progress,
+                probeDatabase,
+                flusher,
+            )
 
-        talk.success("Destination directories created", args.verbose)
+            progress.finish()
 
-        # Copy source files to destination
-        talk.status("Copying files", args.verbose)
+            profiler.endStage("transfer", len(transferredFiles))
 
-        transfer.copyFiles(
-            fromFiles,
-            toFiles,
-            cfgSettings,
-            args.non_interactive,
-            args.verbose,
-            args.quiet,
-        )
+            talk.success("Files converted and copied", args.verbose)
+        else:
+            # Get source and destination paths for the first
+            # destination. Other destinations get copies of the plan.
+            talk.status(
+                "Getting lists of source and destination paths", args.verbose
+            )
+
+            profiler.startStage("scan")
+
+            transferPlan = plan.getTransferPlan(
+                args.sources,
+                args.destination,
+                args.verbose,
+                args.quiet,
+                scanJobs,
+            )
+
+            profiler.endStage("scan", len(transferPlan.files))
+
+            talk.success(
+                "Source and destination locations found", args.verbose
+            )
+
+            # Filter out certain file types based on settings in config
+            # file
+            talk.status("Filtering out unwanted file types", args.verbose)
+
+            profiler.startStage("filter")
+
+            transfer.filterOutExtensions(
+                transferPlan, cfgSettings, args.non_interactive
+            )
+
+            profiler.endStage("filter", len(transferPlan.files))
+
+            talk.success("Filtering complete", args.verbose)
+
+            # Leave out files which are already on the device if we're
+            # asked to
+            if args.incremental:
+                talk.status("Comparing files against manifest", args.verbose)
+
+                profiler.startStage("compare")
+
+                pendingEntries = manifest.filterUnchangedFiles(
+                    transferPlan,
+                    manifestEntries,
+                    mntLoc,
+                    args.verbose,
+                    encoderKey,
+                )
+
+                profiler.endStage("compare", len(transferPlan.files))
+
+                talk.success(
+                    "%d new or changed files found" % len(pendingEntries),
+                    args.verbose,
+                )
+
+            # Make sure everything fits on every device before doing
+            # anything expensive. If we're trimming, keep only what fits
+            # on the fullest device, so that every device gets the same
+            # files.
+            if checkSpace:
+                talk.status("Estimating space needed", args.verbose)
+
+                profiler.startStage("estimate")
+
+                conversionOptions = transfer.getConversionOptions(
+                    cfgSettings, args.non_interactive
+                )
+                trimsetting = capacity.getTrimSetting(
+                    cfgSettings, args.non_interactive
+                )
+                overwritesetting = transfer.getOverwriteSetting(
+                    cfgSettings, args.non_interactive
+                )
+                fileCount = len(transferPlan.files)
+
+                for devicePlan, (_, _, deviceMntLoc) in zip(
+                    getDevicePlans(transferPlan, args.destination, devices),
+                    devices,
+                ):
+                    fits, _ = capacity.checkFreeSpace(
+                        devicePlan,
+                        conversionOptions,
+                        deviceMntLoc,
+                        trimsetting,
+                        args.verbose,
+                        args.quiet,
+                        jobs,
+                        probeDatabase,
+                        encoderProfile.getEstimatedBitrate(),
+                        overwritesetting,
+                    )
+
+                    if not fits:
+                        # Failure
+                        talk.error(
+                            "not enough space on %s!" % deviceMntLoc,
+                            args.quiet,
+                        )
+                        system.abort(1)
+
+                    fileCount = min(fileCount, len(devicePlan.files))
+
+                # Plans are trimmed in natural order
+                if fileCount < len(transferPlan.files):
+                    transferPlan.sort()
+                    transferPlan.trim(fileCount)
+
+                profiler.endStage("estimate", len(transferPlan.files))
+
+                talk.success("Transfer fits", args.verbose)
+
+            # Conversions are shared between devices, so they can't be
+            # written straight to any one of them
+            if len(devices) > 1:
+                cfgSettings["ConvertDirectlyToDestination"] = "0"
+
+            # Create entries in sorted order if we're asked to
+            if sortedCreation:
+                transferPlan.sort()
+
+            devicePlans = getDevicePlans(
+                transferPlan, args.destination, devices
+            )
+
+            # Work out whether each device is left sorted, and where
+            # entries go, for sorting later. Creating entries in sorted
+            # order leaves a device sorted unless we add entries to
+            # directories which already had some, or write the manifest
+            # (which goes into the device's root). Note that
+            # getUnsortedDirectories has to see the device before
+            # anything's created on it.
+            deviceStates = [
+                (
+                    bool(sortedCreation)
+                    and not (
+                        args.incremental
+                        or fatsort.getUnsortedDirectories(devicePlan)
+                    ),
+                    plan.getTouchedDirectories(
+                        devicePlan.directories + devicePlan.files
+                    ),
+                )
+                for devicePlan in devicePlans
+            ]
+
+            # Entries for destinations sharing a device aren't created in
+            # any particular order relative to each other
+            deviceLocations = [device[1] for device in devices]
+
+            for index, deviceLocation in enumerate(deviceLocations):
+                if deviceLocations.count(deviceLocation) > 1:
+                    deviceStates[index] = (False, deviceStates[index][1])
+
+            # The manifest adds to the first device's directories
+            touchedDirectories = deviceStates[0][1]
+
+            # Create necessary directories to transfer to. Do this
+            # before converting, since conversions can be written
+            # straight to their destinations.
+            talk.status("Creating destination directories", args.verbose)
+
+            destinationDirectories = [
+                directory
+                for devicePlan in devicePlans
+                for directory in devicePlan.getDestinationDirectories()
+            ]
+
+            profiler.startStage("mkdir")
+
+            transfer.createDirectories(
+                destinationDirectories,
+                args.non_interactive,
+                args.verbose,
+                args.quiet,
+            )
+
+            profiler.endStage("mkdir", len(destinationDirectories))
+
+            talk.success("Destination directories created", args.verbose)
+
+            if (
+                copyWhileConverting
+                and not sortedCreation
+                and len(devices) == 1
+            ):
+                # Convert and copy at the same time. Copies happen in
+                # whatever order conversions finish, so this isn't done
+                # when creating entries in sorted order.
+                talk.status("Converting and copying files", args.verbose)
+
+                profiler.startStage("transfer")
+
+                transferredFiles = transfer.transferFiles(
+                    transferPlan.files,
+                    cfgSettings,
+                    args.non_interactive,
+                    args.verbose,
+                    args.quiet,
+                    jobs,
+                    cacheDirectory,
+                    profiler,
+                    progress,
+                    probeDatabase,
+                    flusher,
+                )
+
+                progress.finish()
+
+                profiler.endStage("transfer", len(transferredFiles))
+
+                talk.success("Files converted and copied", args.verbose)
+            else:
+                # Perform necessary audio file conversions, once however
+                # many devices there are
+                talk.status(
+                    "Starting to convert any audio files that need it",
+                    args.verbose,
+                )
+
+                profiler.startStage("convert")
+                fileCount = len(transferPlan.files)
+
+                # With one device, files are done once they're converted
+                # straight to it (or left alone) or copied. With several,
+                # they're done once they're copied to each.
+                if len(devices) == 1:
+                    convertProgress = progress
+                    progress.addFiles(fileCount)
+                else:
+                    convertProgress = None
+
+                # Returns a list of temporary files to remove later
+                tmpFiles = transfer.convertAudioFiles(
+                    transferPlan,
+                    cfgSettings,
+                    args.non_interactive,
+                    args.verbose,
+                    args.quiet,
+                    jobs,
+                    cacheDirectory,
+                    profiler,
+                    convertProgress,
+                    probeDatabase,
+                    flusher,
+                )
+
+                profiler.endStage("convert", fileCount)
+
+                talk.success("Conversions finished", args.verbose)
+
+                # Conversions change extensions, which can change the
+                # order files should be created in
+                if sortedCreation:
+                    transferPlan.sort()
+
+                if len(devices) > 1:
+                    progress.addFiles(len(transferPlan.files) * len(devices))
+
+                # Copy source files to destination
+                talk.status("Copying files", args.verbose)
+
+                profiler.startStage("copy")
+
+                copyToDevices(
+                    args,
+                    cfgSettings,
+                    getDevicePlans(transferPlan, args.destination, devices),
+                    devices,
+                    profiler,
+                    progress,
+                    flusher,
+                )
+
+                progress.finish()
+
+                profiler.endStage(
+                    "copy", len(transferPlan.files) * len(devices)
+                )
+
+                talk.success("Files copied", args.verbose)
+
+                # Delete temporary files
+                talk.status("Removing any temp files", args.verbose)
+
+                profiler.startStage("cleanup")
+
+                transfer.deleteFiles(tmpFiles)
+
+                profiler.endStage("cleanup", len(tmpFiles))
 
-        talk.success("Files copied", args.verbose)
+                talk.success("temp files removed", args.verbose)
 
-        # Delete temporary files
-        talk.status("Removing any temp files", args.verbose)
+        # Keep the transcode cache within its size cap
+        if cacheDirectory:
+            talk.status("Pruning transcode cache", args.verbose)
 
-        transfer.deleteFiles(tmpFiles)
+            profiler.startStage("prune")
 
-        talk.success("temp files removed", args.verbose)
+            cache.prune(
+                cacheDirectory,
+                cfgSettings.getint("TranscodeCacheSize", fallback=0)
+                * cache.MIB,
+                args.quiet,
+            )
+
+            profiler.endStage("prune")
+
+            talk.success("Transcode cache pruned", args.verbose)
+
+        # Record what we transferred
+        if args.incremental:
+            talk.status("Updating manifest", args.verbose)
+
+            profiler.startStage("manifest")
+
+            manifest.updateEntries(
+                manifestEntries, pendingEntries, mntLoc, encoderKey
+            )
+
+            # The manifest lives in the device's root
+            touchedDirectories.add(mntLoc)
+
+            manifestSaved = manifest.save(mntLoc, manifestEntries, args.quiet)
+
+            profiler.endStage("manifest", len(pendingEntries))
+
+            if manifestSaved:
+                talk.success("Manifest updated", args.verbose)
+
+        # Wait for everything we've written to reach the devices, showing
+        # how much is left
+        if flusher.enabled:
+            talk.status("Flushing copied files", args.verbose)
+
+            profiler.startStage("flush")
+
+            flusher.finish(talk.FlushProgress(progress.enabled))
+
+            profiler.endStage("flush", flusher.flushedFiles)
+
+            talk.success("Files flushed", args.verbose)
 
         # Delete source directories if asked we're asked to. Note that
         # deleteSourceSetting - 1 is equivalent to a prompt flag, given
@@ -174,41 +683,454 @@ def main():
             # Remove sources
             talk.status("Removing source files and directories", args.verbose)
 
+            profiler.startStage("delete")
+
             transfer.deletePaths(
                 args.sources, promptFlag, args.verbose, args.quiet
             )
 
+            profiler.endStage("delete")
+
             talk.success("source files and directories removed", args.verbose)
 
+    if deviceStates is None:
+        deviceStates = [(alreadySorted, touchedDirectories)]
+
+    # Label stages by device in the profile if there are several
+    if len(devices) > 1:
+        stageDevices = [device[1] for device in devices]
+    else:
+        stageDevices = [None]
+
     # If renaming directories, do so
     if args.rename or cfgSettings.getint("RenameByDefault"):
         talk.status("Renaming any matching directories", args.verbose)
 
-        rename.rename(mntLoc, args.quiet)
+        for index, (_, devLoc, mntLoc) in enumerate(devices):
+            profiler.startStage("rename", device=stageDevices[index])
+
+            rename.rename(mntLoc, args.quiet)
+
+            profiler.endStage("rename", device=stageDevices[index])
+
+            # Renaming creates new entries, so can't be trusted to keep
+            # the device sorted. Directories are renamed in the
+            # device's root.
+            touchedDirectories = deviceStates[index][1]
+
+            if touchedDirectories is not None:
+                touchedDirectories.add(mntLoc)
+
+            deviceStates[index] = (False, touchedDirectories)
 
         talk.success("Matching directories renamed", args.verbose)
 
-    # Unmount and fatsort if we're asked to
-    if not args.no_sort:
+    # Sort each device once, even if several destinations are on it
+    sortJobs = {}
+
+    for (_, devLoc, mntLoc), (alreadySorted, touchedDirectories), label in zip(
+        devices, deviceStates, stageDevices
+    ):
+        if devLoc in sortJobs:
+            _, sortedBefore, touchedBefore, _ = sortJobs[devLoc]
+
+            # Unknown touched directories mean sorting everything
+            if touchedBefore is None or touchedDirectories is None:
+                touchedDirectories = None
+            else:
+                touchedDirectories = touchedBefore | touchedDirectories
+
+            alreadySorted = alreadySorted and sortedBefore
+
+        sortJobs[devLoc] = (mntLoc, alreadySorted, touchedDirectories, label)
+
+    # Unmount and sort all the devices at once
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(sortJobs)
+    ) as executor:
+        sortFutures = [
+            executor.submit(
+                sortDevice,
+                args,
+                cfgSettings,
+                devLoc,
+                mntLoc,
+                alreadySorted,
+                touchedDirectories,
+                sortedCreation,
+                profiler,
+                label,
+            )
+            for devLoc, (
+                mntLoc,
+                alreadySorted,
+                touchedDirectories,
+                label,
+            ) in sortJobs.items()
+        ]
+
+    if not all(future.result() for future in sortFutures):
+        system.abort(1)
+
+    # Successful run
+    talk.success("All done", args.verbose)
+
+    return
+
+
+def sortDevice(
+    args,
+    cfgSettings,
+    devLoc,
+    mntLoc,
+    alreadySorted,
+    touchedDirectories,
+    sortedCreation,
+    profiler,
+    stageDevice=None,
+):
+    """Unmount and fatsort a device if it needs it.
+
+    Args:
+        args: An argparse.Namespace object containing runtime
+            arguments.
+        cfgSettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+        devLoc: A string containing the device location.
+        mntLoc: A string containing the mount location of the device.
+        alreadySorted: A boolean signalling whether the device is known
+            to be sorted already.
+        touchedDirectories: A set of strings containing the paths of
+            the directories this run added entries to, or None if we
+            don't know.
+        sortedCreation: An integer signalling whether entries were
+            created in sorted order, in which case directories are
+            sorted in natural order.
+        profiler: A 'profiling.Profiler' object to time stages with.
+        stageDevice: An optional string to label the profiler's stages
+            with, when several devices are sorted at once.
+
+    Returns:
+        A boolean signalling whether nothing went wrong.
+    """
+    # Work out which directories to sort, if we're asked to only sort
+    # those we touched
+    if touchedDirectories is not None and cfgSettings.getint(
+        "SortTouchedDirectoriesOnly", fallback=0
+    ):
+        sortDirectories = fatsort.getRelativePaths(touchedDirectories, mntLoc)
+    else:
+        sortDirectories = None
+
+    # Check whether the device needs sorting at all if we're asked to.
+    # This is much quicker than unmounting and sorting.
+    if (
+        not (alreadySorted or args.no_sort or sortDirectories == [])
+        and cfgSettings.getint("CheckIfSorted", fallback=0)
+    ):
+        talk.status("Checking whether %s is sorted" % mntLoc, args.verbose)
+
+        profiler.startStage("check", device=stageDevice)
+
+        unsortedCount = fatsort.countUnsortedDirectories(
+            devLoc, sortDirectories, sortedCreation, args.quiet
+        )
+
+        profiler.endStage("check", device=stageDevice)
+
+        if unsortedCount is not None:
+            talk.status(
+                "%d directories need sorting" % unsortedCount, args.verbose
+            )
+
+            alreadySorted = not unsortedCount
+
+    # Unmount and fatsort if we're asked to and the device isn't
+    # already sorted
+    if alreadySorted:
+        talk.success(
+            "%s already sorted; no need to fatsort" % mntLoc, args.verbose
+        )
+    elif sortDirectories == []:
+        talk.success(
+            "No directories touched; no need to fatsort", args.verbose
+        )
+    elif not args.no_sort:
         # Unmount
         talk.status("Unmounting %s" % mntLoc, args.verbose)
 
-        if not fatsort.unmount(devLoc, args.verbose):
+        profiler.startStage("unmount", device=stageDevice)
+
+        unmounted = fatsort.unmount(devLoc, args.verbose)
+
+        profiler.endStage("unmount", device=stageDevice)
+
+        if not unmounted:
             talk.error("Failed to unmount %s!" % mntLoc, args.quiet)
-            system.abort(1)
+            return False
         else:
             talk.success("%s unmounted" % mntLoc, args.verbose)
 
         # Fatsort
         talk.status("fatsorting %s" % mntLoc, args.quiet)
 
-        if not fatsort.fatsort(devLoc, args.verbose):
+        profiler.startStage("fatsort", device=stageDevice)
+
+        fatsorted = fatsort.fatsort(
+            devLoc,
+            args.quiet,
+            sortedCreation,
+            cfgSettings.get("SortBackend", fallback="fatsort"),
+            sortDirectories,
+        )
+
+        profiler.endStage("fatsort", device=stageDevice)
+
+        if not fatsorted:
             talk.error("Failed to fatsort %s!" % mntLoc, args.quiet)
-            system.abort(1)
+            return False
         else:
             talk.success("%s fatsorted" % mntLoc, args.verbose)
 
-    # Successful run
-    talk.success("All done", args.verbose)
+    return True
+
+
+def getDevicePlans(transferPlan, destination, devices):
+    """Return the plan for each of several destinations.
+
+    Args:
+        transferPlan: A 'plan.TransferPlan' object made for one of the
+            destinations.
+        destination: A string containing the destination transferPlan
+            was made for.
+        devices: A list of 3-tuples of ("destination", "devLoc",
+            "mntLoc") for each destination.
+
+    Returns:
+        A list of 'plan.TransferPlan's in the same order as devices.
+        The plan for the destination transferPlan was made for is
+        transferPlan itself; the others are copies of it.
+    """
+    return [
+        transferPlan
+        if deviceDestination == destination
+        else transferPlan.rebase(destination, deviceDestination)
+        for deviceDestination, _, _ in devices
+    ]
+
+
+def copyToDevices(
+    args, cfgSettings, devicePlans, devices, profiler, progress, flusher
+):
+    """Copy files to several destinations, with one writer per device.
+
+    Destinations on the same device are copied to one after another, and
+    different devices are copied to at the same time.
+
+    Args:
+        args: An argparse.Namespace object containing runtime
+            arguments.
+        cfgSettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+        devicePlans: A list of 'plan.TransferPlan's for each destination,
+            as returned by getDevicePlans.
+        devices: A list of 3-tuples of ("destination", "devLoc",
+            "mntLoc") for each destination.
+        profiler: A 'profiling.Profiler' object to time copies with.
+        progress: A 'talk.Progress' object to count each file copied as
+            done on.
+        flusher: A 'flush.Flusher' object to flush each file copied
+            with.
+    """
+    # Group the plans by device
+    plansByDevice = collections.OrderedDict()
+
+    for devicePlan, (_, devLoc, _) in zip(devicePlans, devices):
+        plansByDevice.setdefault(devLoc, []).append(devicePlan)
+
+    def writeToDevice(plans):
+        """Copy files for the destinations on a single device."""
+        for devicePlan in plans:
+            transfer.copyFiles(
+                devicePlan,
+                cfgSettings,
+                args.non_interactive,
+                args.verbose,
+                args.quiet,
+                profiler,
+                progress,
+                flusher,
+            )
+
+    if len(plansByDevice) == 1:
+        writeToDevice(devicePlans)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(plansByDevice)
+    ) as executor:
+        for future in [
+            executor.submit(writeToDevice, plans)
+            for plans in plansByDevice.values()
+        ]:
+            future.result()
+
+    return
+
+
+def streamFiles(
+    args,
+    cfgSettings,
+    mntLoc,
+    scanJobs,
+    manifestEntries,
+    pendingEntries,
+    touchedDirectories,
+    encoderKey=None,
+):
+    """Generate the files to transfer while the sources are scanned.
+
+    Does the work of getting a transfer plan, filtering out unwanted
+    files, comparing files against the manifest, and creating
+    destination directories, but one directory at a time, so that
+    transferring can start before scanning is done.
+
+    Args:
+        args: An argparse.Namespace object containing runtime
+            arguments.
+        cfgSettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+        mntLoc: A string containing the mount location of the device.
+        scanJobs: An integer specifying how many directories to scan at
+            the same time.
+        manifestEntries: A dictionary containing the manifest's entries,
+            or None if the transfer isn't incremental.
+        pendingEntries: A list to add the manifest's pending entries to,
+            as returned by manifest.getPendingEntry. This is updated in
+            place.
+        touchedDirectories: A set to add the destination directories
+            entries are created in to. This is updated in place.
+        encoderKey: An optional string (as returned by
+            manifest.getEncoderKey) identifying the FFmpeg arguments
+            files are encoded with.
+
+    Yields:
+        'plan.FileRecord's for the files to transfer.
+    """
+    isWanted = transfer.getExtensionFilter(cfgSettings, args.non_interactive)
+
+    for record in plan.scanSources(
+        args.sources, args.destination, args.verbose, args.quiet, scanJobs
+    ):
+        if isinstance(record, plan.DirectoryRecord):
+            touchedDirectories.update(plan.getTouchedDirectories([record]))
+
+            # Create the directory before any of its files arrive
+            transfer.createDirectories(
+                [record.destination],
+                args.non_interactive,
+                args.verbose,
+                args.quiet,
+            )
+
+            continue
+
+        if not isWanted(record):
+            continue
+
+        # Leave out files which are already on the device if we're asked
+        # to
+        if manifestEntries is not None:
+            pendingEntry = manifest.getPendingEntry(
+                record, manifestEntries, mntLoc, args.verbose, encoderKey
+            )
+
+            if pendingEntry is None:
+                continue
+            elif pendingEntry:
+                pendingEntries += [pendingEntry]
+
+        touchedDirectories.update(plan.getTouchedDirectories([record]))
+
+        yield record
+
+
+def writeProfile(profiler, reportPath, verbose=False, quiet=False):
+    """Write a profiler's report, saying whether it worked.
+
+    Args:
+        profiler: A 'profiling.Profiler' object.
+        reportPath: A string containing the path of the report file.
+        verbose: An optional boolean toggling whether to give extra
+            output.
+        quiet: An optional boolean toggling whether to omit error
+            output.
+    """
+    if profiler.write(reportPath):
+        talk.success("Profile written to %s" % reportPath, verbose)
+    else:
+        talk.error("Failed to write profile to %s!" % reportPath, quiet)
+
+
+def cacheCommand(args):
+    """Show statistics for or prune the transcode and probe caches."""
+    # Read the configuration file
+    cfgSettings = system.getConfigurationSettings(
+        args.config_file, args.default, args.quiet
+    )
+    if not cfgSettings:
+        # Failure
+        system.abort(1)
+
+    cacheDirectory = system.getCacheDirectoryPath()
+
+    if args.max_size is None:
+        maxBytes = cfgSettings.getint("TranscodeCacheSize", fallback=0)
+        maxBytes *= cache.MIB
+    else:
+        maxBytes = args.max_size * cache.MIB
+
+    if args.action == "prune":
+        # Evict old entries
+        removedCount, removedBytes = cache.prune(
+            cacheDirectory, maxBytes, args.quiet
+        )
+
+        if not args.quiet:
+            print(
+                "Removed %d entries (%.1f MiB)"
+                % (removedCount, removedBytes / cache.MIB)
+            )
+
+        # Forget about audio files which are gone
+        probeCache = probe.openCache(
+            system.getProbeDatabasePath(), True, False
+        )
+
+        if probeCache:
+            forgottenCount = probeCache.prune()
+            probeCache.close()
+
+            if not args.quiet:
+                print("Forgot %d probed files" % forgottenCount)
+    else:
+        # Print statistics
+        entryCount, totalBytes = cache.getStats(cacheDirectory)
+
+        print("Cache directory: %s" % cacheDirectory)
+        print("Entries: %d" % entryCount)
+        print(
+            "Size: %.1f MiB of %.1f MiB"
+            % (totalBytes / cache.MIB, maxBytes / cache.MIB)
+        )
+
+        # Audio files we know about
+        probeCache = probe.openCache(
+            system.getProbeDatabasePath(), True, False
+        )
+
+        if probeCache:
+            print("Probed files: %d" % probeCache.getCount())
+            probeCache.close()
 
     return
@@ -0,0 +1,266 @@
+"""Contains functions for keeping track of what's already on a device.
+
+For incremental transfers we keep a manifest in the root of the device.
+It maps each destination path (relative to the mount location, and as
+it was before any conversion) to a list of
+
+    [source size, source mtime in ns, source SHA-256, final destination,
+     encoder key]
+
+where the final destination is where the file actually ended up (for
+example, with an .mp3 extension after conversion), again relative to
+the mount location, and the encoder key identifies the FFmpeg arguments
+a converted file was made with (see getEncoderKey), or is null if the
+file was copied as is. Converted files made with other arguments count
+as changed. Manifests from older versions have no encoder keys, so
+converted files they list count as changed too.
+"""
+
+import hashlib
+import json
+import os
+from . import cache
+from . import talk
+
+# Name of the manifest file in the root of the device
+MANIFEST_NAME = ".transfat-manifest.json"
+
+# Version of the manifest format
+MANIFEST_VERSION = 1
+
+
+def getManifestPath(mountLocation):
+    """Return the path of the manifest on a device."""
+    return os.path.join(mountLocation, MANIFEST_NAME)
+
+
+def load(mountLocation, quiet=False):
+    """Load the manifest from a device.
+
+    Args:
+        mountLocation: A string containing the mount location of the
+            device.
+        quiet: An optional boolean toggling whether to omit error
+            output.
+
+    Returns:
+        A dictionary containing the manifest's entries. This is empty if
+        there's no manifest or it can't be read.
+    """
+    try:
+        with open(getManifestPath(mountLocation), "r") as manifestFile:
+            manifest = json.load(manifestFile)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError):
+        talk.error("Failed to read manifest; starting afresh", quiet)
+        return {}
+
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+
+    return manifest.get("files", {})
+
+
+def save(mountLocation, entries, quiet=False):
+    """Save a manifest to a device and return whether it succeeded.
+
+    The manifest is written to a temporary file first and then moved
+    into place, so a failed write doesn't destroy the old manifest.
+
+    Args:
+        mountLocation: A string containing the mount location of the
+            device.
+        entries: A dictionary containing the manifest's entries.
+        quiet: An optional boolean toggling whether to omit error
+            output.
+    """
+    manifestPath = getManifestPath(mountLocation)
+    tmpPath = manifestPath + ".part"
+
+    try:
+        with open(tmpPath, "w") as manifestFile:
+            json.dump(
+                {"version": MANIFEST_VERSION, "files": entries},
+                manifestFile,
+                separators=(",", ":"),
+            )
+        os.replace(tmpPath, manifestPath)
+    except OSError:
+        talk.error("Failed to write manifest %s!" % manifestPath, quiet)
+        return False
+
+    return True
+
+
+def getEncoderKey(encoderArguments):
+    """Return a string identifying the FFmpeg arguments files encode with.
+
+    Args:
+        encoderArguments: A list of strings containing the FFmpeg
+            arguments which determine the output (codec, quality, and so
+            on).
+    """
+    return hashlib.sha256(
+        "\0".join(encoderArguments).encode("utf-8")
+    ).hexdigest()
+
+
+def filterUnchangedFiles(
+    plan, entries, mountLocation, verbose=False, encoderKey=None
+):
+    """Remove files which are already on the device from a plan.
+
+    Args:
+        plan: A 'plan.TransferPlan' object containing the files to
+            transfer.
+        entries: A dictionary containing the manifest's entries.
+        mountLocation: A string containing the mount location of the
+            device.
+        verbose: An optional boolean toggling whether to give extra
+            output.
+        encoderKey: An optional string (as returned by getEncoderKey)
+            identifying the FFmpeg arguments files are encoded with.
+            If given, converted files on the device encoded otherwise
+            count as changed.
+
+    Returns:
+        A list of 5-tuples as returned by getPendingEntry for each file
+        which remains to be transferred, to pass to updateEntries once
+        the transfer is done. The work performed on the plan is done in
+        place.
+    """
+    pending = []
+    unchangedFiles = []
+
+    for record in plan.files:
+        pendingEntry = getPendingEntry(
+            record, entries, mountLocation, verbose, encoderKey
+        )
+
+        if pendingEntry is None:
+            unchangedFiles += [record]
+        elif pendingEntry:
+            pending += [pendingEntry]
+
+    # Remove unchanged files from the plan
+    plan.removeFiles(unchangedFiles)
+
+    return pending
+
+
+def getPendingEntry(
+    record, entries, mountLocation, verbose=False, encoderKey=None
+):
+    """Check whether a file is already on the device.
+
+    A file counts as already being on the device if its final
+    destination exists and its source has the same size and mtime as
+    recorded in the manifest. If only the mtime changed, the source is
+    hashed and compared against the recorded hash. If the file was
+    converted, it must also have been encoded with the same FFmpeg
+    arguments.
+
+    Args:
+        record: A 'plan.FileRecord' object for the file to transfer.
+        entries: A dictionary containing the manifest's entries.
+        mountLocation: A string containing the mount location of the
+            device.
+        verbose: An optional boolean toggling whether to give extra
+            output.
+        encoderKey: An optional string (as returned by getEncoderKey)
+            identifying the FFmpeg arguments files are encoded with.
+
+    Returns:
+        None if the file is already on the device. Otherwise, a 5-tuple
+        of ("key", "source", record, size, mtime) to pass to
+        updateEntries once the transfer is done, or an empty tuple if
+        the source can't be read (the transfer can deal with that).
+    """
+    source = record.source
+    key = os.path.relpath(record.destination, mountLocation)
+
+    try:
+        stat = os.stat(source)
+    except OSError:
+        # Let the transfer deal with it
+        return ()
+
+    entry = entries.get(key)
+
+    # Converted files encoded with other arguments are out of date. Older
+    # manifests don't say what their files were encoded with.
+    if (
+        entry
+        and encoderKey is not None
+        and entry[3] != key
+        and entry[4:5] != [encoderKey]
+    ):
+        entry = None
+
+    if entry and os.path.exists(os.path.join(mountLocation, entry[3])):
+        size, mtime, hash_ = entry[:3]
+
+        if stat.st_size == size and stat.st_mtime_ns != mtime:
+            # Compare contents. Keep the hash for updateEntries in case
+            # they've changed.
+            record.sourceHash = safeHashFile(source)
+
+        if stat.st_size == size and (
+            stat.st_mtime_ns == mtime or record.sourceHash == hash_
+        ):
+            # Already on the device
+            talk.status("%s is unchanged" % source, verbose)
+
+            # Remember the new mtime so we don't hash again
+            entry[1] = stat.st_mtime_ns
+
+            return None
+
+    return (key, source, record, stat.st_size, stat.st_mtime_ns)
+
+
+def updateEntries(entries, pending, mountLocation, encoderKey=None):
+    """Record transferred files in the manifest's entries.
+
+    Where each file ended up, and its source's hash if that was worked
+    out during the transfer, are taken from its record. Only sources
+    whose hash isn't known yet are read again. Files which weren't
+    transferred (because they failed to, say) aren't recorded.
+
+    Args:
+        entries: A dictionary containing the manifest's entries. This is
+            updated in place.
+        pending: A list of 5-tuples as returned by getPendingEntry.
+        mountLocation: A string containing the mount location of the
+            device.
+        encoderKey: An optional string (as returned by getEncoderKey)
+            identifying the FFmpeg arguments files were encoded with.
+    """
+    for key, source, record, size, mtime in pending:
+        if record.finalDestination is None:
+            # Didn't make it
+            continue
+
+        hash_ = record.sourceHash or safeHashFile(source)
+
+        if hash_ is None:
+            continue
+
+        finalKey = os.path.relpath(record.finalDestination, mountLocation)
+
+        # Files which ended up somewhere else were converted
+        if finalKey != key:
+            entries[key] = [size, mtime, hash_, finalKey, encoderKey]
+        else:
+            entries[key] = [size, mtime, hash_, finalKey, None]
+
+    return
+
+
+def safeHashFile(path):
+    """Return the hash of a file, or None if it can't be read."""
+    try:
+        return cache.hashFile(path)
+    except OSError:
+        return None
@@ -0,0 +1,246 @@
+"""Contains functions for finding out what's mounted where.
+
+The mount table is read straight from /proc/self/mountinfo rather than
+from the output of mount, so mount points containing spaces or
+non-ASCII characters survive intact. It's read once per run; call
+getMounts.cache_clear() after mounting or unmounting anything.
+
+Benchmarks and tests can point MOUNTINFO_PATH at a mount table of their
+own before anything's read.
+"""
+
+import functools
+import os
+import re
+
+# Location of the mount table
+MOUNTINFO_PATH = "/proc/self/mountinfo"
+
+# Filesystem types which are FAT
+FAT_FILESYSTEM_TYPES = ("vfat", "msdos")
+
+# Stands in for a block size which hasn't been looked up yet
+NOT_LOOKED_UP = object()
+
+# Matches the octal escapes the kernel uses for spaces, tabs, newlines,
+# and backslashes in paths
+OCTAL_ESCAPE_REGEX = re.compile(rb"\\([0-7]{3})")
+
+
+class Mount:
+    """A mounted filesystem.
+
+    Attributes:
+        device: A string containing the mount source, usually a device
+            location like /dev/sdb1.
+        mountPoint: A string containing the mount location.
+        filesystemType: A string containing the filesystem type, like
+            "vfat".
+        options: A list of strings containing the mount options, both
+            those of the mount point and those of the filesystem, like
+            ["rw", "noatime", "fmask=0022"].
+        blockSize: An integer containing the filesystem's preferred
+            block size for I/O in bytes (the cluster size on FAT), or
+            None if it couldn't be found out. It's only looked up when
+            it's first asked for, since statting some filesystems
+            (network filesystems, say) can be slow.
+    """
+
+    __slots__ = (
+        "device",
+        "mountPoint",
+        "filesystemType",
+        "options",
+        "statBlockSize",
+    )
+
+    def __init__(self, device, mountPoint, filesystemType, options=()):
+        """Initialize a mount, leaving its block size until needed."""
+        self.device = device
+        self.mountPoint = mountPoint
+        self.filesystemType = filesystemType
+        self.options = list(options)
+        self.statBlockSize = NOT_LOOKED_UP
+
+    def __repr__(self):
+        return "Mount(%r, %r, %r)" % (
+            self.device,
+            self.mountPoint,
+            self.filesystemType,
+        )
+
+    @property
+    def blockSize(self):
+        """Return the filesystem's block size, looking it up if need be."""
+        if self.statBlockSize is NOT_LOOKED_UP:
+            try:
+                self.statBlockSize = os.statvfs(self.mountPoint).f_bsize
+            except OSError:
+                self.statBlockSize = None
+
+        return self.statBlockSize
+
+    def isFat(self):
+        """Return whether the filesystem is FAT."""
+        return self.filesystemType in FAT_FILESYSTEM_TYPES
+
+    def getOption(self, name):
+        """Return the value of a mount option like "uid=1000".
+
+        Returns True for options without values (like "rw") which are
+        present, and None for options which aren't.
+        """
+        for option in self.options:
+            key, equals, value = option.partition("=")
+
+            if key == name:
+                return value if equals else True
+
+        return None
+
+
+def unescape(field):
+    """Return a string with a mount table field's escapes decoded.
+
+    Args:
+        field: A bytes object containing a field from the mount table.
+
+    Returns:
+        A string, decoded like any other path from the filesystem.
+    """
+    return os.fsdecode(
+        OCTAL_ESCAPE_REGEX.sub(
+            lambda match: bytes((int(match.group(1), 8),)), field
+        )
+    )
+
+
+def parseMountInfo(data):
+    """Return the mounts listed in the contents of a mountinfo file.
+
+    Each line looks like
+
+        36 35 98:0 /mnt1 /mnt/parent rw,noatime master:1 - ext3 /dev/root rw
+
+    where the fields before the "-" describe the mount point (its mount
+    point and options are the fifth and sixth fields) and the fields
+    after it describe the filesystem (its type, source, and options).
+    See proc(5).
+
+    Args:
+        data: A bytes object containing the mountinfo file.
+
+    Returns:
+        A list of 'Mount's in the order they're listed, which is the
+        order they were mounted in.
+    """
+    mounts = []
+
+    for line in data.splitlines():
+        fields = line.split()
+
+        try:
+            separator = fields.index(b"-", 6)
+        except ValueError:
+            # Not a line we understand
+            continue
+
+        # Filesystems can have no options at all
+        filesystemFields = fields[separator + 1 :] + [b""]
+
+        if len(filesystemFields) < 3:
+            continue
+
+        filesystemType, source, superOptions = filesystemFields[:3]
+        options = [
+            option
+            for option in fields[5].split(b",") + superOptions.split(b",")
+            if option
+        ]
+
+        mounts.append(
+            Mount(
+                unescape(source),
+                unescape(fields[4]),
+                unescape(filesystemType),
+                [unescape(option) for option in options],
+            )
+        )
+
+    return mounts
+
+
+@functools.lru_cache(maxsize=None)
+def getMounts():
+    """Return the mounted filesystems.
+
+    Returns:
+        A tuple of 'Mount's in the order they were mounted in. This is
+        empty if the mount table can't be read.
+    """
+    try:
+        with open(MOUNTINFO_PATH, "rb") as mountInfoFile:
+            return tuple(parseMountInfo(mountInfoFile.read()))
+    except OSError:
+        return ()
+
+
+def findMount(path, mounts=None):
+    """Return the mount a path is on.
+
+    Args:
+        path: A string containing a path. It needn't exist yet.
+        mounts: An optional sequence of 'Mount's to look through.
+            Defaults to everything that's mounted.
+
+    Returns:
+        The 'Mount' with the longest mount point containing the path
+        (the last one mounted, if several share a mount point), or None
+        if there's no such mount.
+    """
+    if mounts is None:
+        mounts = getMounts()
+
+    path = os.path.abspath(path)
+    bestMount = None
+
+    for mount in mounts:
+        if os.path.commonpath((path, mount.mountPoint)) != mount.mountPoint:
+            continue
+
+        # Later mounts hide earlier ones at the same mount point
+        if bestMount is None or len(mount.mountPoint) >= len(
+            bestMount.mountPoint
+        ):
+            bestMount = mount
+
+    return bestMount
+
+
+def resolveDestinations(paths):
+    """Return the FAT mounts several destinations are on.
+
+    Args:
+        paths: An iterable of strings containing destination paths.
+
+    Returns:
+        A dictionary mapping each path to the FAT 'Mount' it's on, or to
+        None if it isn't on a FAT filesystem.
+    """
+    mounts = getMounts()
+    resolved = {}
+
+    for path in paths:
+        mount = findMount(path, mounts)
+
+        if mount is not None and mount.isFat():
+            resolved[path] = mount
+        else:
+            resolved[path] = None
+
+    return resolved
+
+
+def getFatMounts():
+    """Return a list of the FAT 'Mount's, in the order they were mounted."""
+    return [mount for mount in getMounts() if mount.isFat()]
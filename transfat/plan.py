@@ -0,0 +1,428 @@
+"""Contains the structures describing what a transfer is going to do.
+
+A transfer plan holds one compact record per file and per directory to
+transfer. Stages of a transfer work on the records themselves: they
+update a record's paths in place (after converting it, say) and remove
+records from the plan by identity, so nothing ever has to search a list
+for a path.
+"""
+
+import concurrent.futures
+import os
+import re
+from . import talk
+
+# Matches runs of digits and runs of everything else
+NATURAL_CHUNK_REGEX = re.compile(r"(\d+)|(\D+)")
+
+
+def getNaturalKey(name):
+    """Return a key which sorts names in natural order.
+
+    Like fatsort's natural, case-insensitive order, runs of digits
+    compare by their numeric value and letters compare regardless of
+    ASCII case; otherwise characters compare by code point. Names which
+    only differ in case or leading zeros are ordered by the names
+    themselves, so the order is always the same.
+    """
+    elements = []
+
+    for digits, text in NATURAL_CHUNK_REGEX.findall(name):
+        if digits:
+            # A number sorts where a digit character would
+            elements.append((ord("0"), int(digits)))
+        else:
+            elements.extend(
+                (ord(c.upper()),) if c < "\x80" else (ord(c),) for c in text
+            )
+
+    return (tuple(elements), name)
+
+
+def getPathKey(path):
+    """Return a key which sorts paths in natural order, parents first."""
+    return tuple(getNaturalKey(name) for name in path.split("/"))
+
+
+def getSuffix(path):
+    """Return the lowercase extension of a path, including the dot.
+
+    Unlike os.path.splitext, a name that starts with a dot (like
+    '.flac') counts as having that extension.
+    """
+    name = path[path.rfind("/") + 1 :]
+    dotIndex = name.rfind(".")
+
+    if dotIndex < 0:
+        return ""
+
+    return name[dotIndex:].lower()
+
+
+class FileRecord:
+    """A file to transfer.
+
+    Attributes:
+        source: A string containing the absolute path of the file to
+            copy to the destination. Conversions replace this with the
+            path of the converted file.
+        destination: A string containing the absolute path to copy the
+            file to.
+        suffix: A string containing the lowercase extension of the
+            destination, including the dot.
+        finalDestination: A string containing the absolute path the file
+            ended up at, once it's been transferred, or None.
+        sourceHash: A string containing the SHA-256 digest of the
+            original source, if it's been worked out along the way, or
+            None.
+    """
+
+    __slots__ = (
+        "source",
+        "destination",
+        "suffix",
+        "finalDestination",
+        "sourceHash",
+    )
+
+    def __init__(self, source, destination):
+        self.source = source
+        self.destination = destination
+        self.suffix = getSuffix(destination)
+        self.finalDestination = None
+        self.sourceHash = None
+
+    def __repr__(self):
+        return "FileRecord(%r, %r)" % (self.source, self.destination)
+
+    def setDestinationSuffix(self, suffix):
+        """Replace the extension of the destination with a new one."""
+        self.destination = (
+            self.destination[: len(self.destination) - len(self.suffix)]
+            + suffix
+        )
+        self.suffix = suffix
+
+
+class DirectoryRecord:
+    """A directory to transfer.
+
+    Attributes:
+        source: A string containing the absolute path of the source
+            directory.
+        destination: A string containing the absolute path of the
+            directory to create.
+    """
+
+    __slots__ = ("source", "destination")
+
+    def __init__(self, source, destination):
+        self.source = source
+        self.destination = destination
+
+    def __repr__(self):
+        return "DirectoryRecord(%r, %r)" % (self.source, self.destination)
+
+
+class TransferPlan:
+    """The files and directories to transfer.
+
+    Attributes:
+        directories: A list of DirectoryRecords, parents before their
+            children.
+        files: A list of FileRecords.
+    """
+
+    __slots__ = ("directories", "files")
+
+    def __init__(self):
+        self.directories = []
+        self.files = []
+
+    def __len__(self):
+        return len(self.files)
+
+    def getDestinationDirectories(self):
+        """Return a list of the destination directory paths."""
+        return [directory.destination for directory in self.directories]
+
+    def sort(self):
+        """Sort the plan's directories and files in natural order.
+
+        Directories keep their parents before their children.
+        """
+        self.directories.sort(
+            key=lambda directory: getPathKey(directory.destination)
+        )
+        self.files.sort(key=lambda record: getPathKey(record.destination))
+
+    def rebase(self, oldDestination, newDestination):
+        """Return a copy of the plan which transfers somewhere else.
+
+        Args:
+            oldDestination: A string containing the destination path the
+                plan was made for.
+            newDestination: A string containing the destination path to
+                transfer to instead.
+
+        Returns:
+            A new TransferPlan with new records, whose destinations are
+            under newDestination instead of oldDestination.
+        """
+        oldPrefixLength = len(os.path.abspath(oldDestination))
+        newPrefix = os.path.abspath(newDestination)
+
+        plan = TransferPlan()
+        plan.directories = [
+            DirectoryRecord(
+                directory.source,
+                newPrefix + directory.destination[oldPrefixLength:],
+            )
+            for directory in self.directories
+        ]
+        plan.files = [
+            FileRecord(
+                record.source, newPrefix + record.destination[oldPrefixLength:]
+            )
+            for record in self.files
+        ]
+
+        return plan
+
+    def removeFiles(self, records):
+        """Remove a collection of FileRecords from the plan."""
+        if not records:
+            return
+
+        unwanted = set(records)
+        self.files = [
+            record for record in self.files if record not in unwanted
+        ]
+
+    def trim(self, count):
+        """Keep only the first files of the plan.
+
+        Directories which only held files that were left out (directly
+        or in subdirectories) are left out too. Sort the plan first to
+        keep the same files every time.
+
+        Args:
+            count: An integer containing the number of files to keep.
+
+        Returns:
+            A list of the FileRecords left out.
+        """
+        trimmedFiles = self.files[count:]
+        self.files = self.files[:count]
+
+        if not trimmedFiles:
+            return trimmedFiles
+
+        # Directories holding files, including through subdirectories
+        keptDirectories = getAncestorDirectories(self.files)
+        trimmedDirectories = (
+            getAncestorDirectories(trimmedFiles) - keptDirectories
+        )
+
+        self.directories = [
+            directory
+            for directory in self.directories
+            if directory.destination not in trimmedDirectories
+        ]
+
+        return trimmedFiles
+
+
+def getAncestorDirectories(records):
+    """Return every directory some records' destinations are inside.
+
+    Args:
+        records: An iterable of FileRecords.
+
+    Returns:
+        A set of strings containing absolute paths.
+    """
+    ancestors = set()
+
+    for record in records:
+        directory = os.path.dirname(record.destination)
+
+        # Stop once we reach a directory we've seen, or the root
+        while directory not in ancestors and directory != "/":
+            ancestors.add(directory)
+            directory = os.path.dirname(directory)
+
+    return ancestors
+
+
+def getTouchedDirectories(records):
+    """Return the destination directories some records add entries to.
+
+    Args:
+        records: An iterable of FileRecords and DirectoryRecords.
+
+    Returns:
+        A set of strings containing the absolute paths of the
+        directories the records are created in, along with the
+        directories the DirectoryRecords create.
+    """
+    touched = set()
+
+    for record in records:
+        touched.add(os.path.dirname(record.destination))
+
+        if isinstance(record, DirectoryRecord):
+            touched.add(record.destination)
+
+    return touched
+
+
+def getTransferPlan(
+    sourcePaths, destinationPath, verbose=False, quiet=False, jobs=1
+):
+    """Return a plan for transferring sources to a destination.
+
+    Args:
+        sourcePaths: A list of strings containing source paths, which
+            can be files or directories.
+        destinationPath: A string containing a destination path for
+            where the source files/directories should be transfered to.
+        verbose: An optional boolean toggling whether to give extra
+            output.
+        quiet: An optional boolean toggling whether to omit error
+            output.
+        jobs: An optional integer specifying how many directories to
+            scan at the same time.
+
+    Returns:
+        A TransferPlan containing absolute paths.
+    """
+    plan = TransferPlan()
+
+    for record in scanSources(
+        sourcePaths, destinationPath, verbose, quiet, jobs
+    ):
+        if isinstance(record, DirectoryRecord):
+            plan.directories.append(record)
+        else:
+            plan.files.append(record)
+
+    return plan
+
+
+def scanSources(
+    sourcePaths, destinationPath, verbose=False, quiet=False, jobs=1
+):
+    """Generate records for everything to transfer as it's found.
+
+    Directories are scanned with os.scandir on a pool of threads, which
+    helps a lot on network filesystems. A DirectoryRecord is always
+    generated before the records of anything inside that directory, but
+    otherwise records are generated in whatever order the scans finish.
+
+    Like os.walk, symbolic links to directories are neither followed
+    nor transferred, and directories which can't be read are skipped.
+
+    Args:
+        sourcePaths: A list of strings containing source paths, which
+            can be files or directories.
+        destinationPath: A string containing a destination path for
+            where the source files/directories should be transfered to.
+        verbose: An optional boolean toggling whether to give extra
+            output.
+        quiet: An optional boolean toggling whether to omit error
+            output.
+        jobs: An optional integer specifying how many directories to
+            scan at the same time.
+
+    Yields:
+        DirectoryRecords and FileRecords containing absolute paths.
+    """
+    # Make sure source and destination paths are absolute paths
+    sourcePaths_ = [os.path.abspath(source) for source in sourcePaths]
+    destinationPath_ = os.path.abspath(destinationPath)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        # Directory scans in progress
+        scans = set()
+
+        # Go through each source
+        for source in sourcePaths_:
+            # Get the parent directory of the source so we can generate
+            # the destination path
+            parentlen = len(os.path.dirname(source))
+            destination = destinationPath_ + source[parentlen:]
+
+            # Determine whether the source is a file or directory
+            if os.path.isfile(source):
+                # The source is a file
+                yield FileRecord(source, destination)
+            elif os.path.isdir(source):
+                # The source is a directory, so scan it and everything
+                # inside of it
+                scans.add(executor.submit(scanDirectory, source, destination))
+            else:
+                # The source is neither a file nor directory. Give a
+                # warning.
+                talk.error("'%s' does not exist!" % source, quiet)
+                talk.status("Proceeding anyway", verbose)
+
+        # Hand out the results of each scan as it finishes, and scan the
+        # subdirectories it found
+        while scans:
+            finished, scans = concurrent.futures.wait(
+                scans, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+
+            for scan in finished:
+                directory, files, subdirectories = scan.result()
+
+                for subdirectory in subdirectories:
+                    scans.add(executor.submit(scanDirectory, *subdirectory))
+
+                if directory is not None:
+                    yield directory
+                    yield from files
+
+
+def scanDirectory(sourceDirectory, destinationDirectory):
+    """Scan a single directory.
+
+    Args:
+        sourceDirectory: A string containing the absolute path of the
+            directory to scan.
+        destinationDirectory: A string containing the absolute path to
+            transfer the directory to.
+
+    Returns:
+        A 3-tuple containing (directory, files, subdirectories) where
+        directory is a DirectoryRecord for the directory scanned (or
+        None if it couldn't be read), files is a list of FileRecords
+        for the files inside of it, and subdirectories is a list of
+        2-tuples of ("sourceDirectory", "destinationDirectory") for the
+        directories inside of it.
+    """
+    directory = DirectoryRecord(sourceDirectory, destinationDirectory)
+    files = []
+    subdirectories = []
+
+    destinationPrefix = destinationDirectory + "/"
+
+    try:
+        for entry in os.scandir(sourceDirectory):
+            # DirEntry caches the file type the directory listing gave
+            # us, so this usually doesn't need any extra system calls
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    subdirectories.append(
+                        (entry.path, destinationPrefix + entry.name)
+                    )
+            else:
+                files.append(
+                    FileRecord(entry.path, destinationPrefix + entry.name)
+                )
+    except OSError:
+        # Can't read this directory; skip it like os.walk does
+        return (None, [], [])
+
+    return (directory, files, subdirectories)
@@ -0,0 +1,465 @@
+"""Contains functions for finding out about audio files with ffprobe.
+
+Planning a transfer needs a few facts about each audio file: its codec,
+duration, bitrate, sample rate, and how big its embedded cover art is.
+Finding these out takes an ffprobe process per file, so they can be
+kept in an SQLite database between runs. Each file's facts are stored
+along with its size, modification time, and inode, and files are only
+probed again once any of those change.
+
+sqlite3 is only imported when the database is used, keeping startup
+quick.
+"""
+
+import json
+import os
+from . import commands
+from . import talk
+
+# Version of the database's layout. Databases with other versions are
+# started afresh.
+SCHEMA_VERSION = 1
+
+# Seconds to wait for another transfat to finish with the database
+DATABASE_TIMEOUT = 10
+
+# Extensions of containers we convert which can hold MP3 audio
+MP3_CONTAINER_EXTENSIONS = (".m4a", ".mp4")
+
+# What to ask ffprobe for. The packet is the first one in the file,
+# which is the cover art if there is any.
+PROBE_ENTRIES = (
+    "format=duration,bit_rate"
+    ":stream=index,codec_type,codec_name,sample_rate,bit_rate"
+    ":stream_disposition=attached_pic"
+    ":packet=stream_index,size"
+)
+
+
+class AudioInfo:
+    """Facts about an audio file.
+
+    Attributes:
+        codec: A string containing the name of the audio codec, like
+            "flac", or None if there's no audio stream.
+        duration: A float containing the duration in seconds, or None if
+            it isn't known.
+        bitrate: An integer containing the bitrate in bits per second,
+            or None if it isn't known.
+        sampleRate: An integer containing the sample rate in hertz, or
+            None if it isn't known.
+        artSize: An integer containing the size of the embedded cover
+            art in bytes; 0 if there isn't any.
+    """
+
+    __slots__ = ("codec", "duration", "bitrate", "sampleRate", "artSize")
+
+    def __init__(self, codec, duration, bitrate, sampleRate, artSize):
+        """Initialize the facts about a file."""
+        self.codec = codec
+        self.duration = duration
+        self.bitrate = bitrate
+        self.sampleRate = sampleRate
+        self.artSize = artSize
+
+    def __repr__(self):
+        return "AudioInfo(%r, %r, %r, %r, %r)" % (
+            self.codec,
+            self.duration,
+            self.bitrate,
+            self.sampleRate,
+            self.artSize,
+        )
+
+
+def getNumber(value, convert=int):
+    """Return a number from ffprobe's output, or None if it isn't one."""
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parseProbeOutput(output):
+    """Return the facts in ffprobe's JSON output.
+
+    Args:
+        output: A string containing the output of ffprobe run with
+            PROBE_ENTRIES and JSON output.
+
+    Returns:
+        An 'AudioInfo', or None if the output couldn't be understood.
+    """
+    try:
+        probe = json.loads(output)
+    except ValueError:
+        return None
+
+    if not isinstance(probe, dict):
+        return None
+
+    formatInfo = probe.get("format", {})
+    streams = probe.get("streams", [])
+
+    # Use the first audio stream, and note which stream the cover art
+    # is in, if any
+    audioStream = {}
+    artIndex = None
+
+    for stream in streams:
+        if stream.get("disposition", {}).get("attached_pic"):
+            if artIndex is None:
+                artIndex = stream.get("index")
+        elif stream.get("codec_type") == "audio" and not audioStream:
+            audioStream = stream
+
+    # Cover art is stored in a single packet
+    artSize = 0
+
+    for packet in probe.get("packets", []):
+        if artIndex is not None and packet.get("stream_index") == artIndex:
+            artSize = getNumber(packet.get("size")) or 0
+
+    return AudioInfo(
+        audioStream.get("codec_name"),
+        getNumber(formatInfo.get("duration"), float),
+        getNumber(audioStream.get("bit_rate"))
+        or getNumber(formatInfo.get("bit_rate")),
+        getNumber(audioStream.get("sample_rate")),
+        artSize,
+    )
+
+
+def getProbeCommand(path):
+    """Return a list of strings containing the ffprobe command for a file."""
+    return [
+        "ffprobe",
+        "-v",
+        "error",
+        "-read_intervals",
+        "%+#1",
+        "-show_entries",
+        PROBE_ENTRIES,
+        "-of",
+        "json",
+        path,
+    ]
+
+
+def getResultInfo(result):
+    """Return the facts in a finished ffprobe 'commands.CommandResult'.
+
+    Returns:
+        An 'AudioInfo', or None if we can't tell.
+    """
+    if not result.succeeded():
+        return None
+
+    return parseProbeOutput(result.getOutput())
+
+
+def probeFiles(paths, jobs=1):
+    """Return the facts about several audio files, probing them all.
+
+    Args:
+        paths: A list of strings containing the paths of the files.
+        jobs: An optional integer specifying how many files to probe at
+            the same time.
+
+    Returns:
+        A list containing each file's 'AudioInfo', or None if we can't
+        tell, in the order of the paths.
+    """
+    try:
+        results = commands.runMany(
+            [getProbeCommand(path) for path in paths],
+            jobs,
+            group="probe",
+            stdin=commands.DISCARD,
+            stdout=commands.CAPTURE,
+            stderr=commands.DISCARD,
+        )
+    except OSError:
+        # No ffprobe
+        return [None] * len(paths)
+
+    return [getResultInfo(result) for result in results]
+
+
+def mayHoldMp3(path):
+    """Return whether a file we'd convert might hold MP3 audio already.
+
+    Only these files are worth probing to see whether their audio can
+    be copied into an MP3 file as is.
+    """
+    return os.path.splitext(path)[1].lower() in MP3_CONTAINER_EXTENSIONS
+
+
+def canStreamCopy(path, info):
+    """Return whether a file's audio can be copied into an MP3 file as is.
+
+    Args:
+        path: A string containing the path of the file.
+        info: The file's 'AudioInfo', or None if we can't tell.
+    """
+    return mayHoldMp3(path) and info is not None and info.codec == "mp3"
+
+
+def getFileKey(path):
+    """Return what identifies a version of a file, or None if it's gone.
+
+    Returns:
+        A 3-tuple of integers containing (size, modification time in
+        nanoseconds, inode).
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+class ProbeCache:
+    """A database of facts about audio files.
+
+    Paths are stored as bytes, so any path the filesystem allows can be
+    stored. Files which ffprobe couldn't make sense of are stored too,
+    so that they aren't probed again until they change.
+    """
+
+    def __init__(self, databasePath):
+        """Open a database, creating it if necessary.
+
+        Args:
+            databasePath: A string containing the path of the database.
+
+        Raises:
+            sqlite3.Error: The database couldn't be opened.
+            OSError: The database's directory couldn't be created.
+        """
+        import sqlite3
+
+        self.error = sqlite3.Error
+
+        os.makedirs(os.path.dirname(databasePath), exist_ok=True)
+
+        self.connection = sqlite3.connect(
+            databasePath, timeout=DATABASE_TIMEOUT
+        )
+
+        # Start afresh if the database was made by another version
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+
+        if version != SCHEMA_VERSION:
+            with self.connection:
+                self.connection.execute("DROP TABLE IF EXISTS probes")
+                self.connection.execute(
+                    "CREATE TABLE probes ("
+                    "path BLOB PRIMARY KEY, "
+                    "size INTEGER, "
+                    "mtime INTEGER, "
+                    "inode INTEGER, "
+                    "probed INTEGER, "
+                    "codec TEXT, "
+                    "duration REAL, "
+                    "bitrate INTEGER, "
+                    "sampleRate INTEGER, "
+                    "artSize INTEGER)"
+                )
+                self.connection.execute(
+                    "PRAGMA user_version = %d" % SCHEMA_VERSION
+                )
+
+    def close(self):
+        """Close the database."""
+        self.connection.close()
+
+    def lookup(self, path, fileKey):
+        """Return the stored facts about a file.
+
+        Args:
+            path: A string containing the path of the file.
+            fileKey: A tuple as returned by getFileKey for the file.
+
+        Returns:
+            A 2-tuple containing (found, info), where found is a boolean
+            signalling whether the file's current version is stored, and
+            info is its 'AudioInfo', or None if ffprobe couldn't make
+            sense of it.
+        """
+        row = self.connection.execute(
+            "SELECT size, mtime, inode, probed, codec, duration, bitrate, "
+            "sampleRate, artSize FROM probes WHERE path = ?",
+            (os.fsencode(path),),
+        ).fetchone()
+
+        if row is None or tuple(row[:3]) != fileKey:
+            return (False, None)
+
+        if not row[3]:
+            return (True, None)
+
+        return (True, AudioInfo(*row[4:]))
+
+    def store(self, entries):
+        """Store facts about several files at once.
+
+        Args:
+            entries: An iterable of 3-tuples of ("path", fileKey, info),
+                where fileKey is as returned by getFileKey and info is
+                an 'AudioInfo' or None.
+        """
+        rows = []
+
+        for path, fileKey, info in entries:
+            if info is None:
+                facts = (0, None, None, None, None, None)
+            else:
+                facts = (
+                    1,
+                    info.codec,
+                    info.duration,
+                    info.bitrate,
+                    info.sampleRate,
+                    info.artSize,
+                )
+
+            rows.append((os.fsencode(path),) + fileKey + facts)
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO probes VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def getCount(self):
+        """Return the number of files stored."""
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM probes"
+        ).fetchone()[0]
+
+    def prune(self):
+        """Forget about files which no longer exist.
+
+        Returns:
+            An integer containing the number of files forgotten.
+        """
+        missingPaths = [
+            (path,)
+            for (path,) in self.connection.execute("SELECT path FROM probes")
+            if not os.path.exists(path)
+        ]
+
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM probes WHERE path = ?", missingPaths
+            )
+
+        return len(missingPaths)
+
+
+def openCache(databasePath, quiet=False, create=True):
+    """Return an open 'ProbeCache', or None if it can't be opened.
+
+    Args:
+        databasePath: A string containing the path of the database.
+        quiet: An optional boolean toggling whether to omit error
+            output.
+        create: An optional boolean toggling whether to create the
+            database if it doesn't exist yet.
+    """
+    if not (create or os.path.exists(databasePath)):
+        return None
+
+    # Python can be built without SQLite
+    try:
+        import sqlite3
+    except ImportError as error:
+        talk.error("Failed to open probe cache (%s)" % error, quiet)
+        return None
+
+    try:
+        return ProbeCache(databasePath)
+    except (OSError, sqlite3.Error) as error:
+        talk.error("Failed to open probe cache (%s)" % error, quiet)
+
+    return None
+
+
+def getAudioInfo(paths, jobs=1, databasePath=None, quiet=False):
+    """Return the facts about several audio files.
+
+    Files are probed in parallel. If a database is given, files whose
+    facts it already has aren't probed again, and the facts about the
+    rest are added to it.
+
+    Args:
+        paths: An iterable of strings containing the paths of the files.
+        jobs: An optional integer specifying how many files to probe at
+            the same time.
+        databasePath: An optional string containing the path of the
+            probe cache's database.
+        quiet: An optional boolean toggling whether to omit error
+            output.
+
+    Returns:
+        A dictionary mapping each path to its 'AudioInfo', or to None if
+        we can't tell.
+    """
+    audioInfo = {}
+
+    # Files to probe, as 2-tuples of ("path", fileKey)
+    unknownFiles = []
+
+    probeCache = openCache(databasePath, quiet) if databasePath else None
+
+    for path in paths:
+        if path in audioInfo:
+            continue
+
+        fileKey = getFileKey(path)
+
+        if fileKey is None:
+            # Gone
+            audioInfo[path] = None
+            continue
+
+        if probeCache:
+            try:
+                found, info = probeCache.lookup(path, fileKey)
+            except probeCache.error:
+                found = False
+
+            if found:
+                audioInfo[path] = info
+                continue
+
+        # Placeholder, keeping paths in order
+        audioInfo[path] = None
+        unknownFiles += [(path, fileKey)]
+
+    # Probing is dominated by process startup, so run several at once
+    probed = probeFiles([path for path, _ in unknownFiles], jobs)
+
+    newEntries = []
+
+    for (path, fileKey), info in zip(unknownFiles, probed):
+        audioInfo[path] = info
+        newEntries += [(path, fileKey, info)]
+
+    # Remember what we found out, all in one transaction. If we were
+    # interrupted, some files weren't really probed, so leave it.
+    if probeCache:
+        if not commands.isCancelled():
+            try:
+                probeCache.store(newEntries)
+            except probeCache.error as error:
+                talk.error(
+                    "Failed to update probe cache (%s)" % error, quiet
+                )
+
+        probeCache.close()
+
+    return audioInfo
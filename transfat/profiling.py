@@ -0,0 +1,411 @@
+"""Contains a class for recording where a run spends its time.
+
+The report it writes is a JSON file holding, for each stage of a run,
+its wall time, CPU time (ours and that of programs we ran, like FFmpeg),
+bytes read and written, and number of files, along with how long each
+file took to convert and copy, how deep the queues of files waiting to
+be converted and written got, and how long the external commands we ran
+(like FFmpeg) took. Optionally, it holds a profile of
+transfat's own Python code from cProfile, and memory statistics from
+tracemalloc.
+
+Most runs aren't profiled, so the profiling modules are only imported
+when they're asked for, keeping startup quick.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from .version import VERSION
+
+# Path of the file containing our I/O counters
+PROC_IO_PATH = "/proc/self/io"
+
+# Number of functions and allocation sites to list in reports
+TOP_COUNT = 25
+
+
+def getIoCounters():
+    """Return how many bytes we've read and written so far.
+
+    Counts include those of child processes which have exited, such as
+    FFmpeg and cp.
+
+    Returns:
+        A 2-tuple of integers containing (bytes read, bytes written), or
+        (None, None) if we can't tell.
+    """
+    counters = {}
+
+    try:
+        with open(PROC_IO_PATH) as ioFile:
+            for line in ioFile:
+                key, _, value = line.partition(":")
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        return (None, None)
+
+    return (counters.get("rchar"), counters.get("wchar"))
+
+
+def getDifference(start, end):
+    """Return end minus start, or None if either is None.
+
+    Floats are rounded to the microsecond, which is as precise as any
+    of our timers are.
+    """
+    if start is None or end is None:
+        return None
+
+    if isinstance(end, float):
+        return round(end - start, 6)
+
+    return end - start
+
+
+class Profiler:
+    """Records where a run spends its time.
+
+    A profiler which isn't enabled does nothing, so it's safe to call
+    its methods unconditionally.
+
+    Attributes:
+        enabled: A boolean signalling whether we're recording anything.
+        stages: A list of dictionaries, one per finished stage.
+        files: A list of dictionaries, one per file converted or copied.
+        queues: A dictionary mapping the names of queues to dictionaries
+            of statistics about how many items waited in them.
+        commands: A dictionary mapping the names of kinds of external
+            commands to dictionaries of statistics about how long they
+            took.
+    """
+
+    def __init__(self, enabled=False, pythonProfile=False, memory=False):
+        """Start recording.
+
+        Args:
+            enabled: An optional boolean signalling whether to record
+                anything.
+            pythonProfile: An optional boolean signalling whether to
+                profile transfat's Python code with cProfile. Only code
+                running in the main thread is profiled.
+            memory: An optional boolean signalling whether to trace
+                memory allocations with tracemalloc.
+        """
+        self.enabled = enabled
+        self.stages = []
+        self.files = []
+        self.queues = {}
+        self.commands = {}
+        self.lock = threading.Lock()
+
+        # Stages which have started but not finished, by name and device
+        self.running = {}
+
+        # Start the optional profilers
+        if enabled and pythonProfile:
+            import cProfile
+
+            self.pythonProfiler = cProfile.Profile()
+            self.pythonProfiler.enable()
+        else:
+            self.pythonProfiler = None
+
+        if enabled and memory:
+            import tracemalloc
+
+            tracemalloc.start()
+            self.tracemalloc = tracemalloc
+        else:
+            self.tracemalloc = None
+
+        self.start = time.perf_counter()
+
+    def getCounters(self):
+        """Return a dictionary of counters to take differences of."""
+        times = os.times()
+        bytesRead, bytesWritten = getIoCounters()
+
+        return {
+            "seconds": time.perf_counter(),
+            "cpuSeconds": times.user + times.system,
+            "childCpuSeconds": times.children_user + times.children_system,
+            "bytesRead": bytesRead,
+            "bytesWritten": bytesWritten,
+        }
+
+    def startStage(self, name, device=None):
+        """Start timing a stage.
+
+        Args:
+            name: A string containing the name of the stage.
+            device: An optional string containing the device the stage
+                works on, for stages which run on several devices at
+                once.
+        """
+        if not self.enabled:
+            return
+
+        # Measure each stage's peak memory use from its start
+        if self.tracemalloc and hasattr(self.tracemalloc, "reset_peak"):
+            self.tracemalloc.reset_peak()
+
+        self.running[(name, device)] = self.getCounters()
+
+    def endStage(self, name, fileCount=None, device=None):
+        """Finish timing a stage and record it.
+
+        Args:
+            name: A string containing the name of the stage, as passed
+                to startStage.
+            fileCount: An optional integer containing the number of
+                files the stage dealt with.
+            device: An optional string containing the device the stage
+                works on, as passed to startStage.
+        """
+        if not self.enabled or (name, device) not in self.running:
+            return
+
+        start = self.running.pop((name, device))
+        end = self.getCounters()
+
+        stage = {"name": name, "files": fileCount}
+
+        if device is not None:
+            stage["device"] = device
+
+        stage.update(
+            {key: getDifference(start[key], end[key]) for key in start}
+        )
+
+        if self.tracemalloc:
+            stage["memoryPeak"] = self.tracemalloc.get_traced_memory()[1]
+
+        self.stages.append(stage)
+
+    def timeFiles(self, kind, function):
+        """Return a function which records how long each call takes.
+
+        The function given is called as is, and each call is recorded
+        as a file of the given kind, named by the first argument.
+
+        Args:
+            kind: A string containing what the function does to files,
+                like "convert" or "copy".
+            function: A function whose first argument is the path of a
+                file.
+
+        Returns:
+            The function given if we're not enabled, or a wrapper around
+            it otherwise.
+        """
+        if not self.enabled:
+            return function
+
+        def timedFunction(path, *args, **kwargs):
+            """Call the function and record how long it took."""
+            start = time.perf_counter()
+
+            result = function(path, *args, **kwargs)
+
+            seconds = time.perf_counter() - start
+
+            # Failures come back as None or False
+            with self.lock:
+                self.files.append(
+                    {
+                        "kind": kind,
+                        "path": path,
+                        "seconds": round(seconds, 6),
+                        "succeeded": result is not None
+                        and result is not False,
+                    }
+                )
+
+            return result
+
+        return timedFunction
+
+    def addToQueue(self, name, count=1):
+        """Record items joining a queue.
+
+        Args:
+            name: A string containing the name of the queue, like
+                "transcode".
+            count: An optional integer containing the number of items
+                joining the queue. Negative numbers leave it.
+        """
+        if not self.enabled:
+            return
+
+        now = time.perf_counter()
+
+        with self.lock:
+            queue = self.queues.setdefault(
+                name,
+                {
+                    "depth": 0,
+                    "maxDepth": 0,
+                    "items": 0,
+                    "start": now,
+                    "changed": now,
+                    "depthSeconds": 0.0,
+                },
+            )
+
+            # Keep a running total of depth over time, for the mean
+            queue["depthSeconds"] += queue["depth"] * (now - queue["changed"])
+            queue["changed"] = now
+            queue["depth"] += count
+            queue["maxDepth"] = max(queue["maxDepth"], queue["depth"])
+
+            if count > 0:
+                queue["items"] += count
+
+    def removeFromQueue(self, name, count=1):
+        """Record items leaving a queue, as passed to addToQueue."""
+        self.addToQueue(name, -count)
+
+    def getQueueReport(self):
+        """Return statistics about each queue as a dictionary.
+
+        Mean depths are over the time from the first item joining the
+        queue to the last one leaving it.
+        """
+        report = {}
+
+        with self.lock:
+            for name, queue in self.queues.items():
+                seconds = queue["changed"] - queue["start"]
+
+                if seconds:
+                    meanDepth = round(queue["depthSeconds"] / seconds, 3)
+                else:
+                    meanDepth = 0.0
+
+                report[name] = {
+                    "items": queue["items"],
+                    "maxDepth": queue["maxDepth"],
+                    "meanDepth": meanDepth,
+                }
+
+        return report
+
+    def addCommand(self, result):
+        """Record an external command having finished.
+
+        Args:
+            result: A 'commands.CommandResult' for the command.
+        """
+        if not self.enabled:
+            return
+
+        with self.lock:
+            statistics = self.commands.setdefault(
+                result.getName(),
+                {"count": 0, "failed": 0, "seconds": 0.0, "maxSeconds": 0.0},
+            )
+
+            statistics["count"] += 1
+            statistics["seconds"] += result.seconds
+            statistics["maxSeconds"] = max(
+                statistics["maxSeconds"], result.seconds
+            )
+
+            if not result.succeeded():
+                statistics["failed"] += 1
+
+    def getCommandReport(self):
+        """Return statistics about each kind of command as a dictionary."""
+        with self.lock:
+            return {
+                name: {
+                    "count": statistics["count"],
+                    "failed": statistics["failed"],
+                    "seconds": round(statistics["seconds"], 6),
+                    "maxSeconds": round(statistics["maxSeconds"], 6),
+                }
+                for name, statistics in self.commands.items()
+            }
+
+    def getReport(self):
+        """Return everything recorded as a dictionary."""
+        report = {
+            "version": VERSION,
+            "python": sys.version.split()[0],
+            "arguments": sys.argv[1:],
+            "seconds": time.perf_counter() - self.start,
+            "stages": self.stages,
+            "files": self.files,
+            "queues": self.getQueueReport(),
+            "commands": self.getCommandReport(),
+        }
+
+        # Add the functions we spent most time in
+        if self.pythonProfiler:
+            import io
+            import pstats
+
+            self.pythonProfiler.disable()
+
+            statsText = io.StringIO()
+            stats = pstats.Stats(self.pythonProfiler, stream=statsText)
+            stats.sort_stats("cumulative").print_stats(TOP_COUNT)
+
+            report["pythonProfile"] = statsText.getvalue().splitlines()
+
+        # Add where memory is allocated
+        if self.tracemalloc:
+            current, peak = self.tracemalloc.get_traced_memory()
+            snapshot = self.tracemalloc.take_snapshot()
+            statistics = snapshot.statistics("lineno")
+
+            report["memory"] = {
+                "current": current,
+                "peak": peak,
+                "top": [
+                    {
+                        "location": "%s:%d"
+                        % (
+                            statistic.traceback[0].filename,
+                            statistic.traceback[0].lineno,
+                        ),
+                        "size": statistic.size,
+                        "count": statistic.count,
+                    }
+                    for statistic in statistics[:TOP_COUNT]
+                ],
+            }
+
+        return report
+
+    def write(self, reportPath):
+        """Write the report to a file.
+
+        If we're profiling Python code, the raw cProfile statistics are
+        also written next to the report, with ".prof" appended to its
+        name, for use with pstats or snakeviz.
+
+        Args:
+            reportPath: A string containing the path of the report file.
+
+        Returns:
+            A boolean signalling whether the report was written.
+        """
+        if not self.enabled:
+            return False
+
+        report = self.getReport()
+
+        try:
+            with open(reportPath, "w") as reportFile:
+                json.dump(report, reportFile, indent=2)
+
+            if self.pythonProfiler:
+                self.pythonProfiler.dump_stats(reportPath + ".prof")
+        except OSError:
+            return False
+
+        return True
@@ -6,10 +6,14 @@ ones that are specific will be marked so.
 
 import argparse
 import configparser
+import functools
+import json
 import os
-import subprocess
+import shutil
 import sys
 import transfat.config.constants
+from . import commands
+from . import mounts
 from . import talk
 from .version import NAME, VERSION
 
@@ -41,7 +45,29 @@ def getRuntimeArguments():
         help="path to source directories or files",
     )
     parser.add_argument(
-        "destination", type=str, help="path to destination directory or file"
+        "destination",
+        nargs="?",
+        type=str,
+        default=None,
+        help=(
+            "path to destination directory or file; trailing paths on FAT"
+            " devices are all destinations, once confirmed"
+        ),
+    )
+    cacheoptions = parser.add_mutually_exclusive_group()
+    cacheoptions.add_argument(
+        "--cache-stats",
+        help="show transcode and probe cache statistics and exit",
+        action="store_const",
+        dest="action",
+        const="stats",
+    )
+    cacheoptions.add_argument(
+        "--cache-prune",
+        help="evict old transcode cache entries and exit",
+        action="store_const",
+        dest="action",
+        const="prune",
     )
     parser.add_argument(
         "--config-file",
@@ -54,6 +80,34 @@ def getRuntimeArguments():
         help="use default settings from config file",
         action="store_true",
     )
+    parser.add_argument(
+        "--encoder-profile",
+        help="encode with this profile from the config file",
+        metavar="NAME",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--incremental",
+        help="only transfer files which changed since the last transfer",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="number of audio conversions to run at once",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--max-size",
+        help=(
+            "with --cache-prune, prune down to this many MiB instead of the"
+            " configured size"
+        ),
+        type=int,
+        default=None,
+    )
     parser.add_argument(
         "--no-sort", help="do not unmount and fatsort", action="store_true"
     )
@@ -63,11 +117,39 @@ def getRuntimeArguments():
         help="print example transfatrc and exit",
         action=ConfigPrintAction,
     )
+    parser.add_argument(
+        "--profile",
+        help="write a JSON report of where time was spent to this file",
+        metavar="REPORT",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--profile-python",
+        help="with --profile, also profile the main thread with cProfile",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        help="with --profile, also trace memory use with tracemalloc",
+        action="store_true",
+    )
     parser.add_argument(
         "--rename",
         help="rename name-pattern matched directories",
         action="store_true",
     )
+    parser.add_argument(
+        "-t",
+        "--to",
+        help=(
+            "transfer to this destination; give it once per destination,"
+            " in which case every path is a source"
+        ),
+        metavar="DESTINATION",
+        action="append",
+        default=None,
+    )
     parser.add_argument(
         "--version", action="version", version="%(prog)s " + VERSION
     )
@@ -85,11 +167,125 @@ def getRuntimeArguments():
         action="store_true",
     )
 
+    parser.set_defaults(command=None)
+
     arguments = parser.parse_args()
 
+    # The destination comes last; a lone path is taken as a source
+    # otherwise
+    if arguments.destination is None and arguments.sources:
+        arguments.destination = arguments.sources.pop()
+
+    # Cache maintenance doesn't transfer anything
+    if arguments.action:
+        if arguments.destination is not None or arguments.to:
+            parser.error("cache options don't take any paths")
+
+        arguments.command = "cache"
+
+        return arguments
+
+    if arguments.to:
+        # Every path is a source when destinations are given explicitly
+        if arguments.destination is not None:
+            arguments.sources.append(arguments.destination)
+
+        arguments.destinations = arguments.to
+    elif arguments.destination is None:
+        parser.error("the following arguments are required: destination")
+    else:
+        # Work out which of the paths given are destinations. If that's
+        # more than the last one, the guess needs confirming (see
+        # confirmDestinations).
+        arguments.sources, arguments.destinations = splitDestinations(
+            arguments.sources + [arguments.destination]
+        )
+
+    arguments.destination = arguments.destinations[0]
+
     return arguments
 
 
+def splitDestinations(paths):
+    """Split paths given on the command line into sources and destinations.
+
+    Specific to transfat. The last path is always a destination. So are
+    the paths before it which are on FAT devices, as long as the first
+    path isn't on a FAT device itself (in which case the paths are taken
+    to be copies from one device to another), and at least one source is
+    left.
+
+    Args:
+        paths: A list of strings containing the paths given on the
+            command line, destination last.
+
+    Returns:
+        A 2-tuple containing lists of strings for (sources,
+        destinations).
+    """
+    destinationCount = 1
+
+    if len(paths) > 2:
+        fatMounts = mounts.resolveDestinations(paths)
+
+        if fatMounts[paths[0]] is None:
+            while (
+                destinationCount < len(paths) - 1
+                and fatMounts[paths[-destinationCount - 1]] is not None
+            ):
+                destinationCount += 1
+
+    return (paths[:-destinationCount], paths[-destinationCount:])
+
+
+def confirmDestinations(
+    sources, destinations, noninteractive=False, quiet=False
+):
+    """Show sources and guessed destinations, and confirm the guess.
+
+    Specific to transfat. splitDestinations guesses that paths on FAT
+    devices are destinations, which is wrong if the user meant to
+    transfer from one of them (an album on an SD card, say), so the
+    guess has to be confirmed. If it isn't, only the last path is a
+    destination.
+
+    Args:
+        sources: A list of strings containing the source paths.
+        destinations: A list of strings containing the destination
+            paths guessed.
+        noninteractive: An optional boolean signalling to never prompt,
+            in which case the guess isn't confirmed; destinations can be
+            given with --to instead.
+        quiet: An optional boolean toggling whether to omit the paths.
+
+    Returns:
+        A boolean signalling whether to transfer to every destination.
+    """
+    if not quiet:
+        print("Sources:")
+
+        for source in sources:
+            print("    " + source)
+
+        print("Destinations:")
+
+        for destination in destinations:
+            print("    " + destination)
+
+    if not noninteractive and talk.prompt(
+        "Transfer to all %d destinations?" % len(destinations)
+    ):
+        return True
+
+    talk.status(
+        "Only transferring to %s; give several destinations with --to"
+        % destinations[-1],
+        not quiet,
+    )
+
+    return False
+
+
 def getConfigurationFilePath():
     """Return a string containing the path of the configuration file.
 
@@ -115,6 +311,139 @@ def getConfigurationFilePath():
     return os.path.dirname(transfat.config.constants.__file__) + "/config.ini"
 
 
+def getCacheDirectoryPath():
+    """Return a string containing the path of the transcode cache.
+
+    Uses the cache directory from the XDG spec (defaults to ~/.cache).
+    """
+    cachedir = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(
+        "~/.cache"
+    )
+
+    return cachedir + "/transfat/transcodes"
+
+
+def getProbeCachePath():
+    """Return a string containing the path of the FFmpeg probe cache.
+
+    Uses the cache directory from the XDG spec (defaults to ~/.cache).
+    """
+    cachedir = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(
+        "~/.cache"
+    )
+
+    return cachedir + "/transfat/ffmpeg.json"
+
+
+def getProbeDatabasePath():
+    """Return a string containing the path of the audio probe cache.
+
+    Uses the cache directory from the XDG spec (defaults to ~/.cache).
+    """
+    cachedir = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(
+        "~/.cache"
+    )
+
+    return cachedir + "/transfat/probes.sqlite3"
+
+
+@functools.lru_cache(maxsize=None)
+def getFfmpegCapabilities():
+    """Return FFmpeg's version and the audio encoders it has.
+
+    Specific to transfat. Probing FFmpeg takes a couple of processes, so
+    the results are cached on disk along with the path, size, and
+    modification time of the ffmpeg binary; the cache is only used
+    while those stay the same.
+
+    Returns:
+        A 2-tuple containing (version, encoders), where version is a
+        string containing FFmpeg's version line and encoders is a
+        frozenset of strings containing the names of its audio encoders.
+        Returns ("", frozenset()) if FFmpeg can't be run.
+    """
+    ffmpegPath = shutil.which("ffmpeg")
+
+    if not ffmpegPath:
+        return ("", frozenset())
+
+    # Identify this particular ffmpeg binary
+    try:
+        ffmpegStat = os.stat(ffmpegPath)
+    except OSError:
+        return ("", frozenset())
+
+    binary = [ffmpegPath, ffmpegStat.st_size, ffmpegStat.st_mtime_ns]
+    cachePath = getProbeCachePath()
+
+    # Use what we found out last time if it's the same binary
+    try:
+        with open(cachePath) as cacheFile:
+            probe = json.load(cacheFile)
+
+        if probe["binary"] == binary:
+            return (probe["version"], frozenset(probe["encoders"]))
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    version = getCommandOutput([ffmpegPath, "-version"])
+
+    if version is None:
+        return ("", frozenset())
+
+    version = version.split("\n", 1)[0].strip()
+
+    # Encoders are listed one per line after a line of dashes, like
+    # " A....D libmp3lame           libmp3lame MP3 (MPEG audio layer 3)"
+    encoders = set()
+    listing = getCommandOutput([ffmpegPath, "-hide_banner", "-encoders"])
+
+    if listing:
+        for line in listing.split("------", 1)[-1].splitlines():
+            fields = line.split()
+
+            if len(fields) >= 2 and fields[0].startswith("A"):
+                encoders.add(fields[1])
+
+    # Remember this for next time; it doesn't matter if we can't
+    try:
+        os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+
+        with open(cachePath + ".tmp", "w") as cacheFile:
+            json.dump(
+                {
+                    "binary": binary,
+                    "version": version,
+                    "encoders": sorted(encoders),
+                },
+                cacheFile,
+            )
+
+        os.replace(cachePath + ".tmp", cachePath)
+    except OSError:
+        pass
+
+    return (version, frozenset(encoders))
+
+
+def getCommandOutput(command):
+    """Return a string containing a command's output, or None on failure."""
+    try:
+        result = commands.run(
+            command,
+            stdin=commands.DISCARD,
+            stdout=commands.CAPTURE,
+            stderr=commands.DISCARD,
+        )
+    except OSError:
+        return None
+
+    if not result.succeeded():
+        return None
+
+    return result.getOutput()
+
+
 def getExampleRCPath():
     """Return a string with the path of an example transfatrc file."""
     return os.path.dirname(transfat.config.constants.__file__) + "/transfatrc"
@@ -146,27 +475,25 @@ def dependenciesAvailable(no_fatsort=False, quiet=False, verbose=False):
         A boolean signaling whether dependicies are installed.
     """
     # Check if ffmpeg is installed
-    ffmpegCheck = subprocess.Popen(
-        ["bash", "-c", "type ffmpeg"],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-    )
-    ffmpegAvailable = not ffmpegCheck.wait()
+    ffmpegAvailable = shutil.which("ffmpeg") is not None
 
     if ffmpegAvailable:
         talk.status("ffmpeg available", verbose)
+
+        # Check that it can make MP3s. If we can't tell which encoders
+        # it has, assume the best.
+        encoders = getFfmpegCapabilities()[1]
+
+        if encoders and "libmp3lame" not in encoders:
+            talk.error("ffmpeg can't encode MP3s (no libmp3lame)!", quiet)
+            ffmpegAvailable = False
     else:
         # ffmpeg not available!
         talk.error("ffmpeg not installed!", quiet)
 
     # Check if fatsort is installed, if necessary
     if not no_fatsort:
-        fatCheck = subprocess.Popen(
-            ["bash", "-c", "type fatsort"],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-        fatsortAvailable = not fatCheck.wait()
+        fatsortAvailable = shutil.which("fatsort") is not None
 
         if fatsortAvailable:
             talk.status("fatsort available", verbose)
@@ -249,14 +576,14 @@ def requestRootAccess(configsettings, noninteractive=False, verbose=False):
         return True
 
     # Check if we have root passphrase cached already; exit code of the
-    # Popen command will be non-zero if we don't have credentials, and
-    # will be zero if we do
-    rootCheck = subprocess.Popen(
+    # command will be non-zero if we don't have credentials, and will be
+    # zero if we do
+    rootCheck = commands.run(
         ["sudo", "-n", "echo"],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
+        stdout=commands.DISCARD,
+        stderr=commands.DISCARD,
     )
-    exitCode = rootCheck.wait()
+    exitCode = int(not rootCheck.succeeded())
 
     # If we're running non-interactively and we don't have access to
     # root credentials, return false
@@ -293,6 +620,37 @@ def requestRootAccess(configsettings, noninteractive=False, verbose=False):
     return True
 
 
+def getConversionJobs(jobsArgument, configsettings):
+    """Return how many audio conversions to run at once.
+
+    Specific to transfat. The runtime argument takes precedence over the
+    ConversionJobs config setting; if neither gives a positive number of
+    jobs, use one job per CPU we're allowed to run on.
+
+    Args:
+        jobsArgument: An integer (or None) containing the number of jobs
+            given on the command line.
+        configsettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+
+    Returns:
+        A positive integer.
+    """
+    if jobsArgument and jobsArgument > 0:
+        return jobsArgument
+
+    configJobs = configsettings.getint("ConversionJobs", fallback=0)
+
+    if configJobs > 0:
+        return configJobs
+
+    # We may be limited to some of the CPUs, by taskset or a container
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+
+    return os.cpu_count() or 1
+
+
 def abort(code):
     """Exit program with an exit code."""
     talk.aborting()
@@ -1,9 +1,22 @@
 """Contains functions for communicating with a user."""
 
-import distutils.util
 import sys
+import threading
+import time
 from .version import NAME
 
+# Answers to yes/no questions, as accepted by distutils' old strtobool
+YES_ANSWERS = ("y", "yes", "t", "true", "on", "1")
+NO_ANSWERS = ("n", "no", "f", "false", "off", "0")
+
+# The progress display currently shown, if any, which other output
+# clears out of the way first
+activeProgress = None
+
+# Held while asking a question, so that questions asked from different
+# threads don't get mixed up
+promptLock = threading.RLock()
+
 
 def prompt(query):
     """Prompt a yes/no question and get an answer.
@@ -18,38 +31,265 @@ def prompt(query):
     Returns:
         A boolean corresponding to the answer to the question asked.
     """
-    sys.stdout.write("%s [y/n]: " % query)
-    val = input().lower()
-    try:
-        result = distutils.util.strtobool(val)
-    except ValueError:
+    with promptLock:
+        sys.stdout.write("%s [y/n]: " % query)
+        val = input().lower()
+        if val in YES_ANSWERS:
+            return True
+        elif val in NO_ANSWERS:
+            return False
+
         # Result no good! Ask again.
         sys.stdout.write("Please answer with y/n\n")
         return prompt(query)
-    return result
 
 
 def status(message, verbose=True):
     """Print a status update if a flag is true."""
     if verbose:
-        print(message)
+        # Write the line in one go, so that lines from several threads
+        # don't run into each other
+        sys.stdout.write(message + "\n")
     return
 
 
 def success(message, verbose=True):
     """Print a success message if a flag is true."""
     if verbose:
-        print("Success: " + message)
+        sys.stdout.write("Success: " + message + "\n")
     return
 
 
 def error(error_message, quiet=False):
     """Print an error message to stderr if a flag is false."""
     if not quiet:
-        print("ERROR: " + error_message, file=sys.stderr)
+        if activeProgress:
+            activeProgress.clear()
+
+        sys.stderr.write("ERROR: " + error_message + "\n")
     return
 
 
+class Progress:
+    """A one-line progress display, rewritten in place.
+
+    Shows files done out of the total, the rate data is written to the
+    device, how many times faster than realtime audio is being encoded,
+    and an estimate of the time left. Counting is cheap and thread-safe;
+    the line is only redrawn a few times a second, however many files
+    there are.
+
+    Attributes:
+        enabled: A boolean signalling whether anything is shown.
+        total: An integer containing the number of files to transfer.
+        done: An integer containing the number of files transferred.
+        bytesWritten: An integer containing the number of bytes written
+            to the device.
+        encodedSeconds: A float containing the seconds of audio encoded.
+    """
+
+    # Minimum seconds between redraws
+    INTERVAL = 0.25
+
+    # Bytes in a megabyte
+    MB = 1000 ** 2
+
+    def __init__(self, enabled=True, stream=sys.stderr):
+        """Start with nothing done.
+
+        Args:
+            enabled: An optional boolean signalling whether to show
+                anything. Nothing is shown unless the stream is a
+                terminal either.
+            stream: An optional file object to draw on.
+        """
+        self.enabled = enabled and stream.isatty()
+        self.stream = stream
+        self.lock = threading.Lock()
+
+        self.total = 0
+        self.done = 0
+        self.bytesWritten = 0
+        self.encodedSeconds = 0.0
+
+        self.start = time.monotonic()
+        self.lastDrawn = 0.0
+        self.lineLength = 0
+
+    def addFiles(self, count=1):
+        """Add to the number of files to transfer."""
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.total += count
+
+        self.update()
+
+    def finishFile(self, size=0):
+        """Count a file as transferred.
+
+        Args:
+            size: An optional integer containing the number of bytes
+                written to the device for the file.
+        """
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.done += 1
+            self.bytesWritten += size
+
+        self.update()
+
+    def addEncoded(self, seconds):
+        """Add to the seconds of audio encoded."""
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.encodedSeconds += seconds
+
+        self.update()
+
+    def getLine(self):
+        """Return a string containing the progress line to draw."""
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+
+        line = "%d/%d files  %.1f MB/s" % (
+            self.done,
+            self.total,
+            self.bytesWritten / self.MB / elapsed,
+        )
+
+        if self.encodedSeconds:
+            line += "  %.1fx realtime" % (self.encodedSeconds / elapsed)
+
+        # Estimate what's left from how long each file has taken
+        if self.done:
+            remaining = max(self.total - self.done, 0) * elapsed / self.done
+            minutes, seconds = divmod(int(remaining), 60)
+            hours, minutes = divmod(minutes, 60)
+
+            line += "  ETA %d:%02d:%02d" % (hours, minutes, seconds)
+
+        return line
+
+    def update(self, force=False):
+        """Redraw the line if it's been long enough since the last time.
+
+        Args:
+            force: An optional boolean signalling to redraw regardless.
+        """
+        global activeProgress
+
+        if not self.enabled:
+            return
+
+        now = time.monotonic()
+
+        # Only one thread gets to draw, and only every so often
+        if not force and now - self.lastDrawn < self.INTERVAL:
+            return
+
+        with self.lock:
+            self.lastDrawn = now
+            line = self.getLine()
+
+            # Pad out to cover whatever was drawn before
+            self.stream.write("\r" + line.ljust(self.lineLength))
+            self.stream.flush()
+
+            self.lineLength = len(line)
+            activeProgress = self
+
+    def clear(self):
+        """Erase the line, so that other output can go in its place."""
+        with self.lock:
+            if self.lineLength:
+                self.stream.write("\r" + " " * self.lineLength + "\r")
+                self.stream.flush()
+
+                self.lineLength = 0
+
+    def finish(self):
+        """Draw the line one last time and move past it."""
+        global activeProgress
+
+        if not self.enabled:
+            return
+
+        self.update(force=True)
+        self.stream.write("\n")
+        self.stream.flush()
+
+        self.lineLength = 0
+        activeProgress = None
+
+
+class FlushProgress(Progress):
+    """A one-line display of how much is left to write to devices.
+
+    Shows the bytes left, the rate they're being written at, and an
+    estimate of the time left.
+
+    Attributes:
+        remaining: An integer containing the number of bytes left to
+            write, or None if we haven't been told yet.
+    """
+
+    def __init__(self, enabled=True, stream=sys.stderr):
+        """Start with nothing known about what's left.
+
+        Args:
+            enabled: An optional boolean signalling whether to show
+                anything. Nothing is shown unless the stream is a
+                terminal either.
+            stream: An optional file object to draw on.
+        """
+        super().__init__(enabled, stream)
+
+        self.remaining = None
+        self.initial = None
+
+    def setRemaining(self, remaining):
+        """Set the number of bytes left to write."""
+        if not self.enabled:
+            return
+
+        with self.lock:
+            if self.initial is None:
+                self.initial = remaining
+
+            self.remaining = remaining
+
+        self.update()
+
+    def getLine(self):
+        """Return a string containing the progress line to draw."""
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        remaining = self.remaining or 0
+
+        line = "Flushing  %.1f MB left" % (remaining / self.MB)
+
+        # Estimate what's left from how fast it's going down
+        written = (self.initial or 0) - remaining
+
+        if written > 0:
+            rate = written / elapsed
+            minutes, seconds = divmod(int(remaining / rate), 60)
+            hours, minutes = divmod(minutes, 60)
+
+            line += "  %.1f MB/s  ETA %d:%02d:%02d" % (
+                rate / self.MB,
+                hours,
+                minutes,
+                seconds,
+            )
+
+        return line
+
+
 def aborting():
     """Prints that the program is aborting."""
     print("Aborting %s" % NAME)
@@ -1,107 +1,53 @@
 """Contains functions used to copy and process (mostly audio) files."""
 
+import collections
+import concurrent.futures
 import os
 import shutil
-import subprocess
+import threading
+from . import cache
+from . import commands
+from . import copyengine
+from . import encoders
+from . import mounts
+from . import probe
 from . import talk
 from .config.constants import NO, YES, PROMPT
 
 
-def getCorrespondingPathsLists(
-    sourcePaths, destinationPath, verbose=False, quiet=False
-):
-    """Return lists of corresponding source and destination paths.
+def filterOutExtensions(plan, configsettings, noninteractive=False):
+    """Remove unwanted files from a transfer plan.
 
-    Generate corresponding lists of paths for source and destination
-    files and source and destination directories. The indices of the two
-    file lists will correspond to each other, and similarly, the indices
-    of the two directory lists will correspond to each other.
+    Filter out files of unwanted extensions from the plan's files.
 
     Args:
-        sourcePaths: A list of strings containing source paths, which
-            can be files or directories.
-        destinationPath: A string containing a destination path for
-            where the source files/directories should be transfered to.
-        verbose: An optional boolean toggling whether to give extra
-            output.
-        quiet: An optional boolean toggling whether to omit error
-            output.
+        plan: A 'plan.TransferPlan' object containing the files to
+            transfer.
+        configsettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+        noninteractive: An optional boolean toggling whether to suppress
+            prompts to remove files that may have been requested in the
+            configuration file config.ini.
 
     Returns:
-        A 4-tuple containing (sourceDirs, sourceFiles, destinationDirs,
-        destinationFiles) where ...
-
-        sourceDirs: A list of strings containing absolute paths to
-            source directories.
-        sourceFiles: A list of strings containing absolute paths to
-            source files.
-        destinationDirs: A list of strings containing absolute paths to
-            destination directories.
-        destinationFiles: A list of strings containing absolute paths to
-            destination files.
-
-        and where the indices of sourceDirs and destinationDirs
-        correspond to each other, and, similarly, where the indices of
-        sourceFiles and destinationFiles correspond to each other.
+        Nothing. The work performed on the plan is done in place.
     """
-    # Make sure source and destination paths are absolute paths
-    sourcePaths_ = [os.path.abspath(source) for source in sourcePaths]
-    destinationPath_ = os.path.abspath(destinationPath)
-
-    # Generate lists of source and destination paths
-    sourceDirs = []
-    sourceFiles = []
-    destinationDirs = []
-    destinationFiles = []
-
-    # Go through each source
-    for source in sourcePaths_:
-        # Get the parent directory of the source so we can generate the
-        # destination path
-        parent = os.path.dirname(source)
-        parentlen = len(parent)
-
-        # Determine whether the source is a file or directory
-        if os.path.isfile(source):
-            # The source is a file, so add it to the file lists
-            sourceFiles += [source]
-            destinationFiles += [destinationPath_ + source[parentlen:]]
-        elif os.path.isdir(source):
-            # The source is a directory, so add itself and everything
-            # inside of it to the appropriate lists
-            for root, _, files in os.walk(source):
-                sourceDirs += [root]
-                sourceFiles += [root + "/" + file for file in files]
-                destinationDirs += [destinationPath_ + root[parentlen:]]
-                destinationFiles += [
-                    destinationPath_ + root[parentlen:] + "/" + file
-                    for file in files
-                ]
-        else:
-            # The source is neither a file nor directory. Give a
-            # warning.
-            talk.error("'%s' does not exist!" % source, quiet)
-            talk.status("Proceeding anyway", verbose)
+    isWanted = getExtensionFilter(configsettings, noninteractive)
 
-    return (sourceDirs, sourceFiles, destinationDirs, destinationFiles)
+    plan.files = [record for record in plan.files if isWanted(record)]
 
+    return
 
-def filterOutExtensions(
-    sourceFiles, destinationFiles, configsettings, noninteractive=False
-):
-    """Remove indices corresponding to unwanted files from lists.
 
-    Filter out files of unwanted extensions from the list of source
-    files and destination files.
+def getExtensionFilter(configsettings, noninteractive=False):
+    """Return a function which decides whether to keep a file.
 
-    [*] The indices of the source file list and destination file list
-    inputs must correspond to each other.
+    The function returned takes a 'plan.FileRecord' and returns a
+    boolean signalling whether to transfer that file, according to the
+    config settings for removing files of certain extensions. It prompts
+    if the config settings ask it to.
 
     Args:
-        sourceFiles: A list of strings of absolute paths to source
-            files. See [*] above.
-        destinationFiles: A list of strings of absolute paths to
-            destination files. See [*] above.
         configsettings: A dictionary-like 'configparser.SectionProxy'
             object containing configuration settings from config.ini.
         noninteractive: An optional boolean toggling whether to suppress
@@ -109,7 +55,7 @@ def filterOutExtensions(
             configuration file config.ini.
 
     Returns:
-        Nothing. The work performed on the file lists is done in place.
+        A function taking a 'plan.FileRecord' and returning a boolean.
     """
     # Load settings from config file
     imageOption = configsettings.getint("RemoveImages")
@@ -125,68 +71,35 @@ def filterOutExtensions(
     cueExt = (".cue",)
     m3uExt = (".m3u",)
 
-    # Pair each file extension with its corresponding config setting
-    extensionList = [
+    # Map each file extension to its corresponding config setting.
+    # Audio files are always kept.
+    removeOptions = {}
+
+    for extensions, removeOption in [
+        [audioExt, NO],
         [imageExt, imageOption],
         [logExt, logOption],
         [cueExt, cueOption],
         [m3uExt, m3uOption],
-    ]
-
-    # Gather all of the non-audio file extensions into one tuple
-    nonAudioExt = ()
-    for ext in extensionList:
-        nonAudioExt += ext[0]
-
-    # Initialize a list of indices corresponding to files to remove
-    indexList = []
-
-    # Find which files have extensions that we don't want and mark their
-    # indices
-    for file_ in destinationFiles:
-        if file_.lower().endswith(audioExt):
-            # This is an audio file; keep this file for sure
-            pass
-        elif file_.lower().endswith(nonAudioExt):
-            # This matches one of the non-audio extensions. Find which
-            # extension it is and remove the file from the file list as
-            # instructed to by the config settings.
-            for ext, removeOption in extensionList:
-                if file_.lower().endswith(ext):
-                    # Extension matched! Remove the file according to
-                    # the config settings, prompting if necessary.
-
-                    if (
-                        removeOption == PROMPT
-                        and (
-                            noninteractive or talk.prompt("Move '%s'?" % file_)
-                        )
-                    ) or removeOption == NO:
-                        # Keep the file in the file list
-                        break
-                    else:
-                        # Add index to list of indices to remove
-                        indexList += [destinationFiles.index(file_)]
-        else:
-            # This is some other kind of file. Remove the file according
-            # to the config settings, prompting if necessary.
-            if (
-                otherOption == PROMPT
-                and (noninteractive or talk.prompt("Move '%s'?" % file_))
-            ) or otherOption == NO:
-                # Keep the file in the file list
-                pass
-            else:
-                # Add index to list of indices to remove
-                indexList += [destinationFiles.index(file_)]
+    ]:
+        for ext in extensions:
+            removeOptions[ext] = removeOption
 
-    # Remove files we don't want from the file lists, going through the
-    # indices in reverse order
-    for index in indexList[::-1]:
-        sourceFiles.pop(index)
-        destinationFiles.pop(index)
+    def isWanted(record):
+        """Return whether to keep a file, prompting if necessary."""
+        # Files with extensions we don't know about are some other kind
+        # of file
+        removeOption = removeOptions.get(record.suffix, otherOption)
 
-    return
+        return (
+            removeOption == PROMPT
+            and (
+                noninteractive
+                or talk.prompt("Move '%s'?" % record.destination)
+            )
+        ) or removeOption == NO
+
+    return isWanted
 
 
 def createDirectories(
@@ -252,24 +165,33 @@ def createDirectories(
 
 
 def convertAudioFiles(
-    sourceFiles,
-    destinationFiles,
+    plan,
     configsettings,
     noninteractive=False,
     verbose=False,
     quiet=False,
+    jobs=1,
+    cacheDirectory=None,
+    profiler=None,
+    progress=None,
+    probeDatabase=None,
+    flusher=None,
 ):
     """Convert non-mp3 audio files to mp3.
 
     Uses FFmpeg to convert audio files with non-mp3 extensions (as
-    specified in the config settings) to mp3s. Returns a list of paths
-    to the mp3 files created, and updates the source and destination
-    file lists in place, replacing the original files with the newly
+    specified in the config settings) to mp3s. Files which hold MP3
+    audio already just have it copied into an mp3 file. Returns a list
+    of paths to the mp3 files created, and updates the plan's file
+    records in place, replacing the original files with the newly
     converted files.
 
-    The input arguments for the source and destination files are
-    expected to be in terms of absolute paths; [*] furthermore, their
-    indices are expected to correspond to each other.
+    If the ConvertDirectlyToDestination config setting is on, converted
+    files which aren't in the cache are written straight to their
+    destinations, whose directories must already exist, and are removed
+    from the plan instead of being swapped in. Only as many conversions
+    as the device takes writers run at once; the rest wait for a
+    writer.
 
     If the user has an old version of FFmpeg, it's quite possible that
     metadata will fail to transfer to the converted file. On later
@@ -277,10 +199,8 @@ def convertAudioFiles(
     here.
 
     Args:
-        sourceFiles: A list of strings of absolute paths to source
-            files. See [*] above.
-        destinationFiles: A list of strings of absolute paths to
-            destination files. See [*] above.
+        plan: A 'plan.TransferPlan' object containing the files to
+            transfer.
         configsettings: A dictionary-like 'configparser.SectionProxy'
             object containing configuration settings from config.ini.
         noninteractive: An optional boolean signalling to never ask to
@@ -291,17 +211,315 @@ def convertAudioFiles(
         quiet: An optional boolean toggling whether to omit both error
             output and output to signal that the non-interactive flag
             has prevented a conversion from taking place.
+        jobs: An optional integer specifying how many conversions to
+            run at the same time.
+        cacheDirectory: An optional string containing the path to a
+            transcode cache directory. If given, converted files are
+            taken from (and stored in) the cache instead of being
+            written next to the original files.
+        profiler: An optional 'profiling.Profiler' object to record how
+            long each conversion takes, and how many conversions wait
+            for a job, with.
+        progress: An optional 'talk.Progress' object to count files
+            converted straight to their destinations (or left alone) as
+            done on, and to show encoding speed on. The caller counts
+            the total.
+        probeDatabase: An optional string containing the path of the
+            probe cache's database, to look up what files are like in.
+            If given, the longest files are converted first, so that no
+            job is left converting a long file on its own at the end.
+        flusher: An optional 'flush.Flusher' object to flush files
+            converted straight to their destinations with.
+
+    Returns:
+        A list of strings containing the absolute paths of the temporary
+        files created by conversion; files in the cache aren't included.
+        Also modifies the plan in place such that the original files are
+        replaced by the newly converted files.
+    """
+    # Work out what to convert, prompting as necessary
+    conversions, finishedFiles = getConversions(
+        plan, configsettings, noninteractive
+    )
+
+    # Files left alone are as done as they'll get
+    if progress:
+        for _ in finishedFiles:
+            progress.finishFile()
+
+    # Start the longest conversions first. Files we can't tell the
+    # length of go last, in their original order.
+    if probeDatabase and jobs > 1:
+        audioInfo = probe.getAudioInfo(
+            [conversion[0].source for conversion in conversions],
+            jobs,
+            probeDatabase,
+            quiet,
+        )
+
+        def getDuration(conversion):
+            """Return how long a conversion's file is, or 0 if unknown."""
+            info = audioInfo[conversion[0].source]
+
+            if info is None or info.duration is None:
+                return 0
+
+            return info.duration
+
+        conversions.sort(key=getDuration, reverse=True)
+
+    # Arguments which determine how FFmpeg runs
+    logsetting = getFfmpegLogSetting(verbose, quiet)
+    encoderArguments = getEncoderArguments(configsettings)
+    priorityCommand = getPriorityCommand(configsettings)
+
+    # Time each conversion, and count conversions waiting for a job, if
+    # we're profiling
+    convert = getQueuedFunction(
+        profiler,
+        "transcode",
+        getTimedFunction(profiler, "convert", convertFile),
+    )
+
+    # Conversions written straight to the device take one of its
+    # writers (see getWriterCount) while they run
+    deviceWriters = threading.Semaphore(getWriterCount(configsettings))
+
+    # List of temporary files created
+    convertedFiles = []
+
+    # Convert the files on a bounded pool of workers. Each worker just
+    # waits on its own FFmpeg process, so threads are all we need here.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        # Start the conversions. Map each future back to its entry in
+        # the conversions list.
+        futures = {}
+
+        for conversion in conversions:
+            record, newFile, destinationFile = conversion
+
+            talk.status("Converting %s" % record.source, verbose)
+
+            if profiler:
+                profiler.addToQueue("transcode")
+
+            future = executor.submit(
+                convert,
+                record.source,
+                newFile,
+                encoderArguments,
+                logsetting,
+                cacheDirectory,
+                destinationFile,
+                progress,
+                priorityCommand,
+                probeDatabase,
+                record,
+                deviceWriters,
+            )
+            futures[future] = conversion
+
+        # Process the conversions as they finish
+        for future in concurrent.futures.as_completed(futures):
+            record, newFile, destinationFile = futures[future]
+            convertedFile = future.result()
+
+            if convertedFile is None:
+                # Failed to convert, unless we're being interrupted
+                if not commands.isCancelled():
+                    talk.error("Failed to convert %s" % record.source, quiet)
+            elif convertedFile == destinationFile:
+                # Success. The converted file is already at its
+                # destination, so there's nothing left to copy.
+                record.finalDestination = convertedFile
+                finishedFiles += [record]
+
+                if flusher:
+                    flusher.add(convertedFile)
+
+                if progress:
+                    progress.finishFile(getFileSize(convertedFile))
+            else:
+                # Success. If the file isn't in the cache, then it's a
+                # temporary file which needs to be removed later.
+                if convertedFile == newFile:
+                    convertedFiles += [newFile]
+
+                # Swap the source and destination files with the new
+                # converted files
+                record.source = convertedFile
+                record.setDestinationSuffix(".mp3")
+
+    # Remove files we've finished with from the plan
+    plan.removeFiles(finishedFiles)
+
+    return convertedFiles
+
+
+def getConversions(plan, configsettings, noninteractive=False):
+    """Return which audio files to convert and how.
+
+    Works out which files need converting (as specified in the config
+    settings) before any conversions start, so that all prompting
+    happens up front.
+
+    Args:
+        plan: A 'plan.TransferPlan' object containing the files to
+            transfer.
+        configsettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+        noninteractive: An optional boolean signalling to never ask to
+            convert files that it would otherwise prompt for, and
+            furthermore, to not do such conversions.
 
     Returns:
-        A list of strings containing the absolute paths of the files
-        created by conversion. Also modifies the source and destination
-        file lists in place such that the original files are replaced by
-        the newly converted files.
+        A 2-tuple containing (conversions, skippedFiles) where ...
+
+        conversions: A list of 3-tuples of (record, "newFile",
+            "destinationFile") for each file to convert, where record is
+            the file's 'plan.FileRecord', newFile is the path of the
+            temporary file to convert to, and destinationFile is the
+            path to convert straight to if ConvertDirectlyToDestination
+            is on, or None otherwise.
+        skippedFiles: A list of 'plan.FileRecord's for files which
+            shouldn't be converted or copied, because their converted
+            destination files may not be overwritten.
     """
-    # Quality setting for conversions. See:
-    # https://trac.ffmpeg.org/wiki/Encode/MP3
-    QUALITY = "0"
+    getConversion = getConversionFunction(configsettings, noninteractive)
+
+    # Files to convert and files to leave alone
+    conversions = []
+    skippedFiles = []
+
+    for record in plan.files:
+        conversion = getConversion(record)
+
+        if conversion is False:
+            skippedFiles += [record]
+        elif conversion is not None:
+            conversions += [(record,) + conversion]
+
+    return (conversions, skippedFiles)
+
+
+def getConversionFunction(configsettings, noninteractive=False):
+    """Return a function which decides whether and how to convert files.
+
+    The function returned takes a 'plan.FileRecord' and returns one of
+
+        None: the file doesn't need converting;
+        False: the file shouldn't be converted or copied, because its
+            converted destination file may not be overwritten;
+        a 2-tuple of ("newFile", "destinationFile"): the file should be
+            converted, where newFile is the path of the temporary file
+            to convert to, and destinationFile is the path to convert
+            straight to if ConvertDirectlyToDestination is on, or None
+            otherwise.
+
+    It prompts if the config settings ask it to, but doesn't prompt
+    more than once for the same extension in the same directory.
+
+    Args:
+        configsettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+        noninteractive: An optional boolean signalling to never ask to
+            convert files that it would otherwise prompt for, and
+            furthermore, to not do such conversions.
+
+    Returns:
+        A function taking a 'plan.FileRecord'.
+    """
+    # Extensions to convert, mapped to whether to prompt
+    extensionOptions = getConversionOptions(configsettings, noninteractive)
+
+    # Determine whether to write conversions straight to their
+    # destinations. Sorted creation can't have conversions creating
+    # destination entries out of order.
+    direct = (
+        configsettings.getint("ConvertDirectlyToDestination", fallback=0)
+        and not configsettings.getint("SortedCreation", fallback=0)
+    )
+
+    # Determine whether to overwrite destination files if there's a
+    # conflict, just like copyFiles does
+    overwritesetting = getOverwriteSetting(configsettings, noninteractive)
+
+    # Don't prompt more than once to convert the same file extension in
+    # the same directory.  Initialize a whitelist and blacklist for
+    # this, [**] which will contain sets of two-tuples of ("dirpath",
+    # "extension")
+    whitelist = set()
+    blacklist = set()
+
+    def getConversion(record):
+        """Return whether and how to convert a file."""
+        # Find if the extension matches
+        extension = record.suffix
+        prompt = extensionOptions.get(extension)
+
+        if prompt is None:
+            # Not a file we convert
+            return None
+
+        oldFile = record.source
+
+        if prompt:
+            # Work out whether we're on the whitelist, blacklist, or
+            # whether we should prompt for this file. See [**] above for
+            # more details.
+            container = os.path.dirname(oldFile)
+
+            if (container, extension) in whitelist:
+                # Convert the file
+                pass
+            elif (container, extension) in blacklist:
+                # Don't convert the file
+                return None
+            else:
+                # Prompt and modify white/black-lists accordingly
+                if talk.prompt(
+                    ("Convert %s and other %s's" "in the same directory?")
+                    % (oldFile, extension)
+                ):
+                    # Add to whitelist and convert
+                    whitelist.add((container, extension))
+                else:
+                    # Add to blacklist and don't convert
+                    blacklist.add((container, extension))
+                    return None
+
+        # If we're converting straight to the destination, make sure
+        # we're allowed to write there
+        if direct:
+            destinationFile = record.destination[: -len(extension)] + ".mp3"
+
+            if not mayWriteDestination(destinationFile, overwritesetting):
+                # Leave the destination file alone, and don't copy the
+                # unconverted file either
+                return False
+        else:
+            destinationFile = None
+
+        # Convert the file
+        return (oldFile[: -len(extension)] + ".mp3", destinationFile)
+
+    return getConversion
+
+
+def getConversionOptions(configsettings, noninteractive=False):
+    """Return which extensions to convert and whether to prompt for them.
+
+    Args:
+        configsettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+        noninteractive: An optional boolean signalling to leave out
+            extensions which would otherwise be prompted for.
 
+    Returns:
+        A dictionary mapping lowercase extensions (including the dot) to
+        convert to a boolean signalling whether to prompt before
+        converting files with that extension.
+    """
     # Load extensions to convert from config file
     flacConvert = configsettings.getint("ConvertFLACtoMP3")
     alacConvert = configsettings.getint("ConvertALACtoMP3")
@@ -310,195 +528,1028 @@ def convertAudioFiles(
     mp4Convert = configsettings.getint("ConvertMP4toMP3")
     oggConvert = configsettings.getint("ConvertOGGtoMP3")
 
-    # Put these extensions in a list along with the option specifying
-    # whether to prompt. Given that PROMPT is 2, YES is 1, and NO is 0,
-    # we have that promptOption = convertOption - 1
-    extensionList = []
+    # Map these extensions to the option specifying whether to prompt.
+    # Given that PROMPT is 2, YES is 1, and NO is 0, we have that
+    # promptOption = convertOption - 1
+    extensionOptions = {}
 
     if flacConvert:
-        extensionList += [[".flac", flacConvert - 1]]
+        extensionOptions[".flac"] = flacConvert - 1
     if alacConvert:
-        extensionList += [[".alac", alacConvert - 1]]
+        extensionOptions[".alac"] = alacConvert - 1
     if aacConvert:
-        extensionList += [[".aac", aacConvert - 1]]
+        extensionOptions[".aac"] = aacConvert - 1
     if m4aConvert:
-        extensionList += [[".m4a", m4aConvert - 1]]
+        extensionOptions[".m4a"] = m4aConvert - 1
     if mp4Convert:
-        extensionList += [[".mp4", mp4Convert - 1]]
+        extensionOptions[".mp4"] = mp4Convert - 1
     if oggConvert:
-        extensionList += [[".ogg", oggConvert - 1]]
+        extensionOptions[".ogg"] = oggConvert - 1
 
     # Make sure we don't prompt if we're in non-interactive mode
     if noninteractive:
-        for pair in extensionList:
-            if pair[1] == PROMPT:
+        for extension, prompt in list(extensionOptions.items()):
+            if prompt == PROMPT:
                 # Don't convert this extension
-                pairIndex = extensionList.index(pair)
-                extensionList.pop(pairIndex)
+                del extensionOptions[extension]
+
+    return extensionOptions
+
+
+def getEncoderArguments(configsettings):
+    """Return a list of FFmpeg arguments determining the output format.
+
+    The format is set by the encoder profile the EncoderProfile config
+    setting chooses (see the encoders module). Any cached conversion
+    must have been made with these same arguments.
+
+    Args:
+        configsettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+
+    Raises:
+        ValueError: The encoder profile doesn't exist or isn't valid.
+    """
+    return encoders.getEncoderProfile(configsettings).getArguments()
+
+
+def getStreamCopyArguments():
+    """Return a list of FFmpeg arguments copying MP3 audio as is."""
+    return ["-codec:a", "copy"]
+
+
+def getFileEncoderArguments(path, encoderArguments, probeDatabase=None):
+    """Return the FFmpeg arguments to convert a particular file with.
+
+    Files in containers which can hold MP3 audio are probed, and if they
+    do, their audio is copied instead of being re-encoded. Everything
+    else is encoded with the arguments given.
+
+    Args:
+        path: A string containing the path of the file to convert.
+        encoderArguments: A list of strings containing the FFmpeg
+            arguments to re-encode audio with, as returned by
+            getEncoderArguments.
+        probeDatabase: An optional string containing the path of the
+            probe cache's database.
+
+    Returns:
+        A list of strings containing FFmpeg arguments.
+    """
+    if not probe.mayHoldMp3(path):
+        return encoderArguments
+
+    info = probe.getAudioInfo([path], 1, probeDatabase)[path]
+
+    if probe.canStreamCopy(path, info):
+        return getStreamCopyArguments()
+
+    return encoderArguments
 
-    # Return an empty list if we don't need to convert anything
-    if not extensionList:
-        return []
 
-    # We need to look for files to convert. Determine how noisy FFmpeg
-    # should be.
+def getFfmpegLogSetting(verbose=False, quiet=False):
+    """Return a string containing how noisy FFmpeg should be."""
     if quiet:
-        logsetting = "fatal"
+        return "fatal"
     elif verbose:
-        logsetting = "info"
+        return "info"
+
+    return "warning"
+
+
+def convertFile(
+    oldFile,
+    newFile,
+    encoderArguments,
+    logsetting,
+    cacheDirectory=None,
+    destinationFile=None,
+    progress=None,
+    priorityCommand=None,
+    probeDatabase=None,
+    record=None,
+    deviceWriters=None,
+):
+    """Convert an audio file with FFmpeg.
+
+    If the file is in a container which holds MP3 audio already, the
+    audio is copied into the new file as is instead of being re-encoded
+    (see getFileEncoderArguments), which is much quicker and loses
+    nothing.
+
+    If a cache directory is given, look for the conversion in the cache
+    first, and store the conversion in the cache (instead of at newFile)
+    if it isn't there already. If a destination file is given, and the
+    conversion isn't in the cache, write the conversion to a staging
+    file next to the destination and rename it into place once it's
+    complete, then store a copy of it in the cache if we're using one.
+
+    Args:
+        oldFile: A string containing the path of the file to convert.
+        newFile: A string containing the path to write the converted
+            file to when not using the cache.
+        encoderArguments: A list of strings containing the FFmpeg
+            arguments specifying the codec and quality to use.
+        logsetting: A string containing FFmpeg's log level.
+        cacheDirectory: An optional string containing the path to a
+            transcode cache directory.
+        destinationFile: An optional string containing the path to
+            write the converted file to instead of newFile.
+        progress: An optional 'talk.Progress' object to report the
+            seconds of audio encoded to.
+        priorityCommand: An optional list of strings containing a
+            command to run FFmpeg under, as returned by
+            getPriorityCommand.
+        probeDatabase: An optional string containing the path of the
+            probe cache's database.
+        record: An optional 'plan.FileRecord' object for the file, to
+            note the file's hash on if it's worked out here.
+        deviceWriters: An optional 'threading.Semaphore' to hold while
+            writing to a destination file, so that no more files than
+            the device takes writers are written to it at once.
+
+    Returns:
+        A string containing the path of the converted file, or None if
+        the conversion failed.
+    """
+    # Copy MP3 audio instead of re-encoding it
+    encoderArguments = getFileEncoderArguments(
+        oldFile, encoderArguments, probeDatabase
+    )
+
+    # The cache entry for the conversion, if we're using the cache
+    entryPath = None
+
+    if cacheDirectory:
+        # Look in the cache first
+        try:
+            key, sourceHash = cache.getCacheKey(oldFile, encoderArguments)
+        except OSError:
+            return None
+
+        # Note the hash so the manifest needn't read the file again
+        if record is not None:
+            record.sourceHash = sourceHash
+
+        entryPath = cache.getEntryPath(cacheDirectory, key)
+
+        if cache.lookup(entryPath):
+            # Cache hit
+            return entryPath
+
+    if destinationFile:
+        # Write to a staging file on the destination
+        outputFile = destinationFile + ".part"
+        finalFile = destinationFile
+    elif entryPath:
+        # Cache miss. Write to a staging file in the cache.
+        try:
+            outputFile = cache.getStagingPath(entryPath)
+        except OSError:
+            return None
+
+        finalFile = entryPath
     else:
-        logsetting = "warning"
+        outputFile = newFile
+        finalFile = newFile
 
-    # List of files converted
-    convertedFiles = []
+    # Staging files belong to us, so it's fine to overwrite them
+    if outputFile == finalFile:
+        overwriteOption = "-n"
+    else:
+        overwriteOption = "-y"
+
+    command = (
+        (priorityCommand or [])
+        + ["ffmpeg"]
+        + [overwriteOption]
+        + ["-nostdin"]
+        + ["-hide_banner"]
+        + ["-loglevel", logsetting]
+        + ["-i", oldFile]
+        + encoderArguments
+        + ["-f", "mp3"]
+        + [outputFile]
+    )
+
+    # Wait for one of the device's writers if we're writing to it
+    if destinationFile and deviceWriters:
+        deviceWriters.acquire()
+
+    # Wait for completion, reporting how far FFmpeg's got if we're
+    # showing progress
+    try:
+        returnCode = runFfmpeg(command, progress)
+    finally:
+        if destinationFile and deviceWriters:
+            deviceWriters.release()
+
+    if returnCode:
+        # Failed to convert. Don't leave staging files around.
+        if outputFile != finalFile and os.path.exists(outputFile):
+            os.remove(outputFile)
+
+        return None
+
+    if outputFile != finalFile:
+        # Move the complete conversion into place
+        try:
+            os.replace(outputFile, finalFile)
+        except OSError:
+            return None
 
-    # Don't prompt more than once to convert the same file extension in
-    # the same directory.  Initialize a whitelist and blacklist for
-    # this, [**] which will contain lists of two-tuples of ("dirpath",
-    # "extension")
-    whitelist = []
-    blacklist = []
-
-    # Convert each file as necessary
-    for oldFile in sourceFiles:
-        for extension, prompt in extensionList:
-            # Find if the extensions match
-            extensionMatch = oldFile.lower().endswith(extension)
-
-            if extensionMatch:
-                # An extension matched!
-                if prompt:
-                    # Work out whether we're on the whitelist,
-                    # blacklist, or whether we should prompt for this
-                    # file. See [**] above for more details.
-                    container = os.path.dirname(oldFile)
-
-                    if (container, extension) in whitelist:
-                        # Convert the file
-                        pass
-                    elif (container, extension) in blacklist:
-                        # Move on to next file
-                        break
-                    else:
-                        # Prompt and modify white/black-lists
-                        # accordingly
-                        if talk.prompt(
-                            (
-                                "Convert %s and other %s's"
-                                "in the same directory?"
-                            )
-                            % (oldFile, extension)
-                        ):
-                            # Add to whitelist and convert
-                            whitelist += [(container, extension)]
-                        else:
-                            # Add to blacklist and move on to next file
-                            blacklist += [(container, extension)]
-                            break
-
-                # Convert the file!
-                talk.status("Converting %s" % oldFile, verbose)
-
-                newFile = oldFile[: -len(extension)] + ".mp3"
-                command = (
-                    ["ffmpeg"]
-                    + ["-n"]
-                    + ["-hide_banner"]
-                    + ["-loglevel", logsetting]
-                    + ["-i", oldFile]
-                    + ["-codec:a", "libmp3lame"]
-                    + ["-qscale:a", QUALITY]
-                    + [newFile]
-                )
+    # Cache misses written straight to their destinations are cached
+    # too, so the next run needn't convert them again
+    if entryPath and finalFile != entryPath:
+        cache.store(finalFile, entryPath)
 
-                # Give stdin and stdout to user and wait for completion
-                convertProcess = subprocess.Popen(command)
-                exitCode = convertProcess.wait()
+    return finalFile
 
-                if exitCode:
-                    # Failed to convert
-                    talk.error("Failed to convert %s" % oldFile, quiet)
-                else:
-                    # Success. Add to list of converted files
-                    convertedFiles += [newFile]
 
-                    # Swap the source and destination files with the new
-                    # converted file-name.
-                    oldFileIndex = sourceFiles.index(oldFile)
-                    oldDestination = destinationFiles[oldFileIndex]
-                    newDestination = oldDestination[: -len(extension)] + ".mp3"
+def runFfmpeg(command, progress=None):
+    """Run an FFmpeg command and return its exit code.
 
-                    sourceFiles[oldFileIndex] = newFile
-                    destinationFiles[oldFileIndex] = newDestination
+    If we're showing progress, FFmpeg reports how much audio it's
+    encoded on stdout (see FFmpeg's -progress option), and we pass that
+    on. Otherwise, stdout goes to the user. If we're interrupted, the
+    partial output file is removed.
 
-                # Move on to next file
-                break
+    Args:
+        command: A list of strings containing the FFmpeg command, with
+            the output file last.
+        progress: An optional 'talk.Progress' object to report the
+            seconds of audio encoded to.
 
-    return convertedFiles
+    Returns:
+        An integer containing FFmpeg's exit code.
+    """
+    if not (progress and progress.enabled):
+        return runCommand(command, "convert", command[-1:])
+
+    # Options go before the output file. Stats would draw over the
+    # progress line, so turn them off.
+    command = (
+        command[:-1] + ["-nostats", "-progress", "pipe:1"] + command[-1:]
+    )
+
+    # Microseconds of audio encoded so far
+    encodedTime = 0
+
+    def readProgress(line):
+        """Pass on the audio encoded since FFmpeg's last update."""
+        nonlocal encodedTime
+
+        # Each update is a block of key=value lines. Despite its name,
+        # out_time_ms is in microseconds too; use out_time_us where we
+        # can.
+        key, _, value = line.strip().partition("=")
+
+        if key in ("out_time_us", "out_time_ms"):
+            try:
+                newTime = int(value)
+            except ValueError:
+                return
+
+            if newTime > encodedTime:
+                progress.addEncoded((newTime - encodedTime) / 1e6)
+                encodedTime = newTime
+
+    return getExitCode(
+        commands.run(
+            command,
+            group="convert",
+            onLine=readProgress,
+            outputs=command[-1:],
+        )
+    )
+
+
+def getFileSize(path):
+    """Return the size of a file in bytes, or 0 if we can't tell."""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
 
 
 def copyFiles(
-    sourceFiles,
-    destinationFiles,
+    plan,
     configsettings,
     noninteractive=False,
     verbose=False,
     quiet=False,
+    profiler=None,
+    progress=None,
+    flusher=None,
 ):
     """Copy files from a source to a destination.
 
-    Use cp with options specified in config settings to copy each source
-    file into a destination file.
+    Copy each source file into a destination file, either in-process
+    (the default) or with cp, depending on the CopyBackend config
+    setting. Whether to overwrite existing destination files is
+    specified by the OverwriteDestinationFiles config setting. Files are
+    copied one after another, unless the DeviceWriters config setting
+    allows several at once.
 
-    [*] The indices of the source file list and destination file list
-    inputs must correspond to each other.
+    Args:
+        plan: A 'plan.TransferPlan' object containing the files to
+            transfer.
+        configsettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+        noninteractive: An optional boolean signalling to never prompt
+            to overwrite destination files.
+        verbose: An optional boolean toggling whether to print each
+            file copied.
+        quiet: An optional boolean toggling whether to omit error
+            output.
+        profiler: An optional 'profiling.Profiler' object to record how
+            long each copy takes with.
+        progress: An optional 'talk.Progress' object to count each file
+            copied as done on. The caller counts the total.
+        flusher: An optional 'flush.Flusher' object to flush each file
+            copied with.
+    """
+    copyFile = getTimedFunction(
+        profiler,
+        "copy",
+        getCopyFunction(configsettings, noninteractive, verbose),
+    )
+
+    def copyRecord(record):
+        """Copy a single file, unless we're being interrupted."""
+        if commands.isCancelled():
+            return
+
+        if not copyFile(record.source, record.destination):
+            # Failed to copy
+            talk.error("Failed to copy %s" % record.source, quiet)
+        else:
+            record.finalDestination = record.destination
+
+            if flusher:
+                flusher.add(record.destination)
+
+        if progress:
+            progress.finishFile(getFileSize(record.source))
+
+    # Copy the files to the destination directory
+    writers = getWriterCount(configsettings)
+
+    if writers == 1:
+        for record in plan.files:
+            copyRecord(record)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=writers
+        ) as executor:
+            # Raise any unexpected errors
+            for _ in executor.map(copyRecord, plan.files):
+                pass
+
+    return
+
+
+def transferFiles(
+    records,
+    configsettings,
+    noninteractive=False,
+    verbose=False,
+    quiet=False,
+    jobs=1,
+    cacheDirectory=None,
+    profiler=None,
+    progress=None,
+    probeDatabase=None,
+    flusher=None,
+):
+    """Convert and copy files, copying while conversions are running.
+
+    Does the work of convertAudioFiles followed by copyFiles (and
+    deleting the temporary files created), but as a pipeline: files
+    which don't need converting start copying straight away, and each
+    converted file is queued for copying as soon as its conversion
+    finishes. At most as many converted files as there are conversion
+    jobs wait to be copied at any time, which caps the temporary space
+    used; conversions block until there's room. Conversions and copies
+    have separate limits: copies are done by as many writers as the
+    DeviceWriters config setting allows (one by default), however many
+    conversions are running. Conversions written straight to their
+    destinations share those writers with the copies.
+
+    The files to transfer can come from a generator, in which case
+    transferring starts before the generator is exhausted. Destination
+    directories must exist before their files are generated. The file
+    records are updated in place as files are converted.
 
     Args:
-        sourceFiles: A list of strings of absolute paths to source
-            files. See [*] above.
-        destinationFiles: A list of strings of absolute paths to
-            destination files. See [*] above.
+        records: An iterable of 'plan.FileRecord's for the files to
+            transfer.
         configsettings: A dictionary-like 'configparser.SectionProxy'
             object containing configuration settings from config.ini.
-        noninteractive: An optional boolean signalling to never run cp
-            with its interactive flag.
-        verbose: An optional boolean toggling whether to run cp with its
-            verbose flag.
+        noninteractive: An optional boolean signalling to never prompt
+            for anything.
+        verbose: An optional boolean toggling whether to give extra
+            output.
         quiet: An optional boolean toggling whether to omit error
             output.
+        jobs: An optional integer specifying how many conversions to
+            run at the same time.
+        cacheDirectory: An optional string containing the path to a
+            transcode cache directory.
+        profiler: An optional 'profiling.Profiler' object to record how
+            long each conversion and copy takes, and how many files wait
+            to be converted and copied, with.
+        progress: An optional 'talk.Progress' object to show how far
+            we've got on. Files are counted towards the total as they
+            come in.
+        probeDatabase: An optional string containing the path of the
+            probe cache's database.
+        flusher: An optional 'flush.Flusher' object to flush each file
+            written to the destination with.
+
+    Returns:
+        A list of the 'plan.FileRecord's transferred (or attempted to
+        be), leaving out those whose converted destination files may
+        not be overwritten.
     """
-    # Initialize list of options to run cp with
-    cpOptions = []
+    # Decides what to convert, prompting as necessary
+    getConversion = getConversionFunction(configsettings, noninteractive)
+
+    # Files waiting to be copied. Each item is a 2-tuple of a record to
+    # copy and the path of a temporary file to remove after copying, or
+    # None.
+    copyQueue = CopyQueue(jobs, profiler=profiler)
+
+    # Number of files to copy at once
+    writers = getWriterCount(configsettings)
+
+    # Arguments which determine how FFmpeg runs
+    logsetting = getFfmpegLogSetting(verbose, quiet)
+    encoderArguments = getEncoderArguments(configsettings)
+    priorityCommand = getPriorityCommand(configsettings)
+
+    # Time each conversion and copy, and count conversions waiting for
+    # a job, if we're profiling
+    convert = getQueuedFunction(
+        profiler,
+        "transcode",
+        getTimedFunction(profiler, "convert", convertFile),
+    )
+
+    # Conversions written straight to the device take one of its
+    # writers (see getWriterCount) while they run
+    deviceWriters = threading.Semaphore(getWriterCount(configsettings))
+
+    def convertAndQueue(record, newFile, destinationFile):
+        """Convert a file and queue the result for copying."""
+        convertedFile = convert(
+            record.source,
+            newFile,
+            encoderArguments,
+            logsetting,
+            cacheDirectory,
+            destinationFile,
+            progress,
+            priorityCommand,
+            probeDatabase,
+            record,
+            deviceWriters,
+        )
+
+        if convertedFile is None:
+            if commands.isCancelled():
+                # Interrupted; we're stopping
+                return
+
+            # Failed to convert. Copy the original file instead, like
+            # convertAudioFiles followed by copyFiles would.
+            talk.error("Failed to convert %s" % record.source, quiet)
+
+            copyQueue.put((record, None), True)
+        elif convertedFile != destinationFile:
+            # Swap in the converted file and queue it, waiting for room
+            # if necessary
+            record.source = convertedFile
+            record.setDestinationSuffix(".mp3")
+
+            if convertedFile == newFile:
+                tmpFile = newFile
+            else:
+                tmpFile = None
+
+            copyQueue.put((record, tmpFile), True)
+        else:
+            # Already at its destination
+            record.finalDestination = convertedFile
+
+            if progress:
+                progress.finishFile(getFileSize(convertedFile))
+
+            if flusher:
+                flusher.add(convertedFile)
+
+    copyFile = getTimedFunction(
+        profiler,
+        "copy",
+        getCopyFunction(configsettings, noninteractive, verbose),
+    )
+
+    def copyQueuedFiles():
+        """Copy files until there's nothing left to copy.
+
+        If copying fails unexpectedly, the queue is aborted, so that
+        conversions waiting for room in it fail too instead of waiting
+        forever.
+        """
+        try:
+            copyQueuedItems()
+        except Exception as error:
+            copyQueue.abort(error)
+            raise
+
+    def copyQueuedItems():
+        """Copy files from the queue until it's closed and empty."""
+        while True:
+            item = copyQueue.get()
+
+            if item is None:
+                # All done
+                return
+
+            record, tmpFile = item
+
+            # If we're interrupted, keep emptying the queue so nothing
+            # waits on it, but don't copy anything more
+            if not commands.isCancelled():
+                with deviceWriters:
+                    copied = copyFile(record.source, record.destination)
+
+                if not copied:
+                    # Failed to copy
+                    talk.error("Failed to copy %s" % record.source, quiet)
+                else:
+                    record.finalDestination = record.destination
+
+                    if flusher:
+                        flusher.add(record.destination)
+
+                if progress:
+                    progress.finishFile(getFileSize(record.source))
+
+            if tmpFile:
+                # Remove temporary files as soon as we're done with them
+                deleteFiles([tmpFile], quiet)
 
+    # Files transferred
+    transferredFiles = []
+
+    # Start copying in the background, then go through the files,
+    # converting or queueing each for copying
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=writers
+    ) as copier:
+        copyFutures = [
+            copier.submit(copyQueuedFiles) for _ in range(writers)
+        ]
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=jobs
+            ) as executor:
+                futures = []
+
+                for record in records:
+                    conversion = getConversion(record)
+
+                    if conversion is False:
+                        # Leave this file alone
+                        continue
+
+                    transferredFiles += [record]
+
+                    if progress:
+                        progress.addFiles()
+
+                    if conversion is None:
+                        # Copy this straight away
+                        copyQueue.put((record, None))
+                    else:
+                        talk.status("Converting %s" % record.source, verbose)
+
+                        if profiler:
+                            profiler.addToQueue("transcode")
+
+                        futures += [
+                            executor.submit(
+                                convertAndQueue, record, *conversion
+                            )
+                        ]
+
+            # Raise any unexpected errors from the conversions
+            for future in futures:
+                future.result()
+        finally:
+            # Tell the copiers there's nothing more coming and wait for
+            # them to finish
+            copyQueue.close()
+
+            for copyFuture in copyFutures:
+                copyFuture.result()
+
+    return transferredFiles
+
+
+class CopyQueue:
+    """A queue of files waiting to be copied.
+
+    Holds two bounded queues: one for converted files and one for files
+    which didn't need converting. Converted files are handed out first,
+    since they're taking up temporary space. Putting an item into a full
+    queue blocks until there's room, and getting an item from an empty
+    queue blocks until there's an item or the queue is closed.
+
+    If whatever's taking items out of the queue fails, it should abort
+    the queue, so that nothing waits on it forever; putting and getting
+    then raise the error it failed with.
+
+    If there's a profiler, it's told how many files are waiting, as the
+    "write" queue.
+    """
+
+    # Default maximum number of unconverted files waiting to be copied
+    DEFAULT_PLAIN_SIZE = 1024
+
+    def __init__(
+        self, convertedSize, plainSize=DEFAULT_PLAIN_SIZE, profiler=None
+    ):
+        """Initialize an empty queue.
+
+        Args:
+            convertedSize: An integer containing the maximum number of
+                converted files waiting to be copied.
+            plainSize: An optional integer containing the maximum number
+                of unconverted files waiting to be copied.
+            profiler: An optional 'profiling.Profiler' object to record
+                how many files are waiting with.
+        """
+        self.condition = threading.Condition()
+        self.queues = {
+            True: (collections.deque(), convertedSize),
+            False: (collections.deque(), plainSize),
+        }
+        self.closed = False
+        self.error = None
+        self.profiler = profiler
+
+    def put(self, item, converted=False):
+        """Add an item, waiting for room if necessary.
+
+        Raises:
+            RuntimeError: The queue is closed.
+            Exception: The queue was aborted with this error.
+        """
+        items, size = self.queues[converted]
+
+        with self.condition:
+            while len(items) >= size and not self.closed:
+                self.condition.wait()
+
+            self.raiseIfClosed()
+
+            items.append(item)
+            self.condition.notify_all()
+
+        if self.profiler:
+            self.profiler.addToQueue("write")
+
+    def get(self):
+        """Remove and return an item, or None if we're closed and empty.
+
+        Raises:
+            Exception: The queue was aborted with this error.
+        """
+        convertedItems = self.queues[True][0]
+        plainItems = self.queues[False][0]
+
+        with self.condition:
+            while not (convertedItems or plainItems or self.closed):
+                self.condition.wait()
+
+            if self.error is not None:
+                raise self.error
+
+            if convertedItems:
+                item = convertedItems.popleft()
+            elif plainItems:
+                item = plainItems.popleft()
+            else:
+                return None
+
+            self.condition.notify_all()
+
+        if self.profiler:
+            self.profiler.removeFromQueue("write")
+
+        return item
+
+    def close(self):
+        """Signal that nothing more will be put into the queue."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def abort(self, error):
+        """Close the queue because its items can't be dealt with.
+
+        Args:
+            error: The exception which stopped items being dealt with.
+                It's raised to anything putting or getting items from
+                now on.
+        """
+        with self.condition:
+            if self.error is None:
+                self.error = error
+
+            self.closed = True
+            self.condition.notify_all()
+
+    def raiseIfClosed(self):
+        """Raise an error if the queue is closed.
+
+        The condition must be held.
+        """
+        if self.error is not None:
+            raise self.error
+
+        if self.closed:
+            raise RuntimeError("copy queue is closed")
+
+
+def getOverwriteSetting(configsettings, noninteractive=False):
+    """Return whether to overwrite destination files.
+
+    Args:
+        configsettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+        noninteractive: An optional boolean signalling to never prompt
+            to overwrite destination files.
+
+    Returns:
+        One of the YES, NO, or PROMPT config setting constants. PROMPT
+        is never returned in non-interactive mode; we don't overwrite
+        anything if we can't ask.
+    """
+    overwritesetting = configsettings.getint("OverwriteDestinationFiles")
+
+    if overwritesetting == PROMPT and noninteractive:
+        return NO
+
+    return overwritesetting
+
+
+def mayWriteDestination(destination, overwritesetting):
+    """Return whether a destination file may be written to.
+
+    Prompts if necessary.
+
+    Args:
+        destination: A string containing the path of the destination
+            file.
+        overwritesetting: One of the YES, NO, or PROMPT config setting
+            constants specifying whether to overwrite existing files.
+
+    Returns:
+        A boolean signalling whether to write the destination file.
+    """
+    if not os.path.lexists(destination):
+        # Nothing to overwrite
+        return True
+
+    if overwritesetting == PROMPT:
+        return talk.prompt("Overwrite '%s'?" % destination)
+
+    return overwritesetting == YES
+
+
+def getCopyFunction(configsettings, noninteractive=False, verbose=False):
+    """Return a function which copies a file to a destination.
+
+    The function returned takes source and destination paths and
+    returns a boolean signalling whether it succeeded. It copies either
+    in-process (the default) or with cp, depending on the CopyBackend
+    config setting, and only overwrites existing destination files as
+    specified by the OverwriteDestinationFiles config setting; not
+    overwriting a file doesn't count as failing.
+
+    Args:
+        configsettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+        noninteractive: An optional boolean signalling to never prompt
+            to overwrite destination files.
+        verbose: An optional boolean toggling whether to print each
+            file copied.
+
+    Returns:
+        A function taking source and destination strings and returning
+        a boolean.
+    """
     # Determine whether to overwrite destination files if there's a
     # conflict
-    overwritesetting = configsettings.getint("OverwriteDestinationFiles")
+    overwritesetting = getOverwriteSetting(configsettings, noninteractive)
+
+    # Use cp if we're asked to
+    if configsettings.get("CopyBackend", fallback="native") == "cp":
+        # Initialize list of options to run cp with
+        cpOptions = []
+
+        if overwritesetting == YES:
+            # cp --force
+            cpOptions += ["-f"]
+        elif overwritesetting == PROMPT:
+            # cp --interactive
+            cpOptions += ["-i"]
+        else:
+            # cp --no-clobber
+            cpOptions += ["-n"]
+
+        # Determine whether to be verbose
+        if verbose:
+            cpOptions += ["-v"]
+
+        def copyFileWithCp(source, destination):
+            """Copy a file with cp and return whether it succeeded."""
+            # Only remove the destination if we're interrupted when it's
+            # ours to remove
+            if os.path.lexists(destination):
+                outputs = []
+            else:
+                outputs = [destination]
 
-    if overwritesetting == YES:
-        # cp --force
-        cpOptions += ["-f"]
-    elif overwritesetting == PROMPT and not noninteractive:
-        # cp --interactive
-        cpOptions += ["-i"]
-    else:
-        # cp --no-clobber
-        cpOptions += ["-n"]
+            # Give stdin and stdout to user and wait for completion
+            return not runCommand(
+                ["cp", source, destination] + cpOptions, outputs=outputs
+            )
 
-    # Determine whether to be verbose
-    if verbose:
-        cpOptions += ["-v"]
+        return copyFileWithCp
 
-    # Copy the files to the destination directory
-    for source, destination in zip(sourceFiles, destinationFiles):
-        # Give stdin and stdout to user and wait for completion
-        copyProcess = subprocess.Popen(["cp", source, destination] + cpOptions)
-        exitCode = copyProcess.wait()
+    # Number of bytes to copy per system call
+    bufferSize = (
+        configsettings.getint("CopyBufferSize", fallback=0) * 1024
+        or copyengine.DEFAULT_BUFFER_SIZE
+    )
 
-        if exitCode:
-            # Failed to copy
-            talk.error("Failed to copy %s" % source, quiet)
+    # Numbers of bytes to copy per system call into each destination
+    # directory
+    directoryBufferSizes = {}
 
-    return
+    def getBufferSize(destination):
+        """Return the number of bytes to copy per system call.
+
+        Writes are rounded up to whole blocks of the destination's
+        filesystem (clusters, on FAT), so that no write leaves a
+        cluster half written for the next one to finish.
+        """
+        directory = os.path.dirname(destination)
+
+        if directory not in directoryBufferSizes:
+            mount = mounts.findMount(directory)
+            blockSize = mount.blockSize if mount else None
+
+            if blockSize:
+                directoryBufferSizes[directory] = (
+                    -(-bufferSize // blockSize) * blockSize
+                )
+            else:
+                directoryBufferSizes[directory] = bufferSize
+
+        return directoryBufferSizes[directory]
+
+    def copyFileNatively(source, destination):
+        """Copy a file in-process and return whether it succeeded."""
+        # Check whether we'd be overwriting anything
+        if not mayWriteDestination(destination, overwritesetting):
+            # Leave the destination file alone
+            return True
+
+        try:
+            copyengine.copyFile(
+                source,
+                destination,
+                getBufferSize(destination),
+                overwritesetting == YES,
+            )
+        except OSError:
+            return False
+
+        talk.status("'%s' -> '%s'" % (source, destination), verbose)
+
+        return True
+
+    return copyFileNatively
+
+
+def getTimedFunction(profiler, kind, function):
+    """Return a function which a profiler times, if there's a profiler.
+
+    Args:
+        profiler: A 'profiling.Profiler' object, or None.
+        kind: A string containing what the function does to files, like
+            "convert" or "copy".
+        function: A function whose first argument is the path of a file.
+
+    Returns:
+        The function given, or a wrapper around it which records how
+        long each call takes.
+    """
+    if profiler is None:
+        return function
+
+    return profiler.timeFiles(kind, function)
+
+
+def getQueuedFunction(profiler, name, function):
+    """Return a function which takes an item off a profiler's queue.
+
+    Callers add an item to the queue when they submit a call to a pool
+    of workers; the function returned takes it off again when a worker
+    starts the call.
+
+    Args:
+        profiler: A 'profiling.Profiler' object, or None.
+        name: A string containing the name of the queue.
+        function: The function to call.
+
+    Returns:
+        The function given, or a wrapper around it.
+    """
+    if profiler is None:
+        return function
+
+    def queuedFunction(*args, **kwargs):
+        """Leave the queue and call the function."""
+        profiler.removeFromQueue(name)
+
+        return function(*args, **kwargs)
+
+    return queuedFunction
+
+
+def getWriterCount(configsettings):
+    """Return how many files to write to a device at once.
+
+    Several writers to a cheap USB stick fragment its FAT and slow it
+    down, so this is one unless the DeviceWriters config setting says
+    otherwise. Entries created in sorted order are always written one
+    at a time, since writing several at once would mix up the order.
+
+    Args:
+        configsettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+
+    Returns:
+        A positive integer.
+    """
+    if configsettings.getint("SortedCreation", fallback=0):
+        return 1
+
+    return max(configsettings.getint("DeviceWriters", fallback=1), 1)
+
+
+def getPriorityCommand(configsettings):
+    """Return a command to run conversions at a lower priority under.
+
+    Uses nice and ionice, as specified by the TranscodeNiceness and
+    TranscodeIoClass config settings, so that conversions don't get in
+    the way of writing to the device (or of anything else). Programs
+    which aren't installed are left out.
+
+    Args:
+        configsettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+
+    Returns:
+        A list of strings to put in front of the FFmpeg command; empty
+        if we're running conversions at normal priority.
+    """
+    command = []
+
+    # CPU priority
+    niceness = configsettings.getint("TranscodeNiceness", fallback=0)
+
+    if niceness and shutil.which("nice"):
+        command += ["nice", "-n", str(niceness)]
+
+    # I/O priority
+    ioClass = configsettings.get("TranscodeIoClass", fallback="none")
+    ioClassOptions = {
+        "best-effort": ["-c", "2", "-n", "7"],
+        "idle": ["-c", "3"],
+    }
+
+    if ioClass in ioClassOptions and shutil.which("ionice"):
+        command += ["ionice"] + ioClassOptions[ioClass]
+
+    return command
 
 
 def deletePaths(paths, doprompt=True, verbose=False, quiet=False):
@@ -544,6 +1595,39 @@ def deletePaths(paths, doprompt=True, verbose=False, quiet=False):
     return
 
 
+def runCommand(command, group=None, outputs=()):
+    """Run a command and return its exit code.
+
+    The command's standard streams are left with the user.
+
+    Args:
+        command: A list of strings containing the command.
+        group: An optional string containing the name of the group of
+            commands to limit the command with (see commands.setLimit).
+        outputs: An optional iterable of strings containing the paths of
+            files the command writes, to remove if we're interrupted.
+
+    Returns:
+        An integer containing the command's exit code.
+
+    Raises:
+        OSError: The command couldn't be started.
+    """
+    return getExitCode(commands.run(command, group=group, outputs=outputs))
+
+
+def getExitCode(result):
+    """Return the exit code of a 'commands.CommandResult'.
+
+    Commands which were cancelled, or never started, count as having
+    failed.
+    """
+    if result.succeeded():
+        return 0
+
+    return result.returnCode or 1
+
+
 def deleteFiles(filePaths, quiet=False):
     """Delete a list of files."""
     for path in filePaths: